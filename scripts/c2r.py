@@ -2,14 +2,129 @@
 """
 
 import sys
-import glob
 import os
 import re
+import io
+import csv
+import gzip
+import bz2
+import lzma
 import datetime
+import heapq
+import json
+import copy
+import shutil
+import tempfile
+import collections
+import pickle
+import struct
+import socket
+import socketserver
+import threading
+import concurrent.futures
+from operator import itemgetter
 import yaml
 import numpy as np
+import numpy.lib.recfunctions as rfn
 import pandas as pd
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# Labels whose values repeat heavily across the particles. They are stored as pandas Categorical (dictionary-encoded).
+CATEGORICAL_LABELS = (
+    '_rlnMicrographName',
+    '_rlnOpticsGroup',
+    '_rlnGroupName',
+    '_rlnGroupNumber',
+)
+
+
+def open_star(filename, mode='r', threads=0, level=None):
+    """Open a star file, transparently (de)compressing it based on the file extension.
+
+    Parameters
+    ----------
+    filename : string
+        File name. '.gz', '.bz2', '.xz' and '.zst' files are (de)compressed on the fly. Any other file is opened as plain text.
+
+    mode : string, optional
+        'r', 'w', 'rb' or 'wb'. By default 'r'
+
+    threads : int, optional
+        Number of compression threads. Only zstd supports multithreaded compression, the other codecs ignore it. -1 uses all the logical CPUs. By default 0 (compress in the calling thread)
+
+    level : int, optional
+        Compression level. By default None (6 for gzip, bz2 and xz, 3 for zstd)
+
+    Returns
+    -------
+    file object
+        File-like object, text mode unless 'b' is in mode.
+    """
+
+    assert mode in ('r', 'w', 'rb', 'wb'), f'Unsupported mode: {mode}'
+    binary = 'b' in mode
+    bmode = mode[0] + 'b'
+    ext = os.path.splitext(filename)[1].lower()
+
+    if ext == '.gz':
+        f = gzip.open(filename, bmode, compresslevel=6 if level is None else level)
+    elif ext == '.bz2':
+        f = bz2.open(filename, bmode, compresslevel=6 if level is None else level)
+    elif ext == '.xz':
+        if bmode == 'wb':
+            f = lzma.open(filename, bmode, preset=6 if level is None else level)
+        else:
+            f = lzma.open(filename, bmode)
+    elif ext == '.zst':
+        assert zstandard is not None, f'The zstandard module is required to read/write {filename}. Install it with "pip install zstandard".'
+        if bmode == 'wb':
+            cctx = zstandard.ZstdCompressor(level=3 if level is None else level, threads=threads)
+            f = cctx.stream_writer(open(filename, 'wb'), closefd=True)
+        else:
+            dctx = zstandard.ZstdDecompressor()
+            f = dctx.stream_reader(open(filename, 'rb'), closefd=True)
+            # stream_reader does not implement readline, which the text line iteration relies on.
+            f = io.BufferedReader(f)
+    else:
+        return open(filename, mode)
+
+    if binary:
+        return f
+    return io.TextIOWrapper(f, encoding='utf-8')
+
+
+def seek_star(f, pos):
+    """Seek a file opened by open_star from the beginning. Non-seekable compressed streams are read forward and discarded.
+
+    Parameters
+    ----------
+    f : file object
+        Binary file object just opened by open_star.
+
+    pos : int
+        Byte offset in the uncompressed contents.
+    """
+
+    if f.seekable():
+        f.seek(pos)
+        return
+    while pos > 0:
+        chunk = f.read(min(pos, 16 * 1024 * 1024))
+        assert len(chunk) > 0, 'Unexpected end of file.'
+        pos -= len(chunk)
+
 
 def imgname_to_imgid(imgname, rm_uid=True, rm_ext=False):
     n, f = imgname.split('@')
@@ -50,284 +165,2485 @@ def blobpath_and_blobidx_to_imgid(blobpath, blobidx, rm_uid=True, rm_ext=True):
     return imgid
 
 
+def normalize_stackname(stackname, rm_uid=True, rm_ext=False):
+    """Normalize a particle stack file name for matching, the same way as imgname_to_imgid.
+
+    Parameters
+    ----------
+    stackname : string
+        Particle stack file path.
+
+    rm_uid : bool, optional
+        Remove the preceding cryoSPARC UID. By default True
+
+    rm_ext : bool, optional
+        Remove the file extension. By default False
+
+    Returns
+    -------
+    string
+        Normalized stack basename.
+    """
+
+    basename = os.path.basename(stackname)
+    if rm_uid:
+        basename = re.sub('^[0-9]+_', '', basename)
+    if rm_ext:
+        basename = os.path.splitext(basename)[0]
+    return basename
+
+
+def split_imgnames(imgnames):
+    """Split _rlnImageName values into particle indices and stack file names.
+
+    Parameters
+    ----------
+    imgnames : array-like
+        _rlnImageName values (e.g. 000001@Extract/job010/movies/mic_0001.mrcs)
+
+    Returns
+    -------
+    idxs : ndarray
+        1-based particle indices in the stacks. dtype=int64
+    stacks : pandas.Categorical
+        Stack file names, dictionary-encoded.
+    """
+
+    parts = pd.Series(imgnames, dtype=object).str.split('@', n=1, expand=True)
+    if len(parts) == 0:
+        return np.zeros(0, dtype=np.int64), pd.Categorical([])
+    idxs = parts[0].astype(np.int64).to_numpy()
+    stacks = pd.Categorical(parts[1])
+    return idxs, stacks
+
+
+def stacks_to_imgids(idxs, stacks, rm_uid=True, rm_ext=False):
+    """Build image ids from 1-based particle indices and stack file names.
+
+    The stack names are normalized once per unique stack, and broadcasted to the particles with the category codes.
+
+    Parameters
+    ----------
+    idxs : array-like
+        1-based particle indices.
+    stacks : pandas.Categorical
+        Stack file names.
+    rm_uid : bool, optional
+        Remove the preceding cryoSPARC UID. By default True
+    rm_ext : bool, optional
+        Remove the file extension. By default False
+
+    Returns
+    -------
+    ndarray
+        Image ids (e.g. 1@mic_0001.mrcs). dtype=object
+    """
+
+    basenames = np.array([normalize_stackname(x, rm_uid=rm_uid, rm_ext=rm_ext) for x in stacks.categories], dtype=object)
+    basenames = pd.Series(basenames[stacks.codes], dtype=object)
+    imgids = pd.Series(idxs, dtype=np.int64).astype(str).astype(object) + '@' + basenames
+    return imgids.to_numpy(dtype=object)
+
+
+def imgnames_to_imgids(imgnames, rm_uid=True, rm_ext=False):
+    """Vectorized imgname_to_imgid.
+
+    Parameters
+    ----------
+    imgnames : array-like
+        _rlnImageName values.
+    rm_uid : bool, optional
+        Remove the preceding cryoSPARC UID. By default True
+    rm_ext : bool, optional
+        Remove the file extension. By default False
+
+    Returns
+    -------
+    ndarray
+        Image ids. dtype=object
+    """
+
+    idxs, stacks = split_imgnames(imgnames)
+    return stacks_to_imgids(idxs, stacks, rm_uid=rm_uid, rm_ext=rm_ext)
+
+
+def split_blobs(cs):
+    """Particle indices and stack file names of cryoSPARC particles, in the same form as split_imgnames."""
+
+    # cs idx is 0-base, so add 1
+    idxs = cs['blob/idx'].astype(np.int64) + 1
+    stacks = pd.Categorical(cs['blob/path'])
+    stacks = stacks.rename_categories([x.decode('UTF-8') for x in stacks.categories])
+    return idxs, stacks
+
+
 def cs_to_imgids(cs, rm_uid=False, rm_ext=False):
-    imgids = []
-    for i in range(len(cs)):
-        # cs idx is 0-base, so add 1
-        n = str(int(cs['blob/idx'][i]) + 1)
-        f = cs['blob/path'][i].decode('UTF-8')
-        imgname = n + '@' + f
-        imgid = imgname_to_imgid(imgname, rm_uid=rm_uid)
-        if rm_ext:
-            imgid = os.splitext(imgid)[0]
-        imgids.append(imgid)
-    return imgids
+    idxs, stacks = split_blobs(cs)
+    return stacks_to_imgids(idxs, stacks, rm_uid=rm_uid, rm_ext=rm_ext)
 
 
 def df_data_to_imgids(df_data, rm_uid=False, rm_ext=False):
-    imgids = []
-    ar = df_data['_rlnImageName'].to_numpy(copy=True)
-    for i in range(len(ar)):
-        imgid = imgname_to_imgid(ar[i], rm_uid=rm_uid)
-        if rm_ext:
-            imgid = os.splitext(imgid)[0]
-        imgids.append(imgid)
-    return imgids
+    return imgnames_to_imgids(df_data['_rlnImageName'], rm_uid=rm_uid, rm_ext=rm_ext)
 
 
-def load_cs(cs_file):
-    return np.load(cs_file)
+class ImageKeyCodebook:
+    """Integer codes of the normalized particle stack basenames, shared by the metadata to be joined.
 
+    An image key packs the stack code and the 1-based particle index into one uint64 (code << 32 | index), so that joins, set operations and sorting run on integer arrays instead of image id strings.
+    Keys are only comparable when built with the same codebook.
+    """
 
-def save_cs(cs_file, cs):
-    np.save(cs_file, cs)
-    # np.save automatically add .npy extension, thus remove it
-    os.rename(cs_file + '.npy', cs_file)
+    def __init__(self):
+        # Normalized stack basenames, indexed by the codes.
+        self.names = []
+        self._codes = {}
 
+    def __len__(self):
+        return len(self.names)
 
-def load_csg(csg_file):
-    with open(csg_file, 'r') as f:
-        csg = yaml.load(f, Loader=yaml.FullLoader)
-    return csg
+    def encode(self, stacks, rm_uid=False, rm_ext=False):
+        """Codes of stack file names. New names are added to the codebook.
 
+        Parameters
+        ----------
+        stacks : pandas.Categorical
+            Stack file names.
+        rm_uid : bool, optional
+            Remove the preceding cryoSPARC UID. By default False
+        rm_ext : bool, optional
+            Remove the file extension. By default False
 
-def save_csg(csg_file, csg):
-    with open(csg_file, 'w') as f:
-        yaml.dump(csg, stream=f)
+        Returns
+        -------
+        ndarray
+            Stack codes. dtype=uint64
+        """
 
+        # Normalize and look up each unique stack once, and broadcast with the category codes.
+        category_codes = np.empty(len(stacks.categories), dtype=np.uint64)
+        for i, stack in enumerate(stacks.categories):
+            name = normalize_stackname(stack, rm_uid=rm_uid, rm_ext=rm_ext)
+            code = self._codes.get(name)
+            if code is None:
+                code = self._codes[name] = len(self.names)
+                self.names.append(name)
+            category_codes[i] = code
+        assert np.all(stacks.codes >= 0), 'Missing stack file names.'
+        return category_codes[stacks.codes]
+
+    def keys(self, idxs, stacks, rm_uid=False, rm_ext=False):
+        """Image keys of particles.
 
-def get_metafiles_from_csg(csg_file):
-    # Assumes the same directory as csg file
-    dirpath = os.path.dirname(csg_file)
+        Parameters
+        ----------
+        idxs : array-like
+            1-based particle indices.
+        stacks : pandas.Categorical
+            Stack file names.
+        rm_uid : bool, optional
+            Remove the preceding cryoSPARC UID. By default False
+        rm_ext : bool, optional
+            Remove the file extension. By default False
 
-    csg = load_csg(csg_file)
+        Returns
+        -------
+        ndarray
+            Image keys. dtype=uint64
+        """
 
-    metafiles = []
-    for key in csg['results'].keys():
-        metafiles.append(csg['results'][key]['metafile'].replace('>', ''))
-    metafiles = np.unique(metafiles)
+        idxs = np.asarray(idxs, dtype=np.int64)
+        assert len(idxs) == 0 or (idxs.min() >= 0 and idxs.max() < 2 ** 32), 'Particle indices out of range.'
+        return (self.encode(stacks, rm_uid=rm_uid, rm_ext=rm_ext) << np.uint64(32)) | idxs.astype(np.uint64)
 
-    cs_file = None
-    passthrough_file = None
-    for metafile in metafiles:
-        if 'passthrough_particles.cs' in metafile:
-            if passthrough_file is not None and passthrough_file != metafile:
-                sys.exit('More than two kinds of passthrough_particles.cs files found.')
-            passthrough_file = os.path.join(dirpath, metafile)
-        elif 'particles.cs' or 'particles_expanded.cs' or 'downsampled_particles.cs' in metafile:
-            if cs_file is not None and cs_file != metafile:
-                sys.exit('More than two kinds of particles.cs files found.')
-            cs_file = os.path.join(dirpath, metafile)
-        else:
-            sys.exit(f'Unknown metafile type: {metafile}')
+    def imgids(self, keys):
+        """Image id strings (e.g. 1@mic_0001.mrcs) of image keys, for messages."""
 
-    assert cs_file is not None
-    # Some times there is no passthrough file.
+        keys = np.asarray(keys, dtype=np.uint64)
+        names = np.array(self.names, dtype=object)[(keys >> np.uint64(32)).astype(np.int64)]
+        idxs = (keys & np.uint64(0xFFFFFFFF)).astype(np.int64)
+        return (pd.Series(idxs).astype(str).astype(object) + '@' + pd.Series(names, dtype=object)).to_numpy(dtype=object)
 
-    return cs_file, passthrough_file
 
+def hash_imgids(imgids):
+    """Vectorized 64-bit hashes of image ids.
 
-def find_cryosparc_files(dir):
-    """Find required cryoSPARC files from a job directory
+    Parameters
+    ----------
+    imgids : array-like
+        Normalized image ids.
+
+    Returns
+    -------
+    ndarray
+        Hashes. dtype=uint64. Image keys (ImageKeyCodebook) are returned as they are.
+    """
+
+    if isinstance(imgids, np.ndarray) and imgids.dtype == np.uint64:
+        return imgids
+    return pd.util.hash_array(np.asarray(imgids, dtype=object), categorize=False)
+
+
+def compare_imgids(imgids_a, imgids_b, num_examples=5, codebook=None):
+    """Compare two image id sequences (e.g. the rows of a .cs file and of the exported star file) with 64-bit hashes.
 
     Parameters
     ----------
-    dir : string
-        Job directory
+    imgids_a, imgids_b : array-like
+        Normalized image ids, or image keys built with codebook.
+
+    num_examples : int, optional
+        Number of divergent rows and missing image ids reported. By default 5
+
+    codebook : ImageKeyCodebook, optional
+        Codebook of image keys, to report the examples as image ids. By default None
 
     Returns
     -------
-    cs_file : string
-        Particle .cs file
+    dict
+        'status' : 'identical' (same ids in the same order), 'permutation' (same ids in a different order), 'subset' (a is a proper subset of b), 'superset' (b is a proper subset of a) or 'different'.
+        'num_a', 'num_b' : number of ids.
+        'num_duplicated_a', 'num_duplicated_b' : number of duplicated ids.
+        'num_only_a', 'num_only_b' : number of unique ids found only in a or only in b.
+        'mismatches' : list of (row, id_a, id_b) of the first divergent rows.
+        'only_a', 'only_b' : examples of the ids found only in a or only in b.
+    """
 
-    csg_file : string
-        Particle group .csg file
+    if codebook is None:
+        imgids_a = np.asarray(imgids_a, dtype=object)
+        imgids_b = np.asarray(imgids_b, dtype=object)
+    hashes_a = hash_imgids(imgids_a)
+    hashes_b = hash_imgids(imgids_b)
+    uniq_a = np.unique(hashes_a)
+    uniq_b = np.unique(hashes_b)
+    in_b = np.isin(hashes_a, uniq_b)
+    in_a = np.isin(hashes_b, uniq_a)
+
+    n = min(len(hashes_a), len(hashes_b))
+    mismatch_rows = np.flatnonzero(hashes_a[:n] != hashes_b[:n])[:num_examples]
+    if len(mismatch_rows) < num_examples and len(hashes_a) != len(hashes_b):
+        mismatch_rows = np.concatenate((mismatch_rows, [n]))[:num_examples]
+
+    report = {
+        'num_a': len(imgids_a),
+        'num_b': len(imgids_b),
+        'num_duplicated_a': len(hashes_a) - len(uniq_a),
+        'num_duplicated_b': len(hashes_b) - len(uniq_b),
+        'num_only_a': len(np.unique(hashes_a[~in_b])),
+        'num_only_b': len(np.unique(hashes_b[~in_a])),
+        'mismatches': [
+            (int(i), imgids_a[i] if i < len(imgids_a) else None, imgids_b[i] if i < len(imgids_b) else None) for i in mismatch_rows
+        ],
+        'only_a': list(pd.unique(imgids_a[~in_b])[:num_examples]),
+        'only_b': list(pd.unique(imgids_b[~in_a])[:num_examples]),
+    }
+    if codebook is not None:
+        # Decode the examples only.
+        decode = lambda x: None if x is None else codebook.imgids([x])[0]
+        report['mismatches'] = [(row, decode(id_a), decode(id_b)) for row, id_a, id_b in report['mismatches']]
+        report['only_a'] = list(codebook.imgids(report['only_a']))
+        report['only_b'] = list(codebook.imgids(report['only_b']))
+
+    if len(hashes_a) == len(hashes_b) and len(mismatch_rows) == 0:
+        report['status'] = 'identical'
+    elif len(hashes_a) == len(hashes_b) and np.array_equal(np.sort(hashes_a), np.sort(hashes_b)):
+        report['status'] = 'permutation'
+    elif report['num_only_a'] == 0 and report['num_only_b'] == 0:
+        # Same ids with different multiplicities
+        report['status'] = 'different'
+    elif report['num_only_a'] == 0:
+        report['status'] = 'subset'
+    elif report['num_only_b'] == 0:
+        report['status'] = 'superset'
+    else:
+        report['status'] = 'different'
+    return report
 
-    passthrough_file : string
-        Particle passthrough .cs file
+
+def format_imgid_comparison(report, name_a='a', name_b='b'):
+    """Human readable summary of compare_imgids report.
+
+    Parameters
+    ----------
+    report : dict
+        Output of compare_imgids.
+
+    name_a, name_b : string, optional
+        Names of the compared files.
+
+    Returns
+    -------
+    string
+        Summary text.
     """
 
-    assert os.path.isdir(dir), f'{dir} is not a directory.'
+    lines = [
+        f'Comparison of {name_a} and {name_b}: {report["status"]}',
+        f'\tNumber of particles: {report["num_a"]} ({name_a}), {report["num_b"]} ({name_b})',
+    ]
+    if report['num_duplicated_a'] > 0 or report['num_duplicated_b'] > 0:
+        lines.append(f'\tDuplicated particles: {report["num_duplicated_a"]} ({name_a}), {report["num_duplicated_b"]} ({name_b})')
+    if report['status'] != 'identical':
+        lines.append('\tFirst divergent rows (row, {}, {}):'.format(name_a, name_b))
+        for row, id_a, id_b in report['mismatches']:
+            lines.append(f'\t\t{row} {id_a} {id_b}')
+    if report['num_only_a'] > 0:
+        lines.append(f'\tParticles only in {name_a}: {report["num_only_a"]}, e.g. {" ".join(report["only_a"])}')
+    if report['num_only_b'] > 0:
+        lines.append(f'\tParticles only in {name_b}: {report["num_only_b"]}, e.g. {" ".join(report["only_b"])}')
+    return '\n'.join(lines)
+
+
+def preflight_imgids(imgids_a, imgids_b, name_a='a', name_b='b', require='identical', allow_duplicated_a=False, codebook=None):
+    """Check the consistency of two image id sequences before a transfer, and exit with a report on failure.
 
-    cs_list = sorted(glob.glob(os.path.join(dir, 'cryosparc*_particles.cs')))
-    assert len(cs_list) > 0, f'Particle cs file not found in {dir}'
-    # The last cs file found in the directory.
-    cs_file = cs_list[-1]
+    Parameters
+    ----------
+    imgids_a, imgids_b : array-like
+        Normalized image ids.
 
-    csg_list = sorted(glob.glob(os.path.join(dir, '*_particles.csg')))
-    assert len(csg_list) > 0, f'cs group file (*_particles.csg) was not found in {dir}'
-    assert len(csg_list) == 1, f'*_particles.csg matched more than 1 file: {csg_list}'
-    csg_file = csg_list[0]
+    name_a, name_b : string, optional
+        Names of the compared files, for the report.
 
-    passthrough_list = sorted(glob.glob(os.path.join(dir, '*_passthrough_particles.cs')))
-    assert len(passthrough_list) > 0, f'Particle passthrough file was not found in {dir}'
-    assert len(passthrough_list) == 1, f'*_passthrough_particles.cs matched more than 1 file: {passthrough_list}'
-    passthrough_file = passthrough_list[0]
+    require : string, optional
+        'identical' (same ids in the same order), 'same_set' (same ids in any order) or 'subset' (every id of a is in b). With 'identical', a row-by-row identical pair passes even with duplicated ids (e.g. symmetry-expanded particles), as the rows correspond one to one.
+        With 'same_set' and 'subset', the ids of b are looked up, so duplicated ids of b always fail the check, and duplicated ids of a fail unless allow_duplicated_a. By default 'identical'
 
-    return cs_file, csg_file, passthrough_file
+    allow_duplicated_a : bool, optional
+        Accept duplicated ids in a (e.g. symmetry-expanded particles) for 'subset'. By default False
 
+    codebook : ImageKeyCodebook, optional
+        Codebook of image keys, if imgids_a and imgids_b are image keys. By default None
+
+    Returns
+    -------
+    dict
+        compare_imgids report.
+    """
+
+    assert require in ('identical', 'same_set', 'subset'), f'Unknown requirement: {require}'
+    report = compare_imgids(imgids_a, imgids_b, codebook=codebook)
+    if require == 'identical':
+        ok = report['status'] == 'identical'
+    elif require == 'same_set':
+        ok = report['status'] in ('identical', 'permutation')
+    else:
+        ok = report['num_only_a'] == 0
+    if report['status'] != 'identical' or require != 'identical':
+        ok = ok and report['num_duplicated_b'] == 0
+        ok = ok and (report['num_duplicated_a'] == 0 or (allow_duplicated_a and require == 'subset'))
+    if not ok:
+        sys.exit(f'Consistency check ({require}) failed.\n' + format_imgid_comparison(report, name_a, name_b))
+    return report
 
-def load_latent_variables(infile, num_components=-1):
-    """Loat latent variables from cryoSPARC 3D variability job result.
+
+def neighbor_pairs(groups, x, y, radius):
+    """Find the pairs of points closer than radius in the same group, with a spatial hash grid.
 
     Parameters
     ----------
-    infile : string
-        A particle .cs file containing the latent variables (variability components). Typically like 'cryosparc_<project id>_<job id>_particles.cs'
+    groups : ndarray
+        Integer group (e.g. micrograph) codes of the points.
+    x, y : ndarray
+        Coordinates of the points.
+    radius : float
+        Distance threshold.
 
-    num_components : int, optional
-        Number of components to use. By default (-1) use all the components.
+    Returns
+    -------
+    i, j : ndarray
+        Indices of the pairs, both (i, j) and (j, i) for each pair.
+    """
+
+    # Cells of size radius. The neighbors are in the same or the 8 adjacent cells.
+    n = len(x)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    cx = np.floor((x - x.min()) / radius).astype(np.int64) + 1
+    cy = np.floor((y - y.min()) / radius).astype(np.int64) + 1
+    nx = int(cx.max()) + 2
+    ny = int(cy.max()) + 2
+    keys = (groups.astype(np.int64) * ny + cy) * nx + cx
+
+    # Work on the points sorted by cell, so that each cell is a contiguous range.
+    order = np.argsort(keys, kind='stable')
+    xs, ys = x[order], y[order]
+    cells, cell_starts, cell_counts = np.unique(keys[order], return_index=True, return_counts=True)
+    point_cells = np.repeat(np.arange(len(cells)), cell_counts)
+
+    pairs_i = []
+    pairs_j = []
+    # Half of the adjacent cells, each pair of cells is visited once.
+    for dx, dy in ((0, 0), (1, 0), (-1, 1), (0, 1), (1, 1)):
+        if dx == 0 and dy == 0:
+            # Pairs within the same cell: the points after each point.
+            starts = np.arange(1, n + 1)
+            counts = (cell_starts + cell_counts)[point_cells] - starts
+        else:
+            targets = cells + dy * nx + dx
+            pos = np.minimum(np.searchsorted(cells, targets), len(cells) - 1)
+            found = cells[pos] == targets
+            starts = np.where(found, cell_starts[pos], 0)[point_cells]
+            counts = np.where(found, cell_counts[pos], 0)[point_cells]
+        i = np.repeat(np.arange(n), counts)
+        # Positions within the neighbor cell ranges.
+        j = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        close = (xs[i] - xs[j]) ** 2 + (ys[i] - ys[j]) ** 2 < radius ** 2
+        pairs_i.append(order[i[close]])
+        pairs_j.append(order[j[close]])
+    pairs_i = np.concatenate(pairs_i)
+    pairs_j = np.concatenate(pairs_j)
+    return np.concatenate([pairs_i, pairs_j]), np.concatenate([pairs_j, pairs_i])
+
+
+def greedy_nms(n, pairs_i, pairs_j, priority):
+    """Greedy non-maximum suppression: keep the points in priority order, and drop the neighbors of the kept points.
+
+    The points are decided in rounds: a point whose priority is higher than all of its undecided neighbors is kept, and its neighbors are dropped.
+    This gives the same result as the sequential greedy algorithm, in as many rounds as the longest chain of overlapping points.
+
+    Parameters
+    ----------
+    n : int
+        Number of points.
+    pairs_i, pairs_j : ndarray
+        Neighbor pairs (both directions), e.g. from neighbor_pairs.
+    priority : ndarray
+        Unique ranks of the points. Lower is kept first.
 
     Returns
     -------
     ndarray
-        Array containing the latent variables. shape=(num_samples, num_variables)
+        Boolean mask of the kept points.
     """
 
-    assert os.path.exists(infile)
-    cs = np.load(infile)
-    Z = []
-    components_mode = 0
+    undecided = np.ones(n, dtype=bool)
+    keep = np.zeros(n, dtype=bool)
     while True:
-        if f'components_mode_{components_mode}/value' in cs.dtype.names:
-            Z.append(cs[f'components_mode_{components_mode}/value'])
-            components_mode += 1
-        else:
-            break
-    assert num_components <= components_mode
-    Z = np.vstack(Z).T
-    Z = Z[:, :num_components]
-    return Z
+        active = undecided[pairs_i] & undecided[pairs_j]
+        pairs_i, pairs_j = pairs_i[active], pairs_j[active]
+        min_neighbor = np.full(n, np.iinfo(np.int64).max)
+        np.minimum.at(min_neighbor, pairs_i, priority[pairs_j])
+        kept_now = undecided & (priority < min_neighbor)
+        keep |= kept_now
+        undecided &= ~kept_now
+        undecided[pairs_j[kept_now[pairs_i]]] = False
+        if not undecided.any():
+            return keep
 
 
-class CryoSPARCMetaData:
-    """cryoSPARC metadata handling class.
+def _nms_groups(groups, x, y, radius, priority):
+    # Module level function, to be run in worker processes.
+    pairs_i, pairs_j = neighbor_pairs(groups, x, y, radius)
+    return greedy_nms(len(x), pairs_i, pairs_j, priority)
+
+
+def euler_to_matrices(rot, tilt, psi):
+    """Rotation matrices of RELION Euler angles (ZYZ convention, as Euler_angles2matrix of RELION).
 
     Parameters
     ----------
-    cs : ndarray
-        Array containing cryoSPARC particles .cs file contents (loaded by np.load)
+    rot, tilt, psi : array-like
+        _rlnAngleRot, _rlnAngleTilt and _rlnAnglePsi in degrees.
 
-    csg_template : dict
-        Dictionary containing cryoSPARC particles .csg file contents (loaded by yaml.load)
+    Returns
+    -------
+    ndarray
+        Rotation matrices. shape=(n, 3, 3)
+    """
 
-    passthrough : ndarray
-        Array containing cryoSPARC passthrough_particles .cs file contents (loaded by np.load)
+    a, b, g = (np.deg2rad(np.asarray(x, dtype=np.float64)) for x in (rot, tilt, psi))
+    ca, sa, cb, sb, cg, sg = np.cos(a), np.sin(a), np.cos(b), np.sin(b), np.cos(g), np.sin(g)
+    cc, cs, sc, ss = cb * ca, cb * sa, sb * ca, sb * sa
+    mats = np.empty(a.shape + (3, 3), dtype=np.float64)
+    mats[..., 0, 0] = cg * cc - sg * sa
+    mats[..., 0, 1] = cg * cs + sg * ca
+    mats[..., 0, 2] = -cg * sb
+    mats[..., 1, 0] = -sg * cc - cg * sa
+    mats[..., 1, 1] = -sg * cs + cg * ca
+    mats[..., 1, 2] = sg * sb
+    mats[..., 2, 0] = sc
+    mats[..., 2, 1] = ss
+    mats[..., 2, 2] = cb
+    return mats
+
+
+def _axis_rotation(axis, fold):
+    """Rotation matrix of 360/fold degrees around an axis."""
+
+    axis = np.asarray(axis, dtype=np.float64)
+    x, y, z = axis / np.linalg.norm(axis)
+    t = 2 * np.pi / fold
+    c, s = np.cos(t), np.sin(t)
+    k = np.array([[0, -z, y], [z, 0, -x], [-y, x, 0]])
+    return c * np.eye(3) + s * k + (1 - c) * np.outer((x, y, z), (x, y, z))
+
+
+# Symmetry axes (fold, axis) of the point groups, in the orientations of RELION.
+_SYMMETRY_AXES = {
+    'T': ((3, (0, 0, 1)), (2, (0, 0.816496, 0.577350))),
+    'O': ((3, (0.5773502, 0.5773502, 0.5773502)), (4, (0, 0, 1))),
+    'I': ((2, (0, 0, 1)), (5, (0.525731114, 0, 0.850650807)), (3, (0, 0.356822076, 0.934172364))),
+}
+_SYMMETRY_ORDERS = {'T': 12, 'O': 24, 'I': 60}
+
+
+def symmetry_matrices(symmetry):
+    """Rotation matrices of a point group symmetry.
+
+    Parameters
+    ----------
+    symmetry : string
+        Cn, Dn, T, O or I (I2 orientation of RELION), e.g. C1, C4, D7.
+
+    Returns
+    -------
+    ndarray
+        Rotation matrices of the group, the identity first. shape=(order, 3, 3)
     """
 
-    def __init__(self, csg, cs, passthrough=None):
-        self.cs = cs
-        self.csg = csg
-        self.passthrough = passthrough
+    symmetry = symmetry.upper()
+    if symmetry in _SYMMETRY_AXES:
+        generators = [_axis_rotation(axis, fold) for fold, axis in _SYMMETRY_AXES[symmetry]]
+        order = _SYMMETRY_ORDERS[symmetry]
+    else:
+        m = re.fullmatch('([CD])([0-9]+)', symmetry)
+        assert m is not None and int(m.group(2)) > 0, f'Unsupported symmetry: {symmetry}'
+        n = int(m.group(2))
+        generators = [_axis_rotation((0, 0, 1), n)]
+        order = n
+        if m.group(1) == 'D':
+            generators.append(_axis_rotation((1, 0, 0), 2))
+            order = 2 * n
+
+    # Closure of the generators.
+    mats = [np.eye(3)]
+    new = [np.eye(3)]
+    while len(new) > 0:
+        products = [x @ g for x in new for g in generators]
+        new = []
+        for p in products:
+            if not any(np.allclose(p, x, atol=1e-4) for x in mats):
+                mats.append(p)
+                new.append(p)
+        assert len(mats) <= order, f'Invalid symmetry axes of {symmetry}.'
+    assert len(mats) == order, f'Invalid symmetry axes of {symmetry}.'
+    return np.array(mats)
+
+
+def angular_distances(mats_a, mats_b, symmetry='C1', chunk_size=1000000):
+    """Angular distances between orientations, the smallest over the symmetry-equivalent orientations.
+
+    The angle of the relative rotation A^T B R is computed from its trace for all the symmetry operators R at once.
 
-        if self.passthrough is not None:
-            assert self.cs.shape[0] == self.passthrough.shape[0]
+    Parameters
+    ----------
+    mats_a, mats_b : ndarray
+        Rotation matrices (e.g. from euler_to_matrices). shape=(n, 3, 3)
+    symmetry : string, optional
+        Point group symmetry (see symmetry_matrices). By default 'C1'
+    chunk_size : int, optional
+        Number of orientations processed at once, which bounds the memory. By default 1000000
 
-    @classmethod
-    def load(cls, csg_file):
-        """Load cryoSPARC metadata from .csg file.
+    Returns
+    -------
+    ndarray
+        Angular distances in degrees. shape=(n,)
+    """
+
+    assert mats_a.shape == mats_b.shape, 'mats_a and mats_b must have the same shape.'
+    sym_mats = symmetry_matrices(symmetry)
+    dists = np.empty(len(mats_a), dtype=np.float64)
+    for start in range(0, len(mats_a), chunk_size):
+        end = start + chunk_size
+        rel = np.einsum('nki,nkj->nij', mats_a[start:end], mats_b[start:end])
+        # trace(rel @ R) = sum_ij rel_ij R_ji
+        traces = np.einsum('nij,gji->ng', rel, sym_mats).max(axis=1)
+        dists[start:end] = np.rad2deg(np.arccos(np.clip((traces - 1) / 2, -1, 1)))
+    return dists
+
+
+AGGREGATION_RULES = ('any', 'all', 'majority', 'min_count')
+
+
+def aggregate_by_source(src_uids, selected, rule='any', min_count=1):
+    """Reduce symmetry-expanded particles to their source particles, deciding each source particle from the selection of its copies.
+
+    The copies are grouped with np.unique, and the selected copies are counted per source particle with np.bincount.
+
+    Parameters
+    ----------
+    src_uids : ndarray
+        Source particle uids of the expanded particles (sym_expand/src_uid).
+    selected : ndarray
+        Boolean mask of the selected expanded particles (e.g. in the chosen classes).
+    rule : string, optional
+        Aggregation rule, one of AGGREGATION_RULES. A source particle is kept if 'any' of its copies, 'all' of them, more than half of them ('majority') or at least min_count of them ('min_count') are selected. By default 'any'
+    min_count : int, optional
+        Number of selected copies required by the 'min_count' rule. By default 1
+
+    Returns
+    -------
+    uids : ndarray
+        Unique source uids, sorted.
+    keep : ndarray
+        Boolean mask of the kept source particles.
+    num_selected : ndarray
+        Number of selected copies of each source particle.
+    num_copies : ndarray
+        Number of copies of each source particle.
+    """
+
+    assert rule in AGGREGATION_RULES, f'Unknown aggregation rule: {rule}'
+    selected = np.asarray(selected, dtype=bool)
+    assert len(selected) == len(src_uids), 'src_uids and selected must have the same length.'
+    uids, inverse = np.unique(src_uids, return_inverse=True)
+    inverse = inverse.ravel()
+    num_copies = np.bincount(inverse, minlength=len(uids))
+    num_selected = np.bincount(inverse[selected], minlength=len(uids))
+    if rule == 'any':
+        keep = num_selected > 0
+    elif rule == 'all':
+        keep = num_selected == num_copies
+    elif rule == 'majority':
+        keep = 2 * num_selected > num_copies
+    else:
+        keep = num_selected >= min_count
+    return uids, keep, num_selected, num_copies
+
+
+def split_half_sets(group_codes, seed=0):
+    """Random half sets (_rlnRandomSubset) keeping the particles of each group (e.g. micrograph) in the same half.
+
+    The groups are shuffled with a seeded permutation, and split where the cumulative number of particles crosses the half, so that the sizes of the halves differ by at most the largest group size.
+
+    Parameters
+    ----------
+    group_codes : ndarray
+        Group codes of the particles, from 0 to the number of groups - 1. Missing groups (e.g. -1 of pandas.factorize) are not allowed.
+    seed : int, optional
+        Seed of the permutation. By default 0
+
+    Returns
+    -------
+    ndarray
+        Half sets (1 or 2) of the particles. dtype=int64
+    """
+
+    group_codes = np.asarray(group_codes, dtype=np.int64)
+    if len(group_codes) == 0:
+        return np.zeros(0, dtype=np.int64)
+    assert group_codes.min() >= 0, f'{np.count_nonzero(group_codes < 0)} particles have no group.'
+    sizes = np.bincount(group_codes)
+    order = np.random.default_rng(seed).permutation(len(sizes))
+    ends = np.cumsum(sizes[order])
+    # A group goes to the first half if its middle comes before the middle of all the particles.
+    halves = np.empty(len(sizes), dtype=np.int64)
+    halves[order] = np.where(2 * ends - sizes[order] < ends[-1], 1, 2)
+    return halves[group_codes]
+
+
+def remap_categories(values, func):
+    """Apply a function to the unique values of a categorical column only, and broadcast the results with the codes.
+
+    Parameters
+    ----------
+    values : pandas.Series
+        Categorical (or any) column.
+    func : callable or dict
+        Function (or mapping) from an old value to a new value. Different old values may map to the same new value.
+
+    Returns
+    -------
+    pandas.Series
+        Categorical column with the new values.
+    """
+
+    if not isinstance(values.dtype, pd.CategoricalDtype):
+        values = values.astype('category')
+    if isinstance(func, dict):
+        mapping = func
+        func = lambda x: mapping.get(x, x)
+    new_categories = [func(x) for x in values.cat.categories]
+    # New values may collide, so re-encode them.
+    uniq, inverse = np.unique(np.array(new_categories, dtype=object).astype(str), return_inverse=True)
+    codes = values.cat.codes.to_numpy()
+    new_codes = np.where(codes >= 0, inverse[codes], -1)
+    cat = pd.Categorical.from_codes(new_codes, categories=uniq)
+    return pd.Series(cat, index=values.index, name=values.name)
+
+
+class PathRelocator:
+    """Rewrite file paths (e.g. after moving a project) with prefix or regular expression rules.
+
+    The rules are compiled into one anchored regular expression, so that each path is matched once whatever the number of rules, and the first matching rule wins.
+    Each unique path is rewritten only once, and the results are broadcasted to the rows.
+
+    Parameters
+    ----------
+    rules : list of tuples
+        (kind, pattern, replacement). kind is 'prefix' or 'regex'.
+        A prefix rule replaces the leading pattern of a path with replacement.
+        A regex rule is matched at the beginning of a path (re.match), and the matched part is replaced with the expanded replacement (e.g. \\1).
+    rm_uid : bool, optional
+        Remove the preceding cryoSPARC UID of the file names after the rules. By default False
+    """
+
+    def __init__(self, rules, rm_uid=False):
+        self.rules = list(rules)
+        self.rm_uid = rm_uid
+        for kind, _, _ in self.rules:
+            assert kind in ('prefix', 'regex'), f'Unknown rule kind: {kind}'
+        self._patterns = [re.compile(pattern if kind == 'regex' else re.escape(pattern)) for kind, pattern, _ in self.rules]
+        try:
+            self._combined = re.compile('|'.join(f'(?P<_rule{i}>{x.pattern})' for i, x in enumerate(self._patterns)))
+        except re.error:
+            # e.g. the same group name in two regex rules. Try the rules one by one instead.
+            self._combined = None
+        self._cache = {}
+        # Number of unique paths rewritten by each rule, and the unique paths matching no rule.
+        self.num_matched = [0] * len(self.rules)
+        self.unmatched = []
+
+    @classmethod
+    def load(cls, rules_file, rm_uid=False):
+        """Load the rules from a text file.
+
+        Parameters
+        ----------
+        rules_file : string
+            One rule per line. Syntax: <prefix|regex> <pattern> <replacement>. Empty lines and lines starting with # are ignored.
+        rm_uid : bool, optional
+            Remove the preceding cryoSPARC UID of the file names after the rules. By default False
+
+        Returns
+        -------
+        PathRelocator
+            PathRelocator class instance.
+        """
+
+        rules = []
+        for line in open(rules_file):
+            words = line.split()
+            if len(words) == 0 or words[0].startswith('#'):
+                continue
+            assert len(words) == 3, f'Invalid rule: {line.strip()}'
+            rules.append(tuple(words))
+        return cls(rules, rm_uid=rm_uid)
+
+    def _match_rule(self, path):
+        if self._combined is not None:
+            m = self._combined.match(path)
+            return None if m is None else int(m.lastgroup[len('_rule'):])
+        for i, pattern in enumerate(self._patterns):
+            if pattern.match(path) is not None:
+                return i
+        return None
+
+    def relocate(self, path):
+        """Rewrite a path.
+
+        Parameters
+        ----------
+        path : string
+            File path.
+
+        Returns
+        -------
+        string
+            Rewritten path. The path is kept as it is when no rule matches.
+        """
+
+        new_path = self._cache.get(path)
+        if new_path is not None:
+            return new_path
+
+        new_path = path
+        i = self._match_rule(path)
+        if i is None:
+            self.unmatched.append(path)
+        else:
+            kind, _, replacement = self.rules[i]
+            m = self._patterns[i].match(path)
+            new_path = (m.expand(replacement) if kind == 'regex' else replacement) + path[m.end():]
+            self.num_matched[i] += 1
+        if self.rm_uid:
+            new_path = os.path.join(os.path.dirname(new_path), normalize_stackname(new_path))
+        self._cache[path] = new_path
+        return new_path
+
+    def relocate_values(self, values):
+        """Rewrite a column of paths.
+
+        Parameters
+        ----------
+        values : pandas.Series
+            File paths. Categorical columns stay categorical.
+
+        Returns
+        -------
+        pandas.Series
+            Rewritten paths.
+        """
+
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            return remap_categories(values, self.relocate)
+        codes, uniques = pd.factorize(values)
+        new_uniques = np.array([self.relocate(x) for x in uniques], dtype=object)
+        return pd.Series(new_uniques[codes], index=values.index, name=values.name)
+
+    def relocate_imgnames(self, imgnames):
+        """Rewrite the stack file paths of _rlnImageName values, keeping the particle indices as they are.
+
+        Parameters
+        ----------
+        imgnames : pandas.Series
+            _rlnImageName values (e.g. 000001@Extract/job010/movies/mic_0001.mrcs)
+
+        Returns
+        -------
+        pandas.Series
+            Rewritten _rlnImageName values.
+        """
+
+        if len(imgnames) == 0:
+            return imgnames
+        parts = imgnames.astype(str).str.split('@', n=1, expand=True)
+        assert parts.shape[1] == 2 and not parts[1].isna().any(), 'Invalid _rlnImageName values.'
+        return (parts[0] + '@' + self.relocate_values(parts[1])).rename(imgnames.name)
+
+
+def stat_files(paths, num_workers=32):
+    """Stat files concurrently, which hides the latency of network file systems.
+
+    Parameters
+    ----------
+    paths : list of strings
+        File paths.
+
+    num_workers : int, optional
+        Number of threads. By default 32
+
+    Returns
+    -------
+    dict
+        os.stat_result of each path, or None if the file does not exist.
+    """
+
+    def stat(path):
+        try:
+            return os.stat(path)
+        except OSError:
+            return None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+        return dict(zip(paths, executor.map(stat, paths)))
+
+
+# Bytes per voxel of the MRC modes
+MRC_MODE_BYTES = {0: 1, 1: 2, 2: 4, 3: 4, 4: 8, 6: 2, 12: 2, 101: 0.5}
+
+
+def read_mrc_header(path):
+    """Read the main fields of an MRC file header.
+
+    Parameters
+    ----------
+    path : string
+        MRC file (.mrc or .mrcs).
+
+    Returns
+    -------
+    dict
+        'nx', 'ny', 'nz' : dimensions (nz is the number of images of a .mrcs stack), 'mode' : data type, 'data_offset' : offset of the data in bytes, 'data_size' : expected size of the data in bytes (None for unknown modes).
+    """
+
+    with open(path, 'rb') as f:
+        header = f.read(1024)
+    assert len(header) == 1024, f'{path} is too small for an MRC file.'
+    # Little endian unless the machine stamp says otherwise.
+    endian = '>' if header[212] == 0x11 else '<'
+    nx, ny, nz, mode = struct.unpack(endian + '4i', header[:16])
+    nsymbt = struct.unpack(endian + 'i', header[92:96])[0]
+    mode_bytes = MRC_MODE_BYTES.get(mode)
+    return {
+        'nx': nx,
+        'ny': ny,
+        'nz': nz,
+        'mode': mode,
+        'data_offset': 1024 + nsymbt,
+        'data_size': int(nx * ny * nz * mode_bytes) if mode_bytes else None,
+    }
+
+
+def load_cs(cs_file, mmap=False):
+    # Memory-mapped arrays are read from the disk on access, for .cs files larger than RAM.
+    return np.load(cs_file, mmap_mode='r' if mmap else None)
+
+
+def save_cs(cs_file, cs):
+    # Field selections of memory-mapped arrays are views with the unselected fields as padding, which cryoSPARC does not expect.
+    np.save(cs_file, rfn.repack_fields(cs))
+    # np.save automatically add .npy extension, thus remove it
+    os.rename(cs_file + '.npy', cs_file)
+
+
+# Parsed .csg files, keyed by the absolute path. Entries are reparsed when the file size or mtime changes.
+_csg_cache = {}
+
+
+def load_csg(csg_file):
+    stat = os.stat(csg_file)
+    key = os.path.abspath(csg_file)
+    cached = _csg_cache.get(key)
+    if cached is None or cached[0] != (stat.st_mtime_ns, stat.st_size):
+        with open(csg_file, 'r') as f:
+            csg = yaml.load(f, Loader=yaml.FullLoader)
+        cached = ((stat.st_mtime_ns, stat.st_size), csg)
+        _csg_cache[key] = cached
+    # The callers may modify the csg (e.g. CryoSPARCMetaData._update_csg).
+    return copy.deepcopy(cached[1])
+
+
+def save_csg(csg_file, csg):
+    with open(csg_file, 'w') as f:
+        yaml.dump(csg, stream=f)
+
+
+def is_parquet(filename):
+    return filename.endswith(('.parquet', '.pq'))
+
+
+def _check_pyarrow(filename):
+    assert pa is not None, f'The pyarrow module is required to read/write {filename}. Install it with "pip install pyarrow".'
+
+
+def _parquet_c2r_metadata(schema, kind, filename):
+    # c2r specific metadata (optics table, csg, etc.) is stored as JSON in the Arrow schema metadata.
+    metadata = schema.metadata or {}
+    assert b'c2r' in metadata, f'{filename} was not written by c2r.'
+    metadata = json.loads(metadata[b'c2r'])
+    assert metadata['kind'] == kind, f'{filename} contains {metadata["kind"]} metadata, not {kind}.'
+    return metadata
+
+
+def _write_parquet(outfile, table, metadata):
+    schema_metadata = dict(table.schema.metadata or {})
+    schema_metadata[b'c2r'] = json.dumps(metadata).encode()
+    pq.write_table(table.replace_schema_metadata(schema_metadata), outfile, compression='zstd')
+
+
+def classify_metafile(filename):
+    """Classify a cryoSPARC file by name.
+
+    Parameters
+    ----------
+    filename : string
+        File name.
+
+    Returns
+    -------
+    string or None
+        'passthrough' for passthrough particles .cs files, 'particles' for particles .cs files (including expanded and downsampled particles), 'csg' for particles .csg files, None otherwise.
+    """
+
+    if filename.endswith('passthrough_particles.cs'):
+        return 'passthrough'
+    if filename.endswith(('particles.cs', 'particles_expanded.cs')):
+        return 'particles'
+    if filename.endswith('particles.csg'):
+        return 'csg'
+    return None
+
+
+def get_metafiles_from_csg(csg_file):
+    # Assumes the same directory as csg file
+    dirpath = os.path.dirname(csg_file)
+
+    csg = load_csg(csg_file)
+
+    metafiles = []
+    for key in csg['results'].keys():
+        metafiles.append(csg['results'][key]['metafile'].replace('>', ''))
+    metafiles = np.unique(metafiles)
+
+    cs_file = None
+    passthrough_file = None
+    for metafile in metafiles:
+        kind = classify_metafile(metafile)
+        if kind == 'passthrough':
+            if passthrough_file is not None and passthrough_file != metafile:
+                sys.exit('More than two kinds of passthrough_particles.cs files found.')
+            passthrough_file = os.path.join(dirpath, metafile)
+        elif kind == 'particles':
+            if cs_file is not None and cs_file != metafile:
+                sys.exit('More than two kinds of particles.cs files found.')
+            cs_file = os.path.join(dirpath, metafile)
+        else:
+            sys.exit(f'Unknown metafile type: {metafile}')
+
+    assert cs_file is not None
+    # Some times there is no passthrough file.
+
+    return cs_file, passthrough_file
+
+
+def find_cryosparc_files(dir):
+    """Find required cryoSPARC files from a job directory
+
+    Parameters
+    ----------
+    dir : string
+        Job directory
+
+    Returns
+    -------
+    cs_file : string
+        Particle .cs file
+
+    csg_file : string
+        Particle group .csg file
+
+    passthrough_file : string
+        Particle passthrough .cs file
+    """
+
+    assert os.path.isdir(dir), f'{dir} is not a directory.'
+
+    # The files were listed and classified by the project index.
+    project_dir, job = os.path.split(os.path.normpath(dir))
+    files = CryoSPARCProjectIndex.load(project_dir or '.', jobs=[job]).jobs[job]['files']
+    filenames = sorted(files)
+    kinds = [files[x]['kind'] for x in filenames]
+
+    cs_list = [os.path.join(dir, x) for x, kind in zip(filenames, kinds) if kind == 'particles' and x.startswith('cryosparc') and x.endswith('_particles.cs')]
+    assert len(cs_list) > 0, f'Particle cs file not found in {dir}'
+    # The last cs file found in the directory.
+    cs_file = cs_list[-1]
+
+    csg_list = [os.path.join(dir, x) for x, kind in zip(filenames, kinds) if kind == 'csg' and x.endswith('_particles.csg')]
+    assert len(csg_list) > 0, f'cs group file (*_particles.csg) was not found in {dir}'
+    assert len(csg_list) == 1, f'*_particles.csg matched more than 1 file: {csg_list}'
+    csg_file = csg_list[0]
+
+    passthrough_list = [os.path.join(dir, x) for x, kind in zip(filenames, kinds) if kind == 'passthrough' and x.endswith('_passthrough_particles.cs')]
+    assert len(passthrough_list) > 0, f'Particle passthrough file was not found in {dir}'
+    assert len(passthrough_list) == 1, f'*_passthrough_particles.cs matched more than 1 file: {passthrough_list}'
+    passthrough_file = passthrough_list[0]
+
+    return cs_file, csg_file, passthrough_file
+
+
+class CryoSPARCProjectIndex:
+    """Index of the particle files in the job directories of a cryoSPARC project.
+
+    The job directories are listed in parallel, and a job directory is rescanned (.cs headers and .csg files read) only when its particle files were added, removed, or changed in size or mtime.
+    The index is cached in a per-user cache directory (C2R_INDEX_DIR environment variable, or ~/.cache/c2r), so that the project directory managed by cryoSPARC is not modified.
+
+    Parameters
+    ----------
+    project_dir : string
+        cryoSPARC project directory (e.g. /path/to/P1).
+
+    jobs : dict
+        Job entries keyed by the job directory name (e.g. 'J20'). See _scan_job.
+
+    index_path : string, optional
+        Cached index file. By default index_file(project_dir)
+    """
+
+    def __init__(self, project_dir, jobs, index_path=None):
+        self.project_dir = project_dir
+        self.jobs = jobs
+        self.index_path = index_path or self.index_file(project_dir)
+
+    @staticmethod
+    def index_file(project_dir):
+        """Default cached index file of a project, in C2R_INDEX_DIR or ~/.cache/c2r (under XDG_CACHE_HOME if set), named after the absolute project path."""
+
+        index_dir = os.environ.get('C2R_INDEX_DIR') or os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'c2r')
+        name = re.sub(r'[^A-Za-z0-9_.-]+', '_', os.path.abspath(project_dir).strip(os.sep))
+        return os.path.join(index_dir, f'{name}.c2r_index.json')
+
+    @classmethod
+    def load(cls, project_dir, jobs=None, num_workers=8, save=True, rebuild=False, index_path=None):
+        """Load the cached index of a project, and rescan the job directories modified since.
+
+        Parameters
+        ----------
+        project_dir : string
+            cryoSPARC project directory.
+
+        jobs : list of strings, optional
+            Job directory names to check. Other cached jobs are kept as they are. By default None (all the job directories)
+
+        num_workers : int, optional
+            Number of threads scanning the job directories. By default 8
+
+        save : bool, optional
+            Save the updated index. If it can not be written, a warning is printed. By default True
+
+        rebuild : bool, optional
+            Ignore the cached index. By default False
+
+        index_path : string, optional
+            Cached index file. By default index_file(project_dir)
+
+        Returns
+        -------
+        CryoSPARCProjectIndex
+            Index of the project.
+        """
+
+        assert os.path.isdir(project_dir), f'{project_dir} is not a directory.'
+        index_path = index_path or cls.index_file(project_dir)
+        cached = {}
+        if not rebuild and os.path.exists(index_path):
+            with open(index_path, 'r') as f:
+                saved = json.load(f)
+            # The file names in the cache directory may collide (e.g. /a_b and /a/b).
+            if saved.get('project_dir') == os.path.abspath(project_dir):
+                cached = saved['jobs']
+
+        if jobs is None:
+            with os.scandir(project_dir) as it:
+                names = [x.name for x in it if re.fullmatch(r'J\d+', x.name) and x.is_dir()]
+        else:
+            # Explicitly requested directories may have any name (e.g. a copied job directory).
+            names = [x for x in jobs if os.path.isdir(os.path.join(project_dir, x))]
+
+        index_jobs = {x: y for x, y in cached.items() if jobs is not None and x not in jobs}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+            listings = dict(zip(names, executor.map(cls._list_job, [os.path.join(project_dir, x) for x in names])))
+            # Files rewritten in place do not change the directory mtime, so the files themselves are compared.
+            stale = [x for x in names if x not in cached or cls._file_stats(cached[x]['files']) != cls._file_stats(listings[x])]
+            index_jobs.update({x: cached[x] for x in names if x not in stale})
+            for name, entry in zip(stale, executor.map(cls._scan_job, [os.path.join(project_dir, x) for x in stale], [listings[x] for x in stale])):
+                index_jobs[name] = entry
+
+        # Natural order, e.g. J9 before J10.
+        index = cls(project_dir, dict(sorted(index_jobs.items(), key=lambda x: re.sub(r'\d+', lambda m: m.group().zfill(12), x[0]))), index_path)
+        if save and (len(stale) > 0 or index.jobs.keys() != cached.keys()):
+            try:
+                index.save()
+            except OSError as e:
+                print(f'WARNING: The project index could not be saved ({e}). Set C2R_INDEX_DIR environment variable to save it elsewhere.', file=sys.stderr)
+        return index
+
+    @staticmethod
+    def _list_job(job_dir):
+        """Particle related files of a job directory, {file name: {'kind': classify_metafile result, 'size': bytes, 'mtime_ns': mtime}}."""
+
+        files = {}
+        with os.scandir(job_dir) as it:
+            for entry in it:
+                kind = classify_metafile(entry.name)
+                if kind is None or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                files[entry.name] = {'kind': kind, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        return files
+
+    @staticmethod
+    def _file_stats(files):
+        return {x: (y['kind'], y['size'], y.get('mtime_ns')) for x, y in files.items()}
+
+    @staticmethod
+    def _scan_job(job_dir, files):
+        """Scan the files of a job directory listed by _list_job.
+
+        Returns
+        -------
+        dict
+            'files' : Particle related files, {file name: {'kind': classify_metafile result, 'size': bytes, 'mtime_ns': mtime, 'num_rows': number of rows of .cs files}}
+            'groups' : Particle groups, one per .csg file, [{'csg': file name, 'particles': file name, 'passthrough': file name or None}]
+        """
+
+        files = {x: dict(y) for x, y in files.items()}
+        for name, entry in files.items():
+            if entry['kind'] != 'csg':
+                try:
+                    # Only the .npy header is read.
+                    entry['num_rows'] = int(load_cs(os.path.join(job_dir, name), mmap=True).shape[0])
+                except ValueError:
+                    entry['num_rows'] = None
+
+        groups = []
+        for name in sorted(x for x, y in files.items() if y['kind'] == 'csg'):
+            try:
+                cs_file, passthrough_file = get_metafiles_from_csg(os.path.join(job_dir, name))
+            except (AssertionError, SystemExit, KeyError, yaml.YAMLError):
+                continue
+            groups.append({
+                'csg': name,
+                'particles': os.path.basename(cs_file),
+                'passthrough': os.path.basename(passthrough_file) if passthrough_file else None,
+            })
+        return {'files': files, 'groups': groups}
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.index_path) or '.', exist_ok=True)
+        # Written to a temporary file and renamed, so that concurrent readers see either index.
+        tmp_path = f'{self.index_path}.tmp{os.getpid()}'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({'project_dir': os.path.abspath(self.project_dir), 'jobs': self.jobs}, f, indent=1)
+            os.replace(tmp_path, self.index_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def find_csg(self, job):
+        """Particles .csg file of a job.
+
+        Parameters
+        ----------
+        job : string
+            Job directory name (e.g. 'J20').
+
+        Returns
+        -------
+        string
+            Path of the .csg file. If the job has several particle groups, the one named *_particles.csg.
+        """
+
+        assert job in self.jobs, f'{job} was not found in {self.project_dir}'
+        groups = self.jobs[job]['groups']
+        assert len(groups) > 0, f'No particle .csg file found in {job}'
+        if len(groups) > 1:
+            groups = [x for x in groups if x['csg'].endswith('_particles.csg') and not x['csg'].endswith('_passthrough_particles.csg')]
+            assert len(groups) == 1, f'Could not determine the particle .csg file of {job}: {[x["csg"] for x in self.jobs[job]["groups"]]}'
+        return os.path.join(self.project_dir, job, groups[0]['csg'])
+
+    def num_particles(self, job):
+        """Number of particles of a job, from the index (without loading the .cs files)."""
+
+        csg_file = self.find_csg(job)
+        group = [x for x in self.jobs[job]['groups'] if x['csg'] == os.path.basename(csg_file)][0]
+        return self.jobs[job]['files'][group['particles']]['num_rows']
+
+
+def resolve_csg(path):
+    """Particles .csg file of a cryoSPARC job directory, looked up in the cached project index. Any other path is returned as is."""
+
+    if not os.path.isdir(path):
+        return path
+    job_dir = os.path.normpath(path)
+    project_dir, job = os.path.split(job_dir)
+    index = CryoSPARCProjectIndex.load(project_dir or '.', jobs=[job])
+    return index.find_csg(job)
+
+
+def load_latent_variables(infile, num_components=-1):
+    """Loat latent variables from cryoSPARC 3D variability job result.
+
+    Parameters
+    ----------
+    infile : string
+        A particle .cs file containing the latent variables (variability components). Typically like 'cryosparc_<project id>_<job id>_particles.cs'
+
+    num_components : int, optional
+        Number of components to use. By default (-1) use all the components.
+
+    Returns
+    -------
+    ndarray
+        Array containing the latent variables. shape=(num_samples, num_variables)
+    """
+
+    assert os.path.exists(infile)
+    return get_latent_variables(np.load(infile), num_components)
+
+
+def get_latent_variables(cs, num_components=-1):
+    """Extract latent variables from the particles of a cryoSPARC 3D variability job.
+
+    Parameters
+    ----------
+    cs : ndarray
+        Array containing particles .cs file contents.
+
+    num_components : int, optional
+        Number of components to use. By default (-1) use all the components.
+
+    Returns
+    -------
+    ndarray
+        Array containing the latent variables. shape=(num_samples, num_variables)
+    """
+
+    Z = []
+    components_mode = 0
+    while True:
+        if f'components_mode_{components_mode}/value' in cs.dtype.names:
+            Z.append(cs[f'components_mode_{components_mode}/value'])
+            components_mode += 1
+        else:
+            break
+    assert components_mode > 0, 'No variability components found.'
+    assert num_components <= components_mode
+    Z = np.vstack(Z).T
+    if num_components >= 0:
+        Z = Z[:, :num_components]
+    return Z
+
+
+def _cs_field_to_arrow(values):
+    # Fixed-shape fields (e.g. alignments3D/pose) are stored as fixed size lists, byte strings as UTF-8 strings.
+    values = np.ascontiguousarray(values)
+    if values.dtype.kind == 'S':
+        return pa.compute.cast(pa.array(values), pa.string())
+    if values.ndim > 1:
+        size = int(np.prod(values.shape[1:]))
+        return pa.FixedSizeListArray.from_arrays(pa.array(values.reshape(-1)), size)
+    return pa.array(values)
+
+
+def _arrow_to_cs(table, descr):
+    """Build a .cs structured array from the Arrow columns of the fields in descr."""
+
+    cs = np.empty(table.num_rows, dtype=np.dtype(descr))
+    for field in descr:
+        name = field[0]
+        column = table.column(name).combine_chunks()
+        if cs.dtype[name].kind == 'S':
+            cs[name] = pa.compute.cast(column, pa.binary()).to_numpy(zero_copy_only=False)
+        elif len(field) > 2:
+            cs[name] = column.flatten().to_numpy(zero_copy_only=False).reshape(cs[name].shape)
+        else:
+            cs[name] = column.to_numpy(zero_copy_only=False)
+    return cs
+
+
+class CryoSPARCMetaData:
+    """cryoSPARC metadata handling class.
+
+    Parameters
+    ----------
+    cs : ndarray
+        Array containing cryoSPARC particles .cs file contents (loaded by np.load)
+
+    csg_template : dict
+        Dictionary containing cryoSPARC particles .csg file contents (loaded by yaml.load)
+
+    passthrough : ndarray
+        Array containing cryoSPARC passthrough_particles .cs file contents (loaded by np.load)
+    """
+
+    def __init__(self, csg, cs, passthrough=None):
+        self.cs = cs
+        self.csg = csg
+        self.passthrough = passthrough
+
+        if self.passthrough is not None:
+            assert self.cs.shape[0] == self.passthrough.shape[0]
+
+    @classmethod
+    def load(cls, csg_file, mmap=False, usecols=None):
+        """Load cryoSPARC metadata from .csg file.
+        If the metadata server (c2r_server.py) is running, loads without mmap are served from its cache.
+
+        Parameters
+        ----------
+        csgfile : string
+            particles .csg file, cryoSPARC job directory (e.g. P1/J20, resolved with CryoSPARCProjectIndex), or Parquet file (.parquet) written by write_parquet.
+
+        mmap : bool, optional
+            Memory-map the .cs files (read-only) instead of loading them. Ignored for Parquet files. By default False
+
+        usecols : list of strings, optional
+            Fields to keep (e.g. ['uid', 'blob/path', 'blob/idx']). uid is always kept. Only the selected columns are read from Parquet files. Result groups of the csg without any remaining field are dropped. By default None (all the fields)
+
+        Returns
+        -------
+        CryoSparcMetaData
+            CryoSparcMetaData class instance.
+        """
+
+        if not mmap:
+            # Parsed metadata kept by the metadata server (c2r_server.py), if it is running.
+            md = server_load('cryosparc', csg_file, usecols=usecols)
+            if md is not None:
+                return md
+
+        if is_parquet(csg_file):
+            return cls._load_parquet(csg_file, usecols)
+
+        csg_file = resolve_csg(csg_file)
+        csg = load_csg(csg_file)
+
+        cs_file, passthrough_file = get_metafiles_from_csg(csg_file)
+
+        cs = load_cs(cs_file, mmap=mmap)
+        if passthrough_file:
+            passthrough = load_cs(passthrough_file, mmap=mmap)
+        else:
+            passthrough = None
+
+        md = cls(csg, cs, passthrough)
+        if usecols is not None:
+            md = md._select_fields(usecols, repack=not mmap)
+        return md
+
+    @classmethod
+    def _load_parquet(cls, infile, usecols=None):
+        """Load cryoSPARC metadata from a Parquet file written by write_parquet."""
+
+        _check_pyarrow(infile)
+        pf = pq.ParquetFile(infile)
+        metadata = _parquet_c2r_metadata(pf.schema_arrow, 'cryosparc', infile)
+        csg = yaml.load(metadata['csg'], Loader=yaml.FullLoader)
+        cs_descr = [tuple(x) for x in metadata['cs_dtype']]
+        passthrough_descr = [tuple(x) for x in metadata['passthrough_dtype'] or []]
+        if usecols is not None:
+            cs_descr = [x for x in cs_descr if x[0] == 'uid' or x[0] in usecols]
+            if not any(x[0] != 'uid' and x[0] in usecols for x in passthrough_descr):
+                passthrough_descr = []
+            passthrough_descr = [x for x in passthrough_descr if x[0] == 'uid' or x[0] in usecols]
+        table = pf.read(columns=[x[0] for x in cs_descr] + [x[0] for x in passthrough_descr if x[0] != 'uid'])
+
+        cs = _arrow_to_cs(table, cs_descr)
+        passthrough = _arrow_to_cs(table, passthrough_descr) if passthrough_descr else None
+        md = cls(csg, cs, passthrough)
+        md._prune_csg()
+        return md
+
+    def write(self, outdir, outfile_rootname):
+        """Save metadata in files.
+
+        Parameters
+        ----------
+        outdir : string
+            Output directory.
+
+        outfile_rootname : string
+            Output file rootname.
+        """
+
+        os.makedirs(outdir, exist_ok=True)
+
+        cs_file = os.path.join(outdir, outfile_rootname + '_particles.cs')
+        save_cs(cs_file, self.cs)
+
+        if self.passthrough is not None:
+            passthrough_file = os.path.join(outdir, outfile_rootname + '_passthrough_particles.cs')
+            save_cs(passthrough_file, self.passthrough)
+        else:
+            passthrough_file = None
+
+        csg_file = os.path.join(outdir, outfile_rootname + '_particles.csg')
+        self._update_csg(cs_file, passthrough_file)
+        save_csg(csg_file, self.csg)
+
+    def write_parquet(self, outfile):
+        """Save metadata in a single Parquet file, with one typed column per field.
+        The passthrough fields are joined to the particles on uid. The csg and the numpy dtypes are stored in the schema metadata, so that load restores the .cs arrays exactly.
+
+        Parameters
+        ----------
+        outfile : string
+            Output Parquet file (.parquet).
+        """
+
+        _check_pyarrow(outfile)
+        columns = {name: _cs_field_to_arrow(self.cs[name]) for name in self.cs.dtype.names}
+        if self.passthrough is not None:
+            if np.array_equal(self.passthrough['uid'], self.cs['uid']):
+                passthrough = self.passthrough
+            else:
+                idxs = pd.Index(self.passthrough['uid']).get_indexer(self.cs['uid'])
+                assert np.all(idxs >= 0), 'Some particles are missing in the passthrough.'
+                passthrough = self.passthrough[idxs]
+            for name in passthrough.dtype.names:
+                if name == 'uid':
+                    continue
+                assert name not in columns, f'{name} is in both the particles and the passthrough.'
+                columns[name] = _cs_field_to_arrow(passthrough[name])
+
+        metadata = {
+            'kind': 'cryosparc',
+            'csg': yaml.dump(self.csg),
+            'cs_dtype': self.cs.dtype.descr,
+            'passthrough_dtype': self.passthrough.dtype.descr if self.passthrough is not None else None,
+        }
+        _write_parquet(outfile, pa.table(columns), metadata)
+
+    def _update_csg(self, cs_file, passthrough_file=None):
+        """Update cs group file content.
+
+        Parameters
+        ----------
+        cs_file : string
+            Filename of new particles .cs file. (Directory path not required.)
+
+        passthrough_file : string
+            Filename of new passthrough_particles .cs file. (Directory path not required.)
+        """
+
+        self.csg['created'] = datetime.datetime.now()
+        self.csg['group']['description'] = 'Created by cryoPICLS. cryopcls.data_handling.cryosparc.CryoSPARCMetaData._update_csg()'
+
+        num_items = self.cs.shape[0]
+        cs_basename = os.path.basename(cs_file)
+        if passthrough_file:
+            passthrough_basename = os.path.basename(passthrough_file)
+
+        for key in self.csg['results'].keys():
+            if 'passthrough_particles.cs' in self.csg['results'][key]['metafile']:
+                assert passthrough_file is not None
+                self.csg['results'][key]['metafile'] = '>' + passthrough_basename
+            elif 'particles.cs' in self.csg['results'][key]['metafile'] or 'particles_expanded.cs' in self.csg['results'][key]['metafile']:
+                self.csg['results'][key]['metafile'] = '>' + cs_basename
+            else:
+                sys.exit(f'Unknown metafile name in {key}: {self.csg["results"][key]["metafile"]}')
+            if 'num_items' in self.csg['results'][key].keys():
+                self.csg['results'][key]['num_items'] = num_items
+
+    def image_keys(self, codebook, rm_uid=False, rm_ext=False):
+        """Integer image keys of the particles (see ImageKeyCodebook).
+
+        Parameters
+        ----------
+        codebook : ImageKeyCodebook
+            Codebook shared with the metadata to be compared.
+
+        rm_uid : bool, optional
+            Remove the cryoSPARC UIDs from the stack names. By default False
+
+        rm_ext : bool, optional
+            Remove the file extension from the stack names. By default False
+
+        Returns
+        -------
+        ndarray
+            Image keys. dtype=uint64
+        """
+
+        idxs, stacks = split_blobs(self.cs)
+        return codebook.keys(idxs, stacks, rm_uid=rm_uid, rm_ext=rm_ext)
+
+    def _select_fields(self, usecols, repack=True):
+        """Keep the uid and the fields in usecols. Without repack, the arrays are views of the original ones."""
+
+        def select(cs, names):
+            cs = cs[names]
+            return rfn.repack_fields(cs) if repack else cs
+
+        cs = select(self.cs, [x for x in self.cs.dtype.names if x == 'uid' or x in usecols])
+        passthrough = None
+        if self.passthrough is not None:
+            names = [x for x in self.passthrough.dtype.names if x != 'uid' and x in usecols]
+            if len(names) > 0:
+                passthrough = select(self.passthrough, ['uid'] + names)
+        md = self.__class__(copy.deepcopy(self.csg), cs, passthrough)
+        md._prune_csg()
+        return md
+
+    def _prune_csg(self):
+        """Drop the csg result groups without any field in cs and passthrough."""
+
+        names = list(self.cs.dtype.names)
+        if self.passthrough is not None:
+            names += list(self.passthrough.dtype.names)
+        prefixes = set(x.split('/')[0] for x in names)
+        for key in list(self.csg['results'].keys()):
+            if key not in prefixes:
+                del self.csg['results'][key]
+
+    def iloc(self, idxs):
+        """Fancy indexing.
+
+        Parameters
+        ----------
+        idxs : array-like
+            Indices to select.
+
+        Returns
+        -------
+        CryoSPARCMetaData
+            New metadata object with the selected rows.
+        """
+
+        cs = self.cs[idxs]
+        if self.passthrough is not None:
+            passthrough = self.passthrough[idxs]
+        else:
+            passthrough = None
+        return self.__class__(self.csg, cs, passthrough)
+
+
+class StarBlock:
+    """Index entry of a data block in a star file.
+    Parameters
+    ----------
+    name : string
+        Data block name (e.g. data_optics, data_particles, data_)
+    offset : int
+        Byte offset of the data block line.
+    """
+    def __init__(self, name, offset):
+        self.name = name
+        self.offset = offset
+        # True for loop_ blocks, False for key-value blocks (e.g. data_model_general).
+        self.loop = None
+        # Metadata labels
+        self.labels = []
+        # Values of key-value blocks.
+        self.values = []
+        # Byte offsets of the loop body [body_offset, body_end), up to the first empty line. body_end is None until the body is read or skipped.
+        self.body_offset = None
+        self.body_end = None
+
+    def __repr__(self):
+        return f'StarBlock(name={self.name!r}, offset={self.offset}, loop={self.loop}, num_labels={len(self.labels)}, body_offset={self.body_offset}, body_end={self.body_end})'
+
+
+class StarFile:
+    """Lazy star file reader with a byte-offset block index.
+    The file is scanned incrementally, only as far as needed to find the requested data block. Only the start of a loop body is recorded when its header is scanned.
+    The end of the body is found when the body is read, or skipped with a chunked byte search when a later block is requested.
+    One file handle is kept open across the scan and the reads, and is only moved forward when the blocks are accessed in file order, so that a compressed file is decompressed once.
+    Works for any multi-block star file (particles, micrographs, model, job, ...).
+    Parameters
+    ----------
+    starfile : string
+        star file. Compressed star files (.star.gz, .star.zst, etc.) are also accepted, although seeking backward in them requires decompressing from the beginning.
+    """
+
+    # Chunk size for skipping loop bodies.
+    SCAN_CHUNK_SIZE = 16 * 1024 * 1024
+    # A loop body ends at the first empty line, or at the next data block.
+    _BODY_END = re.compile(rb'\n(?:[ \t\r]*\n|data_)')
+    _BODY_END_FIRST_LINE = re.compile(rb'(?:[ \t\r]*\n|data_)')
+
+    def __init__(self, starfile):
+        self.starfile = starfile
+        # Block name -> StarBlock, in file order.
+        self.blocks = {}
+        self._cache = {}
+        self._scan_pos = 0
+        self._scan_done = False
+        # The loop block whose body end is not found yet.
+        self._pending = None
+        # File handle, the uncompressed offset of the next byte to read, and the bytes read ahead.
+        self._f = None
+        self._pos = 0
+        self._pushback = b''
+        self._compressed = os.path.splitext(starfile)[1].lower() in ('.gz', '.bz2', '.xz', '.zst')
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_f'] = None
+        state['_pushback'] = b''
+        return state
+
+    def close(self):
+        """Close the file handle. It is reopened on the next access."""
+
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+            self._pushback = b''
+
+    def __contains__(self, name):
+        return self.find_block(name) is not None
+
+    def __getitem__(self, name):
+        """Parsed data block contents, cached."""
+        if name not in self._cache:
+            self._cache[name] = self.read(name)
+        return self._cache[name]
+
+    def block_names(self):
+        """Names of all the data blocks. Scans the whole file.
+        Returns
+        -------
+        list of strings
+            Data block names in file order.
+        """
+
+        self._scan()
+        return list(self.blocks.keys())
+
+    def nth_block(self, n):
+        """The n-th (0-based) data block, scanning only as far as needed.
+        Returns
+        -------
+        StarBlock or None
+            None if the file has n or fewer data blocks.
+        """
+
+        while len(self.blocks) <= n and not self._scan_done:
+            self._scan_next_block()
+        if len(self.blocks) <= n:
+            return None
+        return list(self.blocks.values())[n]
+
+    def find_block(self, name):
+        """Find a data block by name, scanning only as far as needed.
+        Returns
+        -------
+        StarBlock or None
+            None if the block does not exist.
+        """
+
+        while name not in self.blocks and not self._scan_done:
+            self._scan_next_block()
+        return self.blocks.get(name)
+
+    def labels(self, name):
+        """Metadata labels of a data block, without parsing its body.
+        Returns
+        -------
+        list of strings
+            Metadata labels.
+        """
+
+        block = self.find_block(name)
+        assert block is not None, f'{name} block was not found in {self.starfile}'
+        return list(block.labels)
+
+    def _scan(self):
+        while not self._scan_done:
+            self._scan_next_block()
+
+    def _seek(self, pos):
+        """Move the file handle to the uncompressed offset pos. Compressed files are reopened only to move backward."""
+
+        if self._f is not None and pos == self._pos:
+            return
+        if self._f is not None:
+            real_pos = self._pos + len(self._pushback)
+            if self._pos < pos <= real_pos:
+                self._pushback = self._pushback[pos - self._pos:]
+                self._pos = pos
+                return
+            self._pushback = b''
+            if pos >= real_pos and not self._f.seekable():
+                seek_star(self._f, pos - real_pos)
+                self._pos = pos
+                return
+            if pos < real_pos and self._compressed:
+                self.close()
+        if self._f is None:
+            self._f = open_star(self.starfile, 'rb')
+            self._pos = 0
+        if self._f.seekable():
+            self._f.seek(pos)
+        else:
+            seek_star(self._f, pos)
+        self._pos = pos
+
+    def _readline(self):
+        if self._pushback:
+            line = self._pushback
+            self._pushback = b''
+            i = line.find(b'\n') + 1
+            if i > 0:
+                line, self._pushback = line[:i], line[i:]
+            else:
+                line += self._f.readline()
+        else:
+            line = self._f.readline()
+        self._pos += len(line)
+        return line
+
+    def _unreadline(self, line):
+        self._pushback = line + self._pushback
+        self._pos -= len(line)
+
+    def _read(self, n):
+        data = self._pushback[:n]
+        self._pushback = self._pushback[n:]
+        if len(data) < n:
+            data += self._f.read(n - len(data))
+        self._pos += len(data)
+        return data
+
+    def _scan_next_block(self):
+        """Scan the next data block header from self._scan_pos."""
+
+        if self._pending is not None:
+            # A later block is requested: skip the last loop body now.
+            self.ensure_block_end(self._pending)
+
+        self._seek(self._scan_pos)
+
+        # Get to the next block.
+        block = None
+        while True:
+            line = self._readline()
+            if not line:
+                break
+            stripped = line.strip()
+            if stripped.startswith(b'data_'):
+                block = StarBlock(stripped.split()[0].decode('UTF-8'), self._pos - len(line))
+                break
+        if block is None:
+            self._scan_done = True
+            self._scan_pos = self._pos
+            return
+        self.blocks[block.name] = block
+
+        # Block header
+        body_pos = None
+        while True:
+            line = self._readline()
+            if not line:
+                break
+            line_pos = self._pos - len(line)
+            stripped = line.strip()
+            if stripped == b'' or stripped.startswith(b'#'):
+                if block.loop and len(block.labels) > 0:
+                    # Empty loop body
+                    body_pos = line_pos
+                    self._unreadline(line)
+                    break
+                continue
+            elif stripped.startswith(b'data_'):
+                # Next block begins without a loop body.
+                self._unreadline(line)
+                break
+            elif stripped.startswith(b'loop_'):
+                block.loop = True
+            elif stripped.startswith(b'_'):
+                words = stripped.decode('UTF-8').split(None, 1)
+                block.labels.append(words[0])
+                if block.loop is None:
+                    block.loop = False
+                if not block.loop:
+                    block.values.append(words[1].strip() if len(words) > 1 else '')
+            else:
+                # The first line of the loop body
+                body_pos = line_pos
+                self._unreadline(line)
+                break
+
+        if body_pos is None:
+            # Key-value block, or a block without body.
+            block.body_offset = self._pos
+            block.body_end = self._pos
+            self._scan_pos = self._pos
+            return
+
+        # The body end is found only when needed.
+        block.body_offset = body_pos
+        self._scan_pos = body_pos
+        self._pending = block
+
+    def _iter_body(self, block, chunk_bytes):
+        """Raw bytes of a loop body in chunks of complete lines, without the trailing empty lines.
+        Finds the end of the body on the way, if it is not known yet. The bytes read beyond the end are kept for the next read.
+        """
+
+        pos = block.body_offset
+        end = block.body_end
+        tail = b''
+        # Start small, as most blocks other than the particles are a few lines.
+        read_size = min(chunk_bytes, 64 * 1024)
+        while True:
+            self._seek(pos + len(tail))
+            n = read_size if end is None else min(read_size, end - self._pos)
+            read_size = min(read_size * 2, chunk_bytes)
+            data = self._read(n) if n > 0 else b''
+            buf = tail + data
+            last = len(data) == 0 or (end is not None and self._pos >= end)
+            if last:
+                tail = b''
+            else:
+                # Complete lines only.
+                cut = buf.rfind(b'\n') + 1
+                buf, tail = buf[:cut], buf[cut:]
+            m = self._BODY_END_FIRST_LINE.match(buf)
+            if m is not None:
+                stop = 0
+            else:
+                m = self._BODY_END.search(buf)
+                stop = None if m is None else m.start() + 1
+            if stop is not None:
+                self._unreadline(buf[stop:] + tail)
+                buf = buf[:stop]
+                last = True
+            if len(buf) > 0:
+                yield buf
+            pos += len(buf)
+            if last:
+                if block.body_end is None:
+                    block.body_end = pos
+                if self._pending is block:
+                    self._pending = None
+                    self._scan_pos = block.body_end
+                return
+
+    def ensure_block_end(self, block):
+        """Find the end of the block body, skipping the body if it is not read yet."""
+
+        if block.body_end is None:
+            for _ in self._iter_body(block, self.SCAN_CHUNK_SIZE):
+                pass
+
+    def _read_body_bytes(self, block):
+        """Raw bytes of a loop body, without the trailing empty lines and comments."""
+
+        return b''.join(self._iter_body(block, self.SCAN_CHUNK_SIZE))
+
+    def _parse_body(self, buf, block, labels, categorical_labels):
+        """Parse loop body bytes with the pandas C parser."""
+
+        if len(buf) == 0:
+            return pd.DataFrame(columns=labels, dtype=object)
+        dtype = {x: ('category' if x in categorical_labels else str) for x in labels}
+        df = pd.read_csv(
+            io.BytesIO(buf), sep=r'\s+', header=None, names=block.labels, usecols=labels, dtype=dtype,
+            quoting=csv.QUOTE_NONE, na_filter=False, engine='c'
+        )
+        assert df.shape[1] == len(labels), f'Unexpected number of columns in {block.name} block of {self.starfile}'
+        return df[labels]
+
+    def read(self, name, usecols=None, categorical_labels=()):
+        """Parse a data block.
+        Parameters
+        ----------
+        name : string
+            Data block name.
+        usecols : list of strings, optional
+            Labels to parse. Labels not in the block are ignored. By default None (all the labels)
+        categorical_labels : list of strings, optional
+            Labels to parse directly into pandas Categorical. By default ()
+        Returns
+        -------
+        pandas.DataFrame
+            Block contents as strings (or Categorical). Key-value blocks are returned as a single row DataFrame.
+        """
+
+        block = self.find_block(name)
+        assert block is not None, f'{name} block was not found in {self.starfile}'
+
+        labels = block.labels
+        if usecols is not None:
+            labels = [x for x in labels if x in usecols]
+
+        if not block.loop:
+            df = pd.DataFrame([block.values], columns=block.labels)
+            return df[labels]
+
+        return self._parse_body(self._read_body_bytes(block), block, labels, categorical_labels)
+
+    def iter_chunks(self, name, chunk_bytes=64 * 1024 * 1024, usecols=None, categorical_labels=()):
+        """Parse a loop block in chunks of rows, to stream blocks larger than RAM.
+        Parameters
+        ----------
+        name : string
+            Data block name.
+        chunk_bytes : int, optional
+            Approximate size of the body bytes parsed at once. By default 64 MiB
+        usecols : list of strings, optional
+            Labels to parse. Labels not in the block are ignored. By default None (all the labels)
+        categorical_labels : list of strings, optional
+            Labels to parse directly into pandas Categorical. By default ()
+        Yields
+        ------
+        pandas.DataFrame
+            Consecutive rows of the block.
+        """
+
+        block = self.find_block(name)
+        assert block is not None, f'{name} block was not found in {self.starfile}'
+        assert block.loop, f'{name} block of {self.starfile} is not a loop block.'
+
+        labels = block.labels
+        if usecols is not None:
+            labels = [x for x in labels if x in usecols]
+
+        for buf in self._iter_body(block, chunk_bytes):
+            yield self._parse_body(buf, block, labels, categorical_labels)
+
+
+class StarRowIndex:
+    """Seekable row index of the data block of a star file.
+    Records the byte offset of every row and the hashes of the image ids, so that arbitrary rows can be fetched with seek + read without parsing the whole file.
+    The index is stored as a sidecar file next to the star file (<starfile>.c2ridx.npz), and rebuilt when the star file changes.
+    Parameters
+    ----------
+    starfile : string
+        Uncompressed star file.
+    block_name : string
+        Indexed data block name.
+    labels : list of strings
+        Metadata labels of the block.
+    offsets : ndarray
+        Byte offsets of the rows, plus the end of the last row. shape=(num_rows + 1,)
+    key_hashes : ndarray
+        Sorted hashes of the image ids (see hash_imgids).
+    key_rows : ndarray
+        Row numbers corresponding to key_hashes.
+    rm_uid : bool
+        Whether the cryoSPARC UIDs were removed from the image ids.
+    """
+
+    SUFFIX = '.c2ridx.npz'
+    # Bump this when the sidecar contents change.
+    VERSION = 1
+
+    def __init__(self, starfile, block_name, labels, offsets, key_hashes, key_rows, rm_uid):
+        self.starfile = starfile
+        self.block_name = block_name
+        self.labels = list(labels)
+        self.offsets = offsets
+        self.key_hashes = key_hashes
+        self.key_rows = key_rows
+        self.rm_uid = rm_uid
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @classmethod
+    def sidecar_file(cls, starfile):
+        return starfile + cls.SUFFIX
 
+    @classmethod
+    def load(cls, starfile, rm_uid=False, save=True):
+        """Load the index from the sidecar file, or build it if the sidecar is missing or outdated.
         Parameters
         ----------
-        csgfile : string
-            particles .csg file.
-
+        starfile : string
+            Uncompressed star file.
+        rm_uid : bool, optional
+            Remove the cryoSPARC UIDs from the image ids. By default False
+        save : bool, optional
+            Save a newly built index as the sidecar file. If the sidecar can not be written (e.g. read-only project directory), the index is kept in memory only. By default True
         Returns
         -------
-        CryoSparcMetaData
-            CryoSparcMetaData class instance.
+        StarRowIndex
+            StarRowIndex class instance.
         """
 
-        csg = load_csg(csg_file)
-
-        cs_file, passthrough_file = get_metafiles_from_csg(csg_file)
+        sidecar = cls.sidecar_file(starfile)
+        if os.path.exists(sidecar):
+            st = os.stat(starfile)
+            with np.load(sidecar) as npz:
+                meta = npz['meta']
+                if int(meta[0]) == cls.VERSION and int(meta[1]) == st.st_size and int(meta[2]) == st.st_mtime_ns and bool(meta[3]) == rm_uid:
+                    return cls(starfile, str(npz['block_name']), npz['labels'].tolist(), npz['offsets'], npz['key_hashes'], npz['key_rows'], rm_uid)
+
+        index = cls.build(starfile, rm_uid=rm_uid)
+        if save:
+            try:
+                index.save()
+            except OSError as e:
+                print(f'WARNING: The row index could not be saved ({e}), and is used in memory only.', file=sys.stderr)
+                if os.path.exists(sidecar):
+                    try:
+                        os.remove(sidecar)
+                    except OSError:
+                        pass
+        return index
 
-        cs = load_cs(cs_file)
-        if passthrough_file:
-            passthrough = load_cs(passthrough_file)
-        else:
-            passthrough = None
+    @classmethod
+    def build(cls, starfile, rm_uid=False):
+        """Build the index by scanning the data block.
+        Parameters
+        ----------
+        starfile : string
+            Uncompressed star file.
+        rm_uid : bool, optional
+            Remove the cryoSPARC UIDs from the image ids. By default False
+        Returns
+        -------
+        StarRowIndex
+            StarRowIndex class instance.
+        """
 
-        return cls(csg, cs, passthrough)
+        assert os.path.splitext(starfile)[1].lower() not in ('.gz', '.bz2', '.xz', '.zst'), f'Random access requires an uncompressed star file: {starfile}'
+
+        star = StarFile(starfile)
+        block = star.nth_block(1) if star.nth_block(0).name == 'data_optics' else star.nth_block(0)
+        assert block.loop, f'{block.name} block of {starfile} is not a loop block.'
+        # The row scan stops at the end of the body, which does not need to be found beforehand.
+        body_end = block.body_end if block.body_end is not None else os.path.getsize(starfile)
+        offsets = cls._scan_row_offsets(starfile, block.body_offset, body_end)
+
+        key_hashes = np.zeros(0, dtype=np.uint64)
+        key_rows = np.zeros(0, dtype=np.int64)
+        if '_rlnImageName' in block.labels:
+            imgnames = star.read(block.name, usecols=['_rlnImageName'])['_rlnImageName']
+            assert len(imgnames) == len(offsets) - 1
+            key_hashes = hash_imgids(imgnames_to_imgids(imgnames, rm_uid=rm_uid))
+            key_rows = np.argsort(key_hashes, kind='stable')
+            key_hashes = key_hashes[key_rows]
+
+        return cls(starfile, block.name, block.labels, offsets, key_hashes, key_rows, rm_uid)
+
+    @staticmethod
+    def _scan_row_offsets(starfile, body_offset, body_end, chunk_size=64 * 1024 * 1024):
+        """Byte offsets of the rows of a loop body, up to the first empty line."""
+
+        whitespace = np.zeros(256, dtype=bool)
+        whitespace[[ord(' '), ord('\t'), ord('\r'), ord('\n')]] = True
+
+        row_starts = []
+        line_start = body_offset
+        # Running count of non-whitespace bytes, at the last newline and at the chunk end.
+        nl_count = 0
+        count = 0
+        pos = body_offset
+        with open(starfile, 'rb') as f:
+            f.seek(body_offset)
+            while pos < body_end:
+                chunk = np.frombuffer(f.read(min(chunk_size, body_end - pos)), dtype=np.uint8)
+                if len(chunk) == 0:
+                    break
+                cum = np.cumsum(~whitespace[chunk], dtype=np.int64) + count
+                nl = np.flatnonzero(chunk == ord('\n'))
+                if len(nl) > 0:
+                    starts = np.concatenate(([line_start], pos + nl[:-1] + 1))
+                    # A line without any non-whitespace byte ends the body.
+                    blank = np.flatnonzero(np.diff(np.concatenate(([nl_count], cum[nl]))) == 0)
+                    if len(blank) > 0:
+                        row_starts.append(starts[:blank[0]])
+                        line_start = starts[blank[0]]
+                        break
+                    row_starts.append(starts)
+                    line_start = pos + nl[-1] + 1
+                    nl_count = cum[nl[-1]]
+                count = cum[-1]
+                pos += len(chunk)
+            else:
+                # The last row may lack the line break.
+                if count > nl_count:
+                    row_starts.append(np.array([line_start]))
+                    line_start = pos
+
+        row_starts.append(np.array([line_start]))
+        return np.concatenate(row_starts).astype(np.uint64)
+
+    def save(self):
+        """Save the index as the sidecar file."""
+
+        st = os.stat(self.starfile)
+        meta = np.array([self.VERSION, st.st_size, st.st_mtime_ns, int(self.rm_uid)], dtype=np.int64)
+        with open(self.sidecar_file(self.starfile), 'wb') as f:
+            np.savez(
+                f, meta=meta, block_name=np.array(self.block_name), labels=np.array(self.labels),
+                offsets=self.offsets, key_hashes=self.key_hashes, key_rows=self.key_rows
+            )
+
+    def find_imgids(self, imgids):
+        """Look up row numbers of image ids.
+        Parameters
+        ----------
+        imgids : array-like
+            Image ids, normalized in the same way as the index (see rm_uid).
+        Returns
+        -------
+        ndarray
+            Row numbers. -1 for the image ids not found. Hash collisions are not resolved here, see fetch_imgids.
+        """
 
-    def write(self, outdir, outfile_rootname):
-        """Save metadata in files.
+        assert len(self.key_hashes) > 0, f'{self.starfile} has no _rlnImageName to look up.'
+        hashes = hash_imgids(imgids)
+        pos = np.searchsorted(self.key_hashes, hashes)
+        pos = np.minimum(pos, len(self.key_hashes) - 1)
+        found = self.key_hashes[pos] == hashes
+        return np.where(found, self.key_rows[pos], -1)
 
+    def fetch_rows(self, rows, categorical=True):
+        """Read rows by row number with seek + read.
         Parameters
         ----------
-        outdir : string
-            Output directory.
+        rows : array-like
+            Row numbers (0-based).
+        categorical : bool, optional
+            Store the labels in CATEGORICAL_LABELS as pandas Categorical. By default True
+        Returns
+        -------
+        pandas.DataFrame
+            Rows in the requested order.
+        """
 
-        outfile_rootname : string
-            Output file rootname.
+        rows = np.asarray(rows, dtype=np.int64)
+        assert np.all((rows >= 0) & (rows < len(self))), 'Row number out of range.'
+
+        # Read in file order, then restore the requested order.
+        uniq, inverse = np.unique(rows, return_inverse=True)
+        starts = self.offsets[uniq]
+        ends = self.offsets[uniq + 1]
+        lines = []
+        with open(self.starfile, 'rb') as f:
+            for start, end in zip(starts, ends):
+                f.seek(int(start))
+                lines.append(f.read(int(end - start)).rstrip(b'\r\n'))
+
+        categorical_labels = CATEGORICAL_LABELS if categorical else ()
+        dtype = {x: ('category' if x in categorical_labels else str) for x in self.labels}
+        if len(lines) == 0:
+            return pd.DataFrame(columns=self.labels, dtype=object)
+        df = pd.read_csv(
+            io.BytesIO(b'\n'.join(lines)), sep=r'\s+', header=None, names=self.labels, dtype=dtype,
+            quoting=csv.QUOTE_NONE, na_filter=False, engine='c'
+        )
+        return df.iloc[inverse].reset_index(drop=True)
+
+    def fetch_imgids(self, imgids, categorical=True):
+        """Read rows by image id with seek + read.
+        Parameters
+        ----------
+        imgids : array-like
+            Image ids, normalized in the same way as the index (see rm_uid).
+        categorical : bool, optional
+            Store the labels in CATEGORICAL_LABELS as pandas Categorical. By default True
+        Returns
+        -------
+        df : pandas.DataFrame
+            Rows found, in the requested order.
+        found : ndarray
+            Boolean mask of the image ids found.
         """
 
-        os.makedirs(outdir, exist_ok=True)
+        imgids = np.asarray(imgids, dtype=object)
+        rows = self.find_imgids(imgids)
+        found = rows >= 0
+        df = self.fetch_rows(rows[found], categorical=categorical)
+        # Reject hash collisions.
+        if len(df) > 0:
+            match = imgnames_to_imgids(df['_rlnImageName'], rm_uid=self.rm_uid) == imgids[found]
+            if not np.all(match):
+                df = df[match].reset_index(drop=True)
+                found[np.flatnonzero(found)[~match]] = False
+        return df, found
+
+
+class ExternalSorter:
+    """External merge sort of (key, record) string pairs within a memory budget.
+    Pairs are buffered in memory, and sorted runs are spilled to scratch files whenever the buffer exceeds the budget. Iterating over the sorter k-way merges the runs.
+    Keys and records must not contain tabs or line breaks, which always holds for star file values.
+    Parameters
+    ----------
+    max_memory : int
+        Memory budget of the buffer in bytes.
+    tmpdir : string, optional
+        Scratch directory. Preferably on a local disk. By default None (system default)
+    """
 
-        cs_file = os.path.join(outdir, outfile_rootname + '_particles.cs')
-        save_cs(cs_file, self.cs)
+    # Approximate memory overhead of a buffered pair (Python objects), in bytes.
+    PAIR_OVERHEAD = 160
+    # Maximum number of runs merged at once.
+    MAX_FANIN = 256
 
-        if self.passthrough is not None:
-            passthrough_file = os.path.join(outdir, outfile_rootname + '_passthrough_particles.cs')
-            save_cs(passthrough_file, self.passthrough)
-        else:
-            passthrough_file = None
+    def __init__(self, max_memory, tmpdir=None):
+        self.max_memory = max_memory
+        self.tmpdir = tmpdir
+        self._workdir = None
+        self._runs = []
+        self._num_run_files = 0
+        self._buffer = []
+        self._buffer_size = 0
 
-        csg_file = os.path.join(outdir, outfile_rootname + '_particles.csg')
-        self._update_csg(cs_file, passthrough_file)
-        save_csg(csg_file, self.csg)
+    def __enter__(self):
+        return self
 
-    def _update_csg(self, cs_file, passthrough_file=None):
-        """Update cs group file content.
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
+    def add(self, keys, records):
+        """Add (key, record) pairs.
         Parameters
         ----------
-        cs_file : string
-            Filename of new particles .cs file. (Directory path not required.)
-
-        passthrough_file : string
-            Filename of new passthrough_particles .cs file. (Directory path not required.)
+        keys : array-like
+            Sort keys (strings).
+        records : array-like
+            Records (strings).
         """
 
-        self.csg['created'] = datetime.datetime.now()
-        self.csg['group']['description'] = 'Created by cryoPICLS. cryopcls.data_handling.cryosparc.CryoSPARCMetaData._update_csg()'
+        keys = list(keys)
+        records = list(records)
+        assert len(keys) == len(records)
+        self._buffer.extend(zip(keys, records))
+        self._buffer_size += sum(map(len, keys)) + sum(map(len, records)) + self.PAIR_OVERHEAD * len(keys)
+        if self._buffer_size > self.max_memory:
+            self._spill()
+
+    def _new_run_file(self):
+        if self._workdir is None:
+            self._workdir = tempfile.mkdtemp(prefix='c2r_sort_', dir=self.tmpdir)
+        self._num_run_files += 1
+        return os.path.join(self._workdir, f'run{self._num_run_files:06d}.txt')
+
+    def _spill(self):
+        """Sort the buffer and write it as a run."""
+
+        if len(self._buffer) == 0:
+            return
+        self._buffer.sort(key=itemgetter(0))
+        run_file = self._new_run_file()
+        with open(run_file, 'w') as f:
+            f.writelines(f'{key}\t{record}\n' for key, record in self._buffer)
+        self._runs.append(run_file)
+        self._buffer = []
+        self._buffer_size = 0
+
+    @staticmethod
+    def _read_run(f):
+        for line in f:
+            key, record = line.rstrip('\n').split('\t', 1)
+            yield key, record
+
+    def _merge_runs(self, run_files):
+        files = [open(x) for x in run_files]
+        try:
+            yield from heapq.merge(*[self._read_run(f) for f in files], key=itemgetter(0))
+        finally:
+            for f in files:
+                f.close()
+
+    def __iter__(self):
+        if len(self._runs) == 0:
+            # Everything fits in the memory budget.
+            self._buffer.sort(key=itemgetter(0))
+            yield from self._buffer
+            return
+
+        self._spill()
+        # Reduce the number of runs to merge at once, to bound the number of open files.
+        while len(self._runs) > self.MAX_FANIN:
+            runs, self._runs = self._runs, []
+            for i in range(0, len(runs), self.MAX_FANIN):
+                run_file = self._new_run_file()
+                with open(run_file, 'w') as f:
+                    f.writelines(f'{key}\t{record}\n' for key, record in self._merge_runs(runs[i:i + self.MAX_FANIN]))
+                self._runs.append(run_file)
+                for x in runs[i:i + self.MAX_FANIN]:
+                    os.remove(x)
+        yield from self._merge_runs(self._runs)
+
+    def close(self):
+        """Remove the scratch files."""
+
+        if self._workdir is not None:
+            shutil.rmtree(self._workdir, ignore_errors=True)
+            self._workdir = None
+        self._runs = []
+        self._buffer = []
+        self._buffer_size = 0
+
+
+def merge_join(left, right):
+    """Merge join of two key-sorted (key, record) streams, such as ExternalSorter.
+    Parameters
+    ----------
+    left : iterable
+        Sorted (key, record) pairs. Keys may be duplicated.
+    right : iterable
+        Sorted (key, record) pairs. Keys must be unique (strictly increasing).
+    Yields
+    ------
+    key : string
+        Key of the left pair.
+    left_record : string
+        Record of the left pair.
+    right_record : string or None
+        Record of the right pair with the same key, or None if not found.
+    """
 
-        num_items = self.cs.shape[0]
-        cs_basename = os.path.basename(cs_file)
-        if passthrough_file:
-            passthrough_basename = os.path.basename(passthrough_file)
+    def strictly_increasing(pairs):
+        prev = None
+        for pair in pairs:
+            assert prev is None or prev < pair[0], f'Duplicated key {pair[0]} in the right stream.' if prev == pair[0] else f'The right stream is not sorted at {pair[0]}.'
+            prev = pair[0]
+            yield pair
+
+    right = strictly_increasing(right)
+    r = next(right, None)
+    for key, left_record in left:
+        while r is not None and r[0] < key:
+            r = next(right, None)
+        if r is not None and r[0] == key:
+            yield key, left_record, r[1]
+        else:
+            yield key, left_record, None
+    # Check the rest of the right stream too.
+    for _ in right:
+        pass
 
-        for key in self.csg['results'].keys():
-            if 'passthrough_particles.cs' in self.csg['results'][key]['metafile']:
-                assert passthrough_file is not None
-                self.csg['results'][key]['metafile'] = '>' + passthrough_basename
-            elif 'particles.cs' in self.csg['results'][key]['metafile']:
-                self.csg['results'][key]['metafile'] = '>' + cs_basename
-            else:
-                sys.exit(f'Unknown metafile name in {key}: {self.csg["results"][key]["metafile"]}')
-            if 'num_items' in self.csg['results'][key].keys():
-                self.csg['results'][key]['num_items'] = num_items
 
-    def iloc(self, idxs):
-        """Fancy indexing.
+def reconcile_optics(optics_tables):
+    """Merge the optics tables of several star files into one, and renumber the optics groups.
 
-        Parameters
-        ----------
-        idxs : array-like
-            Indices to select.
+    Identical optics groups (all the labels except _rlnOpticsGroup, numbers compared as numbers) are merged into one group, e.g. the same session in two star files.
+    Groups with the same parameters but different names are kept separate, as they may have been split on purpose (e.g. by beam tilt classes).
+    Different groups with the same name are renamed to opticsGroup<new number>.
 
-        Returns
-        -------
-        CryoSPARCMetaData
-            New metadata object with the selected rows.
-        """
+    Parameters
+    ----------
+    optics_tables : list of pandas.DataFrame
+        Optics tables (data_optics blocks). They must have the same labels.
 
-        cs = self.cs[idxs]
-        if self.passthrough is not None:
-            passthrough = self.passthrough[idxs]
-        else:
-            passthrough = None
-        return self.__class__(self.csg, cs, passthrough)
+    Returns
+    -------
+    df_optics : pandas.DataFrame
+        Merged optics table, with the groups numbered from 1 in the order of appearance.
+    mappings : list of dict
+        Old to new _rlnOpticsGroup values, for each input table.
+    """
+
+    labels = list(optics_tables[0].columns)
+    for df in optics_tables[1:]:
+        assert set(df.columns) == set(labels), f'The optics tables have different labels: {labels} and {list(df.columns)}'
+    param_labels = [x for x in labels if x != '_rlnOpticsGroup']
+
+    def normalize(value):
+        try:
+            return float(value)
+        except ValueError:
+            return value
+
+    rows = []
+    params_to_group = {}
+    used_names = set()
+    mappings = []
+    for df in optics_tables:
+        mapping = {}
+        for _, row in df[labels].astype(str).iterrows():
+            params = tuple(normalize(row[x]) for x in param_labels)
+            if params not in params_to_group:
+                group = str(len(rows) + 1)
+                params_to_group[params] = group
+                new_row = row.copy()
+                new_row['_rlnOpticsGroup'] = group
+                if '_rlnOpticsGroupName' in labels:
+                    # Keep the original names unless they collide.
+                    if row['_rlnOpticsGroupName'] in used_names:
+                        new_row['_rlnOpticsGroupName'] = f'opticsGroup{group}'
+                    used_names.add(new_row['_rlnOpticsGroupName'])
+                rows.append(new_row)
+            mapping[row['_rlnOpticsGroup']] = params_to_group[params]
+        mappings.append(mapping)
+    return pd.DataFrame(rows, columns=labels).reset_index(drop=True), mappings
+
+
+def _format_chunk(df):
+    # Module level function, to be run in worker processes.
+    lines = RelionMetaData._format_rows(df)
+    if len(lines) == 0:
+        return ''
+    return '\n'.join(lines) + '\n'
+
+
+def _write_shard(outfile, df_data, df_optics, data_type, threads):
+    # Module level function, to be run in worker processes.
+    RelionMetaData(df_data, df_optics, data_type=data_type).write(outfile, threads=threads)
+
+
+def _arrow_to_df_data(table, categorical=True):
+    """Convert an Arrow table (or record batch) read from a Parquet file into a data block DataFrame."""
+
+    df = table.to_pandas()
+    for label in df.columns:
+        is_categorical = isinstance(df[label].dtype, pd.CategoricalDtype)
+        if categorical and label in CATEGORICAL_LABELS and not is_categorical:
+            df[label] = df[label].astype('category')
+        elif not categorical and is_categorical:
+            df[label] = df[label].astype(str)
+    return df
 
 
 class RelionMetaData:
@@ -351,159 +2667,291 @@ class RelionMetaData:
         self.starfile = starfile
         self.data_type = data_type
 
+    def __getstate__(self):
+        # Parse a lazily loaded data block, and drop the file handles, for pickling (e.g. by the metadata server).
+        state = self.__dict__.copy()
+        state['_df_data'] = self.df_data
+        state['_lazy_read'] = None
+        state.pop('_star', None)
+        state.pop('_parquet', None)
+        return state
+
+    @property
+    def df_data(self):
+        # Lazily loaded data block is parsed on the first access.
+        if self._df_data is None and self._lazy_read is not None:
+            self._df_data = self._lazy_read()
+            self._lazy_read = None
+        return self._df_data
+
+    @df_data.setter
+    def df_data(self, df_data):
+        self._df_data = df_data
+        self._lazy_read = None
+
     @classmethod
-    def load(cls, starfile):
+    def load(cls, starfile, categorical=True, lazy=False, usecols=None):
         """Load RELION metadata from a particle star file.
+        If the metadata server (c2r_server.py) is running, non-lazy loads are served from its cache.
         Parameters
         ----------
         starfile : string
-            star file
+            star file. Compressed star files (.star.gz, .star.zst, etc.) and Parquet files (.parquet) written by write are also accepted.
+        categorical : bool, optional
+            Store the labels in CATEGORICAL_LABELS as pandas Categorical. By default True
+        lazy : bool, optional
+            Parse the data block on the first access of df_data. The optics block and the data labels (data_labels()) are available without parsing it. By default False
+        usecols : list of strings, optional
+            Labels of the data block to parse and keep. Other labels are skipped by the parser, and requested labels not in the file are ignored. The optics block is always loaded entirely. By default None (all the labels)
         Returns
         -------
         RelionMetaData
             RelionMetaData class instance.
         """
 
-        with open(starfile, 'r') as f:
-            # Check RELION version
-            relion31 = None
-            for line in f:
-                words = line.strip().split()
-                if len(words) == 0:
-                    continue
-                elif words[0] == 'data_optics':
-                    relion31 = True
-                    break
-                elif words[0] == 'data_':
-                    relion31 = False
-                    break
-                elif words[0][0] == '#':
-                    # Comment line
-                    continue
-            assert relion31 is not None, f'The starfile {starfile} is invalid.'
-
-            data_type = None
-            if relion31:
-                for line in f:
-                    words = line.strip().split()
-                    if len(words) == 0:
-                        continue
-                    elif len(words) == 1 and words[0].startswith('data_'):
-                        data_type = words[0]
-                        break
-                assert data_type is not None, f'Could not determine the data type of this starfile.'
-
-        # Load starfile
-        if relion31:
-            df_data, df_optics = cls._load_relion31(starfile, data_type)
+        if not lazy:
+            # Parsed metadata kept by the metadata server (c2r_server.py), if it is running.
+            md = server_load('relion', starfile, categorical=categorical, usecols=usecols)
+            if md is not None:
+                return md
+
+        if is_parquet(starfile):
+            return cls._load_parquet(starfile, categorical, lazy, usecols)
+
+        star = StarFile(starfile)
+
+        # Check RELION version
+        first_block = star.nth_block(0)
+        assert first_block is not None, f'The starfile {starfile} is invalid.'
+        if first_block.name == 'data_optics':
+            # RELION 3.1
+            # Read the optics block before scanning the next block header, so that the file is read forward only.
+            df_optics = star.read('data_optics')
+            data_block = star.nth_block(1)
+            assert data_block is not None, f'Could not determine the data type of this starfile.'
+            data_type = data_block.name
         else:
-            df_data = cls._load_relion(starfile)
+            # RELION 2.x/3.0
+            data_type = None if first_block.name == 'data_' else first_block.name
+            data_block = first_block
             df_optics = None
-        return cls(df_data, df_optics, starfile, data_type)
+
+        categorical_labels = CATEGORICAL_LABELS if categorical else ()
+        md = cls(None, df_optics, starfile, data_type)
+        md._star = star
+        md._data_block = data_block.name
+        md._usecols = usecols
+        md._lazy_read = lambda: star.read(data_block.name, usecols=usecols, categorical_labels=categorical_labels)
+        if not lazy:
+            md.df_data
+            star.close()
+        return md
+
+    @classmethod
+    def _load_parquet(cls, infile, categorical=True, lazy=False, usecols=None):
+        """Load RELION metadata from a Parquet file written by write."""
+
+        _check_pyarrow(infile)
+        pf = pq.ParquetFile(infile)
+        metadata = _parquet_c2r_metadata(pf.schema_arrow, 'relion', infile)
+        df_optics = None
+        if metadata['optics'] is not None:
+            df_optics = pd.DataFrame(metadata['optics']['data'], columns=metadata['optics']['columns'], dtype=str)
+
+        md = cls(None, df_optics, infile, metadata['data_type'])
+        md._parquet = pf
+        md._usecols = usecols
+        md._lazy_read = lambda: _arrow_to_df_data(pf.read(columns=md.data_labels()), categorical)
+        if not lazy:
+            md.df_data
+        return md
 
     @classmethod
-    def _load_relion31(cls, starfile, data_type):
-        """Load RELION 3.1 style starfile
+    def load_rows(cls, starfile, rows=None, imgids=None, rm_uid=False, categorical=True, save_index=True):
+        """Load selected particles from a large star file with the seekable row index (StarRowIndex), without parsing the whole file.
+        Apart from the selected rows, only the optics block and the data block header are read, once the index exists.
         Parameters
         ----------
         starfile : string
-            RELION 3.1 style star file
-        data_type : string
-            'data_particles' or 'data_micrographs'
+            Uncompressed star file.
+        rows : array-like, optional
+            Row numbers (0-based) to load.
+        imgids : array-like, optional
+            Image ids to load, normalized with rm_uid. Image ids not in the file are skipped.
+        rm_uid : bool, optional
+            Remove the cryoSPARC UIDs from the image ids of starfile. By default False
+        categorical : bool, optional
+            Store the labels in CATEGORICAL_LABELS as pandas Categorical. By default True
+        save_index : bool, optional
+            Save a newly built row index as the sidecar file (see StarRowIndex.load). By default True
         Returns
         -------
-        df_data : pandas.DataFrame
-            dataframe containing data block
-        df_optics : pandas.DataFrame
-            dataframe containing optics group data block.
+        RelionMetaData
+            RelionMetaData class instance with the selected particles, in the requested order.
         """
 
-        with open(starfile, 'r') as f:
-            headers_optics, data_optics = cls._read_block(f, 'data_optics')
-            headers_data, data_data = cls._read_block(
-                f, data_type)
-        df_optics = pd.DataFrame(data_optics, columns=headers_optics)
-        df_data = pd.DataFrame(data_data, columns=headers_data)
-        return df_data, df_optics
+        assert (rows is None) != (imgids is None), 'Specify either rows or imgids.'
+        index = StarRowIndex.load(starfile, rm_uid=rm_uid, save=save_index)
+        # Reads the optics block and the data block header only.
+        md = cls.load(starfile, categorical=categorical, lazy=True)
+        md._star.close()
+        if rows is not None:
+            md.df_data = index.fetch_rows(rows, categorical=categorical)
+        else:
+            md.df_data, _ = index.fetch_imgids(imgids, categorical=categorical)
+        return md
 
-    @classmethod
-    def _load_relion(cls, starfile):
-        """Load RELION 2.x/3.0 style starfile
+    def iter_data_chunks(self, chunk_bytes=64 * 1024 * 1024, usecols=None, categorical=False):
+        """Stream the data block of a lazily loaded star file in chunks of rows, without loading it entirely.
         Parameters
         ----------
-        starfile : string
-            RELION 2.x/3.0 style starfile
-        Returns
-        -------
+        chunk_bytes : int, optional
+            Approximate size of the star file text parsed at once. By default 64 MiB
+        usecols : list of strings, optional
+            Labels to parse. By default None (all the labels)
+        categorical : bool, optional
+            Store the labels in CATEGORICAL_LABELS as pandas Categorical. Categories are not shared between the chunks. By default False
+        Yields
+        ------
         pandas.DataFrame
-            dataframe containing data block
+            Consecutive rows of the data block.
         """
 
-        with open(starfile, 'r') as f:
-            headers, data = cls._read_block(f, 'data_')
-        df = pd.DataFrame(data, columns=headers)
-        return df
-
-    @classmethod
-    def _read_block(cls, f, blockname):
-        """Read data block from starfile
-        Parameters
-        ----------
-        f : file-like object
-            File-like object of starfile
-        blockname : string
-            Data block name to read.
+        if getattr(self, '_parquet', None) is not None:
+            # Convert the approximate text size to a number of rows with the uncompressed Parquet size.
+            metadata = self._parquet.metadata
+            row_bytes = sum(metadata.row_group(i).total_byte_size for i in range(metadata.num_row_groups)) / max(metadata.num_rows, 1)
+            labels = self.data_labels() if usecols is None else [x for x in self.data_labels() if x in usecols]
+            for batch in self._parquet.iter_batches(batch_size=max(int(chunk_bytes / max(row_bytes, 1)), 1), columns=labels):
+                yield _arrow_to_df_data(batch, categorical)
+            return
+
+        assert self.starfile is not None and hasattr(self, '_star'), 'Only available for metadata loaded from a star file.'
+        categorical_labels = CATEGORICAL_LABELS if categorical else ()
+        yield from self._star.iter_chunks(self._data_block, chunk_bytes=chunk_bytes, usecols=usecols, categorical_labels=categorical_labels)
+
+    def data_labels(self):
+        """Metadata labels of the data block. Does not parse a lazily loaded data block.
         Returns
         -------
-        headers : list of strings
-            Metadata labels
-        body : ndarray
-            Metadatas
+        list of strings
+            Metadata labels.
         """
 
-        # Get to the block (data_, data_optics, data_particles, etc...)
-        for line in f:
-            if line.startswith(blockname):
-                break
-        # Get to header loop
-        for line in f:
-            if line.startswith('loop_'):
-                break
-        # Get list of column headers
-        headers = []
-        for line in f:
-            if line.startswith('_'):
-                headers.append(line.strip().split()[0])
-            else:
-                break
-        # All subsequent lines until empty line is the data block body
-        body = [line.strip().split()]
-        for line in f:
-            if line.strip() == '':
-                break
+        if self._df_data is None and self._lazy_read is not None:
+            if getattr(self, '_parquet', None) is not None:
+                labels = self._parquet.schema_arrow.names
             else:
-                body.append(line.strip().split())
-        body = np.array(body)
-
-        assert len(headers) == body.shape[1]
-        return headers, body
+                labels = self._star.labels(self._data_block)
+            if self._usecols is not None:
+                labels = [x for x in labels if x in self._usecols]
+            return labels
+        return list(self.df_data.columns)
 
-    def write(self, outfile):
+    def write(self, outfile, threads=0, shard_by=None, num_workers=1):
         """Save metadata in file
         Parameters
         ----------
         outfile : string
-            Output file name. Should be .star file.
+            Output file name. Should be .star file. Add .gz, .bz2, .xz or .zst extension (e.g. particles.star.zst) to compress it.
+            With .parquet extension, the data block is saved as typed Parquet columns (numeric labels as numbers, CATEGORICAL_LABELS dictionary-encoded), and the optics block in the schema metadata.
+        threads : int, optional
+            Number of compression threads (zstd only). -1 uses all the logical CPUs. By default 0
+        shard_by : string, optional
+            Write one file per value of this label (e.g. _rlnOpticsGroup, _rlnMicrographName or _rlnGroupName) instead of a single file.
+            The shards are named <root>.<number>_<value><ext> after outfile (e.g. particles.0001_mic_0001.star), and carry the optics groups of their particles only.
+            They are listed in the manifest file <root>.manifest.json. By default None
+        num_workers : int, optional
+            Number of worker processes. The shards are written in parallel with shard_by, otherwise the data block rows are formatted in parallel in chunks and written in order.
+            The output is identical to the serial one. -1 uses all the logical CPUs. By default 1
         """
 
-        with open(outfile, 'w') as f:
+        if num_workers < 0:
+            num_workers = os.cpu_count()
+
+        if shard_by is not None:
+            self._write_shards(outfile, shard_by, threads, num_workers)
+            return
+
+        if is_parquet(outfile):
+            self._write_parquet(outfile)
+            return
+
+        with open_star(outfile, 'w', threads=threads) as f:
             if self.df_optics is not None:
                 self._write_block(f, 'data_optics', self.df_optics)
-                self._write_block(f, self.data_type, self.df_data)
+                self._write_block(f, self.data_type, self.df_data, num_workers)
             else:
-                self._write_block(f, 'data_', self.df_data)
-
-    def _write_block(self, f, blockname, df):
+                self._write_block(f, self.data_type or 'data_', self.df_data, num_workers)
+
+    def _write_shards(self, outfile, shard_by, threads=0, num_workers=1):
+        """Write one file per value of the shard_by label, and the manifest file."""
+
+        assert shard_by in self.df_data.columns, f'{shard_by} is not in the data block.'
+        root, ext = re.match(r'(.*?)((\.star|\.parquet|\.pq)?(\.gz|\.bz2|\.xz|\.zst)?)$', outfile).groups()[:2]
+        outdir = os.path.dirname(outfile)
+
+        shards = []
+        jobs = []
+        groups = self.df_data.groupby(shard_by, observed=True, sort=True).indices
+        for i, (key, idxs) in enumerate(groups.items()):
+            # File name friendly value, e.g. mic_0001 for MotionCorr/job003/movies/mic_0001.mrc
+            name = re.sub(r'[^A-Za-z0-9_.-]+', '_', os.path.splitext(os.path.basename(str(key)))[0])
+            shard_file = f'{root}.{i + 1:04d}_{name}{ext}'
+            df_data = self.df_data.iloc[idxs]
+            # assign returns a new frame, instead of writing into the slice of self.df_data.
+            df_data = df_data.assign(**{label: values.cat.remove_unused_categories() for label, values in df_data.items() if isinstance(values.dtype, pd.CategoricalDtype)})
+            df_optics = self.df_optics
+            if df_optics is not None and '_rlnOpticsGroup' in df_data.columns:
+                df_optics = df_optics[df_optics['_rlnOpticsGroup'].isin(df_data['_rlnOpticsGroup'].astype(str).unique())]
+            shards.append({
+                'key': str(key),
+                'file': os.path.relpath(shard_file, outdir or '.'),
+                'num_particles': len(df_data),
+                'optics_groups': [] if df_optics is None else df_optics['_rlnOpticsGroup'].tolist(),
+            })
+            jobs.append((shard_file, df_data, df_optics, self.data_type, threads))
+
+        if num_workers > 1:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+                for future in [executor.submit(_write_shard, *job) for job in jobs]:
+                    future.result()
+        else:
+            for job in jobs:
+                _write_shard(*job)
+
+        manifest = {
+            'source': self.starfile,
+            'shard_by': shard_by,
+            'num_particles': len(self.df_data),
+            'shards': shards,
+        }
+        with open(root + '.manifest.json', 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+    def _write_parquet(self, outfile):
+        """Save metadata in a Parquet file."""
+
+        _check_pyarrow(outfile)
+        columns = {}
+        for label in self.df_data.columns:
+            values = self.df_data[label]
+            if label in CATEGORICAL_LABELS:
+                values = values.astype('category')
+            elif not isinstance(values.dtype, pd.CategoricalDtype):
+                try:
+                    values = pd.to_numeric(values)
+                except (ValueError, TypeError):
+                    pass
+            columns[label] = pa.array(values)
+
+        optics = None
+        if self.df_optics is not None:
+            optics = {'columns': list(self.df_optics.columns), 'data': self.df_optics.astype(str).values.tolist()}
+        metadata = {'kind': 'relion', 'data_type': self.data_type, 'optics': optics}
+        _write_parquet(outfile, pa.table(columns), metadata)
+
+    def _write_block(self, f, blockname, df, num_workers=1, chunk_size=100000):
         """Write data block as star format
         Parameters
         ----------
@@ -513,17 +2961,284 @@ class RelionMetaData:
             Data block name (e.g. data_optics)
         df : pandas.DataFrame
             DataFrame containing metadata labels and metadatas
+        num_workers : int, optional
+            Number of worker processes formatting the rows. By default 1
+        chunk_size : int, optional
+            Number of rows formatted by a worker at once. By default 100000
+        """
+
+        self._write_block_header(f, blockname, df.columns)
+        if num_workers > 1 and len(df) > chunk_size:
+            # Keep a bounded number of chunks in flight, and write them in submission order.
+            with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+                futures = collections.deque()
+                for start in range(0, len(df), chunk_size):
+                    futures.append(executor.submit(_format_chunk, df.iloc[start:start + chunk_size]))
+                    if len(futures) >= 2 * num_workers:
+                        f.write(futures.popleft().result())
+                while futures:
+                    f.write(futures.popleft().result())
+        else:
+            f.write(_format_chunk(df))
+        f.write('\n')
+
+    def _write_block_header(self, f, blockname, labels):
+        """Write data block name and metadata labels
+        Parameters
+        ----------
+        f : File-like object
+            Star file object
+        blockname : string
+            Data block name (e.g. data_optics)
+        labels : list of strings
+            Metadata labels
         """
 
         f.write(blockname.strip())
         f.write('\n\n')
         f.write('loop_\n')
-        f.write('\n'.join(df.columns))
+        f.write('\n'.join(labels))
         f.write('\n')
-        for i in df.index:
-            f.write(' '.join(df.loc[i]))
+
+    def write_header(self, f, labels):
+        """Write the optics block (if any) and the data block header, to stream the data rows afterwards.
+        The rows are written as space-separated lines, followed by an empty line at the end of the block.
+        Parameters
+        ----------
+        f : File-like object
+            Star file object opened by open_star.
+        labels : list of strings
+            Metadata labels of the data block.
+        """
+
+        if self.df_optics is not None:
+            self._write_block(f, 'data_optics', self.df_optics)
+            self._write_block_header(f, self.data_type, labels)
+        else:
+            self._write_block_header(f, self.data_type or 'data_', labels)
+
+    @staticmethod
+    def _format_rows(df):
+        """Format data block rows as star format lines
+        Parameters
+        ----------
+        df : pandas.DataFrame
+            DataFrame containing metadatas
+        Returns
+        -------
+        list of strings
+            One line per row, without line breaks.
+        """
+
+        columns = []
+        for label in df.columns:
+            values = df[label]
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                # Format the categories only, and look them up with the codes.
+                # Missing values (code -1) are written as 'nan', as astype(str) of the other columns did before pandas 3, instead of wrapping around to the last category.
+                categories = np.array(values.cat.categories.astype(str), dtype=object)
+                categories = np.append(categories, 'nan')
+                codes = values.cat.codes.to_numpy()
+                columns.append(categories[np.where(codes < 0, len(categories) - 1, codes)])
+            else:
+                column = values.astype(str).to_numpy(dtype=object)
+                missing = values.isna().to_numpy()
+                if missing.any():
+                    column[missing] = 'nan'
+                columns.append(column)
+        return [' '.join(row) for row in zip(*columns)]
+
+    def image_name_parts(self):
+        """Split _rlnImageName into particle indices and dictionary-encoded stack file names.
+        Returns
+        -------
+        idxs : ndarray
+            1-based particle indices.
+        stacks : pandas.Categorical
+            Stack file names.
+        """
+
+        return split_imgnames(self.df_data['_rlnImageName'])
+
+    @classmethod
+    def merge(cls, starfiles, outfile, dedup=False, rm_uid=False, threads=0, chunk_bytes=64 * 1024 * 1024):
+        """Merge star files into one, streaming the data blocks without loading them entirely.
+        The optics tables are reconciled with reconcile_optics, and _rlnOpticsGroup of the particles is renumbered accordingly.
+        Only the data labels found in all the star files are written.
+        Parameters
+        ----------
+        starfiles : list of strings
+            Input star files.
+        outfile : string
+            Output star file.
+        dedup : bool, optional
+            Write only the first occurrence of each image (by the normalized image id). By default False
+        rm_uid : bool, optional
+            Remove the cryoSPARC UIDs from the image names for dedup. By default False
+        threads : int, optional
+            Number of compression threads (zstd only). By default 0
+        chunk_bytes : int, optional
+            Approximate size of the star file text parsed at once. By default 64 MiB
+        Returns
+        -------
+        list of tuples
+            (number of particles, number of written particles) of each input.
+        """
+
+        mds = [cls.load(x, lazy=True) for x in starfiles]
+        data_types = set(md.data_type for md in mds)
+        assert len(data_types) == 1, f'The star files have different data blocks: {data_types}'
+        has_optics = [md.df_optics is not None for md in mds]
+        assert all(has_optics) or not any(has_optics), 'Star files with and without the optics block cannot be merged.'
+
+        if mds[0].df_optics is not None:
+            df_optics, mappings = reconcile_optics([md.df_optics for md in mds])
+        else:
+            df_optics, mappings = None, [None] * len(mds)
+
+        labels = mds[0].data_labels()
+        for md in mds[1:]:
+            labels = [x for x in labels if x in md.data_labels()]
+
+        keeps = [None] * len(mds)
+        if dedup:
+            # First pass over the image names only: keep the first occurrence of each key.
+            codebook = ImageKeyCodebook()
+            keys = []
+            for md in mds:
+                chunks = [codebook.keys(*split_imgnames(df['_rlnImageName']), rm_uid=rm_uid) for df in md.iter_data_chunks(chunk_bytes=chunk_bytes, usecols=['_rlnImageName'])]
+                keys.append(np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.uint64))
+            all_keys = np.concatenate(keys)
+            keep = np.zeros(len(all_keys), dtype=bool)
+            keep[np.unique(all_keys, return_index=True)[1]] = True
+            keeps = np.split(keep, np.cumsum([len(x) for x in keys])[:-1])
+
+        md_out = cls(None, df_optics, outfile, mds[0].data_type)
+        counts = []
+        with open_star(outfile, 'w', threads=threads) as f:
+            md_out.write_header(f, labels)
+            for md, mapping, keep in zip(mds, mappings, keeps):
+                n = 0
+                num_written = 0
+                for df in md.iter_data_chunks(chunk_bytes=chunk_bytes, usecols=labels):
+                    num_rows = len(df)
+                    df = df[labels]
+                    if keep is not None:
+                        df = df[keep[n:n + num_rows]]
+                    n += num_rows
+                    if mapping is not None and '_rlnOpticsGroup' in labels:
+                        groups = df['_rlnOpticsGroup'].astype('category')
+                        missing = set(groups.cat.categories) - mapping.keys()
+                        assert len(missing) == 0, f'Optics groups {sorted(missing)} of {md.starfile} are not in its optics block.'
+                        df = df.assign(_rlnOpticsGroup=remap_categories(groups, mapping))
+                    f.write(_format_chunk(df))
+                    num_written += len(df)
+                counts.append((n, num_written))
             f.write('\n')
-        f.write('\n')
+        return counts
+
+    def image_keys(self, codebook, rm_uid=False, rm_ext=False):
+        """Integer image keys of the particles (see ImageKeyCodebook).
+        Parameters
+        ----------
+        codebook : ImageKeyCodebook
+            Codebook shared with the metadata to be compared.
+        rm_uid : bool, optional
+            Remove the cryoSPARC UIDs from the stack names. By default False
+        rm_ext : bool, optional
+            Remove the file extension from the stack names. By default False
+        Returns
+        -------
+        ndarray
+            Image keys. dtype=uint64
+        """
+
+        idxs, stacks = self.image_name_parts()
+        return codebook.keys(idxs, stacks, rm_uid=rm_uid, rm_ext=rm_ext)
+
+    def particle_positions(self, angpix=None):
+        """Particle centers in the micrographs in Angstrom, i.e. the picked coordinates corrected by the origin shifts.
+        Parameters
+        ----------
+        angpix : float, optional
+            Pixel size of the coordinates in Angstrom. By default None (_rlnMicrographPixelSize of the optics groups)
+        Returns
+        -------
+        x, y : ndarray
+            Particle centers.
+        """
+
+        df = self.df_data
+        if angpix is None:
+            assert self.df_optics is not None, 'The pixel size is required for star files without the optics block.'
+            # _rlnImagePixelSize is of the extracted particles, which may be binned, while the coordinates are in the micrograph pixels.
+            assert '_rlnMicrographPixelSize' in self.df_optics.columns, 'The pixel size of the coordinates is required, as the optics block has no _rlnMicrographPixelSize.'
+            pixel_sizes = dict(zip(self.df_optics['_rlnOpticsGroup'].astype(str), self.df_optics['_rlnMicrographPixelSize'].astype(float)))
+            groups = df['_rlnOpticsGroup'].astype('category')
+            missing = set(groups.cat.categories.astype(str)) - pixel_sizes.keys()
+            assert len(missing) == 0, f'Optics groups {sorted(missing)} are not in the optics block.'
+            angpix = remap_categories(groups, pixel_sizes).astype(float).to_numpy()
+
+        x = df['_rlnCoordinateX'].astype(float).to_numpy() * angpix
+        y = df['_rlnCoordinateY'].astype(float).to_numpy() * angpix
+        if '_rlnOriginXAngst' in df.columns:
+            x = x - df['_rlnOriginXAngst'].astype(float).to_numpy()
+            y = y - df['_rlnOriginYAngst'].astype(float).to_numpy()
+        elif '_rlnOriginX' in df.columns:
+            x = x - df['_rlnOriginX'].astype(float).to_numpy() * angpix
+            y = y - df['_rlnOriginY'].astype(float).to_numpy() * angpix
+        return x, y
+
+    def find_duplicates(self, min_distance, score_label=None, lower_is_better=False, angpix=None, num_workers=1):
+        """Find the particles closer than min_distance to a better particle of the same micrograph.
+        The particles are kept greedily from the best one, as in RELION's duplicate removal.
+        Parameters
+        ----------
+        min_distance : float
+            Minimum inter-particle distance in Angstrom.
+        score_label : string, optional
+            Label to rank the particles (e.g. _rlnMaxValueProbDistribution or _rlnAutopickFigureOfMerit). By default None (the first particle in the star file is kept)
+        lower_is_better : bool, optional
+            Keep the particles with the lowest score_label instead. By default False
+        angpix : float, optional
+            Pixel size of the coordinates in Angstrom. By default None (_rlnMicrographPixelSize of the optics groups)
+        num_workers : int, optional
+            Number of worker processes, each processing a part of the micrographs. -1 uses all the logical CPUs. By default 1
+        Returns
+        -------
+        ndarray
+            Boolean mask of the duplicated particles.
+        """
+
+        x, y = self.particle_positions(angpix)
+        n = len(x)
+        mics = self.df_data['_rlnMicrographName']
+        if isinstance(mics.dtype, pd.CategoricalDtype):
+            mic_codes = mics.cat.codes.to_numpy().astype(np.int64)
+        else:
+            mic_codes = pd.factorize(mics)[0].astype(np.int64)
+
+        # Rank of each particle, ties broken by the row order.
+        if score_label is None:
+            priority = np.arange(n)
+        else:
+            score = self.df_data[score_label].astype(float).to_numpy()
+            order = np.lexsort((np.arange(n), score if lower_is_better else -score))
+            priority = np.empty(n, dtype=np.int64)
+            priority[order] = np.arange(n)
+
+        if num_workers < 0:
+            num_workers = os.cpu_count()
+        if num_workers <= 1:
+            return ~_nms_groups(mic_codes, x, y, min_distance, priority)
+
+        keep = np.zeros(n, dtype=bool)
+        parts = [np.flatnonzero(mic_codes % num_workers == k) for k in range(num_workers)]
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = [executor.submit(_nms_groups, mic_codes[idxs], x[idxs], y[idxs], min_distance, priority[idxs]) for idxs in parts]
+            for idxs, future in zip(parts, futures):
+                keep[idxs] = future.result()
+        return ~keep
 
     def iloc(self, idxs):
         """Fancy indexing.
@@ -540,4 +3255,256 @@ class RelionMetaData:
         df_data_new = self.df_data.iloc[idxs]
         return self.__class__(df_data=df_data_new,
                               df_optics=self.df_optics,
-                              data_type=self.data_type)
\ No newline at end of file
+                              data_type=self.data_type)
+
+
+# Set in the metadata server process, which loads the metadata itself.
+_in_server = False
+
+
+def server_socket_path():
+    """Unix socket path of the metadata server. C2R_SERVER_SOCKET environment variable overrides the default path, and 'none' disables the server."""
+
+    return os.environ.get('C2R_SERVER_SOCKET', os.path.join(tempfile.gettempdir(), f'c2r-server-{os.getuid()}.sock'))
+
+
+def server_timeout():
+    """Seconds to wait for a response of the metadata server, before loading locally. C2R_SERVER_TIMEOUT environment variable overrides the default (600)."""
+
+    return float(os.environ.get('C2R_SERVER_TIMEOUT', 600))
+
+
+def _send_message(sock, obj):
+    data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+    sock.sendall(struct.pack('<Q', len(data)))
+    sock.sendall(data)
+
+
+def _recv_exact(sock, size):
+    buf = bytearray(size)
+    view = memoryview(buf)
+    pos = 0
+    while pos < size:
+        n = sock.recv_into(view[pos:], size - pos)
+        if n == 0:
+            raise ConnectionError('Connection closed by the peer.')
+        pos += n
+    return buf
+
+
+def _recv_message(sock):
+    size = struct.unpack('<Q', _recv_exact(sock, 8))[0]
+    return pickle.loads(_recv_exact(sock, size))
+
+
+def server_request(request, socket_path=None):
+    """Send a request to the metadata server.
+
+    Parameters
+    ----------
+    request : dict
+        Request. 'op' is 'load', 'stats', 'clear' or 'shutdown'.
+
+    socket_path : string, optional
+        Server socket. By default None (server_socket_path())
+
+    Returns
+    -------
+    object
+        Response of the server, or None if the server is not running or does not respond within server_timeout().
+    """
+
+    socket_path = socket_path or server_socket_path()
+    if socket_path == 'none' or not os.path.exists(socket_path):
+        return None
+    # Only talk to a server of the same user, as the responses are unpickled.
+    if os.stat(socket_path).st_uid != os.getuid():
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            # A stale socket or a server stuck before accepting fails fast.
+            sock.settimeout(5)
+            sock.connect(socket_path)
+            sock.settimeout(server_timeout())
+            _send_message(sock, request)
+            response = _recv_message(sock)
+    except socket.timeout:
+        print(f'WARNING: The metadata server ({socket_path}) did not respond in time, and is not used.', file=sys.stderr)
+        return None
+    except (ConnectionError, OSError):
+        return None
+    if not response['ok']:
+        raise RuntimeError(f'Metadata server error: {response["error"]}')
+    return response['result']
+
+
+def server_load(kind, path, **kwargs):
+    """Load metadata through the metadata server, if it is running.
+
+    Parameters
+    ----------
+    kind : string
+        'relion' or 'cryosparc'.
+
+    path : string
+        File to load.
+
+    **kwargs
+        Arguments of RelionMetaData.load or CryoSPARCMetaData.load.
+
+    Returns
+    -------
+    RelionMetaData, CryoSPARCMetaData or None
+        Loaded metadata, or None if the server is not running.
+    """
+
+    if _in_server:
+        return None
+    return server_request({'op': 'load', 'kind': kind, 'path': os.path.abspath(path), 'kwargs': kwargs})
+
+
+class MetadataServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Local server keeping parsed metadata in memory between tool invocations.
+
+    Loaded RelionMetaData and CryoSPARCMetaData objects are kept in an LRU cache within a memory budget, and reloaded when the files are modified.
+
+    Parameters
+    ----------
+    socket_path : string
+        Unix socket path.
+
+    max_memory : int
+        Memory budget of the cache in bytes.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, max_memory):
+        self.max_memory = max_memory
+        self.cache = collections.OrderedDict()
+        self.cache_size = 0
+        self.hits = 0
+        self.misses = 0
+        # The lock guards the cache only. Files are loaded outside of it, once per key, and concurrent requests of the same key wait for the same future.
+        self.lock = threading.Lock()
+        self.loading = {}
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        old_umask = os.umask(0o177)
+        try:
+            super().__init__(socket_path, _MetadataRequestHandler)
+        finally:
+            os.umask(old_umask)
+
+    @staticmethod
+    def _signature(kind, path):
+        """Sizes and mtimes of the files of the metadata."""
+
+        files = [path]
+        if kind == 'cryosparc' and not is_parquet(path):
+            files = [resolve_csg(path)]
+            files += [x for x in get_metafiles_from_csg(files[0]) if x]
+        signature = []
+        for x in files:
+            stat = os.stat(x)
+            signature.append((x, stat.st_mtime_ns, stat.st_size))
+        return tuple(signature)
+
+    @staticmethod
+    def _nbytes(md):
+        if isinstance(md, CryoSPARCMetaData):
+            return md.cs.nbytes + (md.passthrough.nbytes if md.passthrough is not None else 0)
+        nbytes = int(md.df_data.memory_usage(deep=True).sum())
+        if md.df_optics is not None:
+            nbytes += int(md.df_optics.memory_usage(deep=True).sum())
+        return nbytes
+
+    def load(self, kind, path, kwargs):
+        """Cached RelionMetaData.load or CryoSPARCMetaData.load."""
+
+        key = (kind, path, tuple(sorted((x, tuple(y) if isinstance(y, list) else y) for x, y in kwargs.items())))
+        signature = self._signature(kind, path)
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is not None and entry[0] == signature:
+                self.hits += 1
+                self.cache.move_to_end(key)
+                return entry[1]
+            future = self.loading.get(key)
+            waiting = future is not None
+            if waiting:
+                self.hits += 1
+            else:
+                self.misses += 1
+                if entry is not None:
+                    # The files were modified.
+                    self.cache_size -= entry[2]
+                    del self.cache[key]
+                future = self.loading[key] = concurrent.futures.Future()
+        if waiting:
+            # Another request is loading the same metadata.
+            return future.result()
+
+        try:
+            cls = RelionMetaData if kind == 'relion' else CryoSPARCMetaData
+            md = cls.load(path, **kwargs)
+            nbytes = self._nbytes(md)
+        except BaseException as e:
+            with self.lock:
+                del self.loading[key]
+            future.set_exception(e)
+            raise
+
+        with self.lock:
+            del self.loading[key]
+            if nbytes <= self.max_memory:
+                self.cache[key] = (signature, md, nbytes)
+                self.cache_size += nbytes
+                while self.cache_size > self.max_memory:
+                    _, (_, _, evicted) = self.cache.popitem(last=False)
+                    self.cache_size -= evicted
+        future.set_result(md)
+        return md
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': [(x[0], x[1], entry[2]) for x, entry in self.cache.items()],
+                'cache_size': self.cache_size,
+                'max_memory': self.max_memory,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+            self.cache_size = 0
+
+
+class _MetadataRequestHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        try:
+            request = _recv_message(self.request)
+        except (ConnectionError, OSError):
+            return
+        try:
+            if request['op'] == 'load':
+                result = self.server.load(request['kind'], request['path'], request['kwargs'])
+            elif request['op'] == 'stats':
+                result = self.server.stats()
+            elif request['op'] == 'clear':
+                result = self.server.clear()
+            elif request['op'] == 'shutdown':
+                threading.Thread(target=self.server.shutdown).start()
+                result = None
+            else:
+                raise ValueError(f'Unknown operation: {request["op"]}')
+            response = {'ok': True, 'result': result}
+        except (Exception, SystemExit) as e:
+            response = {'ok': False, 'error': f'{type(e).__name__}: {e}'}
+        try:
+            _send_message(self.request, response)
+        except (ConnectionError, OSError):
+            pass
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""Bin particles of a cryoSPARC 3D variability job along the variability components, and write one RELION star file per bin (e.g. for per-state refinement).
+
+Particles are binned by quantiles of the chosen components (equally populated bins per component), or by cluster labels given in a file (e.g. from 3D variability display clustering).
+With several components, the bins are the combinations of the per-component bins.
+The inputs are loaded once, and all the subsets are written from the in-memory metadata. cryoSPARC .cs subsets can be written too.
+"""
+
+import sys
+import os
+import argparse
+
+import numpy as np
+import pandas as pd
+
+import c2r
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description=__doc__
+    )
+    parser.add_argument('--csparc_csg', type=str, required=True, help='cryoSPARC particles .csg file of the 3D variability job.')
+    parser.add_argument('--relion_star', type=str, required=True, help='RELION star file containing the particles of --csparc_csg.')
+    parser.add_argument('--outdir', type=str, required=True, help='Output directory.')
+    parser.add_argument('--out_rootname', type=str, default='particles', help='Output file rootname. The star files are named <out_rootname>_<bin>.star')
+    parser.add_argument('--components', type=int, nargs='+', default=[0], help='Variability components (0-based) to bin along.')
+    parser.add_argument('--num_bins', type=int, default=5, help='Number of quantile bins per component.')
+    parser.add_argument('--labels', type=str, help='Text (one integer per line) or .npy file of cluster labels, one per particle of --csparc_csg in the same order. Overrides --components and --num_bins.')
+    parser.add_argument('--relion_remove_uid', action='store_true', help='Remove the cryoSPARC UIDs from the image names of --relion_star too.')
+    parser.add_argument('--write_cs', action='store_true', help='Also write the cryoSPARC particles of each bin (<out_rootname>_<bin>_particles.csg).')
+    args = parser.parse_args()
+
+    print('##### Command #####\n\t' + ' '.join(sys.argv))
+    args_print_str = '##### Input parameters #####\n'
+    for opt, val in vars(args).items():
+        args_print_str += '\t{} : {}\n'.format(opt, val)
+    print(args_print_str)
+    return args
+
+
+def quantile_bins(z, num_bins):
+    """Bin values into equally populated bins.
+
+    Parameters
+    ----------
+    z : ndarray
+        Values. shape=(num_samples,)
+
+    num_bins : int
+        Number of bins.
+
+    Returns
+    -------
+    bins : ndarray
+        Bin index of each value (0 to num_bins - 1).
+
+    edges : ndarray
+        Bin edges. shape=(num_bins + 1,)
+    """
+
+    edges = np.quantile(z, np.linspace(0, 1, num_bins + 1))
+    bins = np.searchsorted(edges[1:-1], z, side='right')
+    return bins, edges
+
+
+def main():
+    args = parse_args()
+
+    print(f'Loading {args.csparc_csg}...')
+    md_cs = c2r.CryoSPARCMetaData.load(args.csparc_csg)
+    print(f'Loading {args.relion_star}...')
+    md_relion = c2r.RelionMetaData.load(args.relion_star)
+
+    print('Matching the particles...')
+    codebook = c2r.ImageKeyCodebook()
+    cs_ids = md_cs.image_keys(codebook, rm_uid=True)
+    relion_ids = md_relion.image_keys(codebook, rm_uid=args.relion_remove_uid)
+    c2r.preflight_imgids(cs_ids, relion_ids, args.csparc_csg, args.relion_star, require='subset', codebook=codebook)
+    relion_idxs = pd.Index(relion_ids).get_indexer(cs_ids)
+
+    print('Binning the particles...')
+    if args.labels is not None:
+        if args.labels.endswith('.npy'):
+            labels = np.load(args.labels)
+        else:
+            labels = np.loadtxt(args.labels, dtype=int, ndmin=1)
+        assert len(labels) == len(md_cs.cs), f'The number of labels ({len(labels)}) differs from the number of particles ({len(md_cs.cs)}).'
+        bin_ids = labels.astype(int)
+        bin_names = {x: f'label{x}' for x in np.unique(bin_ids)}
+    else:
+        Z = c2r.get_latent_variables(md_cs.cs)
+        assert max(args.components) < Z.shape[1], f'{args.csparc_csg} has only {Z.shape[1]} components.'
+        per_component = []
+        for k in args.components:
+            bins, edges = quantile_bins(Z[:, k], args.num_bins)
+            print(f'\tComponent {k} bin edges: ' + ' '.join(f'{x:.4g}' for x in edges))
+            per_component.append(bins)
+        # Combined bin index of the per-component bins.
+        bin_ids = np.ravel_multi_index(per_component, [args.num_bins] * len(args.components))
+        bin_names = {}
+        for x in np.unique(bin_ids):
+            parts = np.unravel_index(x, [args.num_bins] * len(args.components))
+            bin_names[x] = '_'.join(f'c{k}b{b}' for k, b in zip(args.components, parts))
+
+    # Particles of each bin, in one sort.
+    order = np.argsort(bin_ids, kind='stable')
+    sorted_ids = bin_ids[order]
+    starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]])
+    ends = np.r_[starts[1:], len(order)]
+
+    os.makedirs(args.outdir, exist_ok=True)
+    print('Writing the subsets...')
+    for start, end in zip(starts, ends):
+        idxs = order[start:end]
+        name = f'{args.out_rootname}_{bin_names[sorted_ids[start]]}'
+        out_star = os.path.join(args.outdir, name + '.star')
+        md_relion.iloc(relion_idxs[idxs]).write(out_star)
+        if args.write_cs:
+            md_cs.iloc(idxs).write(args.outdir, name)
+        print(f'\t{out_star} : {len(idxs)} particles')
+
+
+if __name__ == '__main__':
+    main()
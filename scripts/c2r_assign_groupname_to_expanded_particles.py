@@ -6,7 +6,6 @@ import argparse
 
 import numpy as np
 import pandas as pd
-from tqdm import tqdm
 
 import c2r
 
@@ -21,6 +20,9 @@ def parse_args():
     parser.add_argument('--csparc_csg', type=str, required=True, help='The cryoSPARC .csg file of the same cryoSPARC job as --csparc_star.')
     parser.add_argument('--csparc_orig_csg', type=str, required=True, help='A cryoSPARC .csg file of a refinement job before symmetry expansion is applied.')
     parser.add_argument('--out_star', type=str, required=True, help='Output star file name.')
+    parser.add_argument('--num_workers', type=int, default=1, help='Number of worker processes formatting the output star file. -1 uses all the logical CPUs.')
+    parser.add_argument('--max_memory', type=float, help='Memory budget in MiB. If specified, the particles are sorted by the source image id on scratch files and merge-joined with --relion_star, for datasets larger than RAM. The output particles are then sorted by the source image id.')
+    parser.add_argument('--tmpdir', type=str, help='Scratch directory for --max_memory. Preferably on a local disk. By default the system temporary directory.')
     args = parser.parse_args()
     print('##### Command #####\n\t' + ' '.join(sys.argv))
     args_print_str = '##### Input parameters #####\n'
@@ -30,12 +32,74 @@ def parse_args():
     return args
 
 
+def assign_groupname_external(args):
+    """Sort-merge join version of main(), with memory bounded by args.max_memory (in addition to the pre-expansion uids)."""
+
+    max_memory = int(args.max_memory * 1024 * 1024)
+    chunk_bytes = max(max_memory // 8, 1024 * 1024)
+
+    md_gr_src = c2r.RelionMetaData.load(args.relion_star, lazy=True)
+    assert '_rlnImageName' in md_gr_src.data_labels(), f'_rlnImageName does not exist in {args.relion_star}'
+    assert '_rlnGroupNumber' in md_gr_src.data_labels(), f'_rlnGroupNumber does not exist in {args.relion_star}'
+    # The .cs files are memory-mapped and read chunk by chunk.
+    md_cs = c2r.CryoSPARCMetaData.load(args.csparc_csg, mmap=True)
+    md_cs_star = c2r.RelionMetaData.load(args.csparc_star, lazy=True)
+    md_cs_orig = c2r.CryoSPARCMetaData.load(args.csparc_orig_csg, mmap=True)
+    assert len(md_cs.cs) == len(md_cs.passthrough), f'The number of records differs between {args.csparc_csg}:cs and {args.csparc_csg}:passthrough'
+    uids_orig = pd.Index(md_cs_orig.cs['uid'])
+
+    md_out = c2r.RelionMetaData(
+        df_data=None, df_optics=md_cs_star.df_optics,
+        data_type='data_particles'
+    )
+    out_cols = md_cs_star.data_labels()
+    if '_rlnGroupNumber' not in out_cols:
+        out_cols.append('_rlnGroupNumber')
+    gr_idx = out_cols.index('_rlnGroupNumber')
+
+    with c2r.ExternalSorter(max_memory // 2, args.tmpdir) as sorter_cs, c2r.ExternalSorter(max_memory // 2, args.tmpdir) as sorter_gr:
+        print(f'Sorting {args.csparc_star} by the source image id...')
+        n = 0
+        for df in md_cs_star.iter_data_chunks(chunk_bytes):
+            cs = md_cs.cs[n:n + len(df)]
+            assert len(cs) == len(df), f'The number of records differs between {args.csparc_star} and {args.csparc_csg}:cs.'
+            c2r.preflight_imgids(c2r.cs_to_imgids(cs), c2r.df_data_to_imgids(df), f'{args.csparc_csg}:cs (from row {n})', f'{args.csparc_star} (from row {n})')
+            idxs = uids_orig.get_indexer(md_cs.passthrough['sym_expand/src_uid'][n:n + len(df)])
+            assert np.all(idxs >= 0), f'Some of sym_expand/src_uid could not be found in {args.csparc_orig_csg}'
+            imgids = c2r.cs_to_imgids(md_cs_orig.cs[idxs], rm_uid=True, rm_ext=True)
+            sorter_cs.add(imgids, md_out._format_rows(df))
+            n += len(df)
+        assert n == len(md_cs.cs), f'The number of records differs between {args.csparc_star} and {args.csparc_csg}:cs.'
+
+        print(f'Sorting {args.relion_star} by image id...')
+        for df in md_gr_src.iter_data_chunks(chunk_bytes, usecols=['_rlnImageName', '_rlnGroupNumber']):
+            sorter_gr.add(c2r.df_data_to_imgids(df, rm_uid=True, rm_ext=True), df['_rlnGroupNumber'])
+
+        print('Resolving _rlnGroupNumber...')
+        with c2r.open_star(args.out_star, 'w') as f:
+            md_out.write_header(f, out_cols)
+            for imgid, row, gr in c2r.merge_join(sorter_cs, sorter_gr):
+                if gr is None:
+                    print(f'imgid {imgid} could not be found from source star file.')
+                    raise KeyError(imgid)
+                words = row.split(' ')
+                words.extend([''] * (len(out_cols) - len(words)))
+                words[gr_idx] = gr
+                f.write(' '.join(words))
+                f.write('\n')
+            f.write('\n')
+
+
 def main():
     args = parse_args()
 
+    if args.max_memory is not None:
+        assign_groupname_external(args)
+        return
+
     # The _rlnGroupName source.
     print(f'Loading {args.relion_star}...')
-    md_gr_src = c2r.RelionMetaData.load(args.relion_star)
+    md_gr_src = c2r.RelionMetaData.load(args.relion_star, usecols=('_rlnImageName', '_rlnGroupNumber'))
     assert '_rlnImageName' in md_gr_src.df_data.columns, f'_rlnImageName does not exist in {args.relion_star}'
     assert '_rlnGroupNumber' in md_gr_src.df_data.columns, f'_rlnGroupNumber does not exist in {args.relion_star}'
 
@@ -45,9 +109,10 @@ def main():
     # cryoSPARC starfile of the expanded particles
     print(f'Loading {args.csparc_star}...')
     md_cs_star = c2r.RelionMetaData.load(args.csparc_star)
-    assert np.all(c2r.cs_to_imgids(md_cs.cs) == c2r.df_data_to_imgids(md_cs_star.df_data)), f'The particle ordering is different between {args.csparc_csg}:cs and {args.csparc_star}'
     assert len(md_cs_star.df_data) == len(md_cs.cs), f'The number of records differs between {args.csparc_star} and {args.csparc_csg}:cs.'
     assert len(md_cs_star.df_data) == len(md_cs.passthrough), f'The number of records differs between {args.csparc_star} and {args.csparc_csg}:passthrough'
+    codebook = c2r.ImageKeyCodebook()
+    c2r.preflight_imgids(md_cs.image_keys(codebook), md_cs_star.image_keys(codebook), f'{args.csparc_csg}:cs', args.csparc_star, codebook=codebook)
 
     # cryoSPARC metadata of the particles before expansion
     print(f'Loading {args.csparc_orig_csg}...')
@@ -60,44 +125,32 @@ def main():
     )
 
     print('Mapping particleid+imagename to _rlnGroupNumber...')
-    ks = md_gr_src.df_data['_rlnImageName'].to_numpy(copy=True)
-    for i in range(len(ks)):
-        ks[i] = c2r.imgname_to_imgid(ks[i], rm_ext=True)
-    vs = md_gr_src.df_data['_rlnGroupNumber'].to_numpy(copy=True)
-    map_imgid_to_gr = dict(zip(ks, vs))
+    ks = pd.Index(md_gr_src.image_keys(codebook, rm_uid=True, rm_ext=True))
 
     # The UIDs of the original particle images before symmetry expansion
-    uids_orig = list(md_cs_orig.cs['uid'])
+    uids_orig = pd.Index(md_cs_orig.cs['uid'])
 
     # The corresponding original UIDs of the expanded particles.
     src_uids = md_cs.passthrough['sym_expand/src_uid']
 
     print('Mapping src_uid to particleid+imagename...')
-    imgids = []
-    for src_uid in tqdm(src_uids):
-        idx = uids_orig.index(src_uid)
-        blobpath = md_cs_orig.cs['blob/path'][idx]
-        blobidx = md_cs_orig.cs['blob/idx'][idx]
-        imgid = c2r.blobpath_and_blobidx_to_imgid(blobpath, blobidx)
-        imgids.append(imgid)
+    idxs = uids_orig.get_indexer(src_uids)
+    assert np.all(idxs >= 0), f'Some of sym_expand/src_uid could not be found in {args.csparc_orig_csg}'
+    imgids = md_cs_orig.image_keys(codebook, rm_uid=True, rm_ext=True)[idxs]
 
     print('Resolving _rlnGroupNumber...')
-    grs = []
-    for imgid in imgids:
-        try:
-            gr = map_imgid_to_gr[imgid]
-        except KeyError:
-            print(f'imgid {imgid} could not be found from source star file.')
-            raise
-        grs.append(gr)
+    js = ks.get_indexer(imgids)
+    missing = np.flatnonzero(js < 0)
+    if len(missing) > 0:
+        imgid = codebook.imgids(imgids[missing[:1]])[0]
+        print(f'imgid {imgid} could not be found from source star file.')
+        raise KeyError(imgid)
+    grs = md_gr_src.df_data['_rlnGroupNumber'].iloc[js].to_numpy()
 
     print('Saving output...')
-    md_out_cols = list(md_cs_star.df_data.columns)
-    md_out_cols.append('_rlnGroupNumber')
-    md_out_data = md_cs_star.df_data.to_numpy(copy=True)
-    md_out_data = np.concatenate((md_out_data, np.array(grs).reshape(-1, 1)), axis=1)
-    md_out.df_data = pd.DataFrame(data=md_out_data, columns=md_out_cols)
-    md_out.write(args.out_star)
+    md_out.df_data = md_cs_star.df_data.copy()
+    md_out.df_data['_rlnGroupNumber'] = grs
+    md_out.write(args.out_star, num_workers=args.num_workers)
 
 
 if __name__ == '__main__':
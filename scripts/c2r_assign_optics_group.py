@@ -7,8 +7,8 @@ import argparse
 
 import numpy as np
 import pandas as pd
-from tqdm import tqdm
 
+import c2r
 from c2r import RelionMetaData
 
 
@@ -30,31 +30,29 @@ def create_data_optics_record(md, list_groupname, list_group):
     assert df.shape[0] == 1
 
     # Duplicate rows
-    df = pd.concat([df] * len(list_groupname), ignore_index=True, copy=True)
+    df = pd.concat([df] * len(list_groupname), ignore_index=True)
 
     for i, (groupname, group) in enumerate(zip(list_groupname, list_group)):
-        df.iloc[i]['_rlnOpticsGroupName'] = groupname
-        df.iloc[i]['_rlnOpticsGroup'] = group
+        df.loc[i, '_rlnOpticsGroupName'] = groupname
+        df.loc[i, '_rlnOpticsGroup'] = group
 
     md.df_optics = df
 
 
-def modify_data(md, list_group, list_pattern):
-    data = md.df_data.to_numpy(copy=False)
-    cols = list(md.df_data.columns)
-    idx_mic = cols.index('_rlnMicrographName')
-    idx_group = cols.index('_rlnOpticsGroup')
+def find_optics_group(mic, list_group, list_pattern):
+    for group, pattern in zip(list_group, list_pattern):
+        if pattern in mic:
+            return group
+    assert False, f'None of the optics patterns matched. {mic}'
+
 
+def modify_data(md, list_group, list_pattern):
     print('Modifying data records....')
-    for i in tqdm(range(data.shape[0])):
-        mic = data[i, idx_mic]
-        optics_found = False
-        for group, pattern in zip(list_group, list_pattern):
-            if pattern in mic:
-                data[i, idx_group] = group
-                optics_found = True
-                break
-        assert optics_found, f'None of the optics patterns matched. {mic}'
+    # The patterns are matched once per unique micrograph, and the results are broadcasted with the category codes.
+    md.df_data['_rlnOpticsGroup'] = c2r.remap_categories(
+        md.df_data['_rlnMicrographName'],
+        lambda mic: find_optics_group(mic, list_group, list_pattern)
+    ).to_numpy()
 
 
 def parse_args():
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""Reassign the random subsets (_rlnRandomSubset, half1 or half2) of a particle star file, so that related particles always share a half and the halves stay balanced.
+
+Particles are grouped by a label (e.g. _rlnMicrographName, so that the particles of a micrograph are in the same half), or by image (--group_by image, so that the symmetry-expanded copies of a particle are in the same half).
+The groups are shuffled with a seeded permutation, and split into two halves of about the same number of particles.
+"""
+
+import sys
+import argparse
+
+import numpy as np
+import pandas as pd
+
+import c2r
+
+SUBSET_COL = '_rlnRandomSubset'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description=__doc__
+    )
+    parser.add_argument('--i', type=str, required=True, help='Input particle star file.')
+    parser.add_argument('--o', type=str, required=True, help='Output particle star file.')
+    parser.add_argument('--group_by', type=str, default='_rlnMicrographName', help='Label to group the particles by, or "image" to group the copies of the same particle image (by _rlnImageName, ignoring the directory part and leading zeros).')
+    parser.add_argument('--remove_uid', action='store_true', help='Remove the cryoSPARC UIDs from the image names for --group_by image.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed.')
+    parser.add_argument('--num_workers', type=int, default=1, help='Number of worker processes formatting the output star file. -1 uses all the logical CPUs.')
+    parser.add_argument('--compress-threads', type=int, default=0, help='Number of zstd compression threads for .star.zst output. -1 uses all the logical CPUs.')
+    args = parser.parse_args()
+
+    print('##### Command #####\n\t' + ' '.join(sys.argv))
+    args_print_str = '##### Input parameters #####\n'
+    for opt, val in vars(args).items():
+        args_print_str += '\t{} : {}\n'.format(opt, val)
+    print(args_print_str)
+    return args
+
+
+def summarize(title, subsets, group_codes):
+    """Sizes of the halves, and the number of groups split across the halves."""
+
+    text = f'##### {title} #####\n'
+    for half in (1, 2):
+        text += '\thalf{} : {}\n'.format(half, int(np.count_nonzero(subsets == half)))
+    num_other = int(np.count_nonzero((subsets != 1) & (subsets != 2)))
+    if num_other > 0:
+        text += '\tneither : {}\n'.format(num_other)
+    num_halves = pd.Series(subsets).groupby(group_codes).nunique()
+    text += '\tgroups split across the halves : {} / {}\n'.format(int(np.count_nonzero(num_halves > 1)), len(num_halves))
+    return text
+
+
+def main():
+    args = parse_args()
+
+    print(f'Loading {args.i}...')
+    md = c2r.RelionMetaData.load(args.i)
+
+    print('Grouping the particles...')
+    if args.group_by == 'image':
+        keys = md.image_keys(c2r.ImageKeyCodebook(), rm_uid=args.remove_uid)
+        _, group_codes = np.unique(keys, return_inverse=True)
+        group_codes = group_codes.ravel()
+    else:
+        assert args.group_by in md.df_data.columns, f'{args.group_by} does not exist in {args.i}'
+        group_codes, _ = pd.factorize(md.df_data[args.group_by])
+        num_missing = np.count_nonzero(group_codes < 0)
+        if num_missing > 0:
+            sys.exit(f'{num_missing} particles have no {args.group_by} value. Fill it in or use another --group_by.')
+    print(f'{group_codes.max(initial=-1) + 1} groups of {len(group_codes)} particles.')
+
+    if SUBSET_COL in md.df_data.columns:
+        print(summarize('Before', pd.to_numeric(md.df_data[SUBSET_COL], errors='coerce').to_numpy(), group_codes))
+
+    subsets = c2r.split_half_sets(group_codes, seed=args.seed)
+    print(summarize('After', subsets, group_codes))
+
+    print('Saving the output star file...')
+    md.df_data[SUBSET_COL] = subsets.astype(str)
+    md.write(args.o, threads=args.compress_threads, num_workers=args.num_workers)
+    print(f'{args.o} was created.')
+
+
+if __name__ == '__main__':
+    main()
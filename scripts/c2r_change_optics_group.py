@@ -3,8 +3,7 @@
 import sys
 import argparse
 
-from tqdm import tqdm
-
+import c2r
 from c2r import RelionMetaData
 
 GR = '_rlnOpticsGroup'
@@ -52,7 +51,8 @@ def main():
     md.df_optics.loc[md.df_optics[GRN] == args.src_optics_group_name, GRN] = args.new_optics_group_name
 
     print('Modifying the data table...')
-    md.df_data.loc[md.df_data[GR] == args.src_optics_group, GR] = args.new_optics_group
+    # Rename the category instead of rewriting every matching row.
+    md.df_data[GR] = c2r.remap_categories(md.df_data[GR], {args.src_optics_group: args.new_optics_group})
 
     md.write(outfile=args.outfile)
     print('end')
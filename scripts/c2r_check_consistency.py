@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""Check that a cryoSPARC particles .cs file and a star file exported from it (e.g. with PyEM csparc2star.py) list the same particles in the same order.
+
+The image ids are compared as 64-bit hashes. On mismatch, the first divergent rows are reported, together with whether the difference is a permutation or a set difference.
+The exit status is 0 if the requirement is met, 1 otherwise.
+"""
+
+import sys
+import argparse
+
+import c2r
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description=__doc__
+    )
+    parser.add_argument('--csparc_csg', type=str, required=True, help='cryoSPARC particles .csg file.')
+    parser.add_argument('--star', type=str, required=True, help='Star file to check against --csparc_csg.')
+    parser.add_argument('--require', type=str, choices=('identical', 'same_set', 'subset'), default='identical', help='identical: same particles in the same order. same_set: same particles in any order. subset: every particle of --star is in --csparc_csg.')
+    parser.add_argument('--remove_uid', action='store_true', help='Remove the cryoSPARC UIDs from the image names on both sides before comparison.')
+    args = parser.parse_args()
+
+    print('##### Command #####\n\t' + ' '.join(sys.argv))
+    args_print_str = '##### Input parameters #####\n'
+    for opt, val in vars(args).items():
+        args_print_str += '\t{} : {}\n'.format(opt, val)
+    print(args_print_str)
+    return args
+
+
+def main():
+    args = parse_args()
+
+    print(f'Loading {args.csparc_csg}...')
+    md_cs = c2r.CryoSPARCMetaData.load(args.csparc_csg, mmap=True)
+    print(f'Loading {args.star}...')
+    md_star = c2r.RelionMetaData.load(args.star, usecols=('_rlnImageName',))
+
+    codebook = c2r.ImageKeyCodebook()
+    report = c2r.preflight_imgids(
+        md_star.image_keys(codebook, rm_uid=args.remove_uid),
+        md_cs.image_keys(codebook, rm_uid=args.remove_uid),
+        args.star, args.csparc_csg, require=args.require, codebook=codebook
+    )
+    print(c2r.format_imgid_comparison(report, args.star, args.csparc_csg))
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
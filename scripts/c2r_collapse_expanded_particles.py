@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""Collapse symmetry-expanded particles back to their source particles (one row per original particle), e.g. after focused classification of the expanded particles in cryoSPARC.
+
+The expanded particles are grouped by sym_expand/src_uid, and each source particle is kept according to how many of its copies are selected (--selected_csg and/or --class_field/--classes):
+* any: at least one copy is selected.
+* all: all the copies are selected.
+* majority: more than half of the copies are selected.
+* min_count: at least --min_count copies are selected.
+Without any selection, all the source particles are kept.
+
+The kept source particles are written as a cryoSPARC subset of --orig_csg (--outdir/--out_rootname), and/or as a subset of the RELION star file of the original particles (--relion_star/--out_star).
+"""
+
+import sys
+import argparse
+
+import numpy as np
+import pandas as pd
+
+import c2r
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description=__doc__
+    )
+    parser.add_argument('--expanded_csg', type=str, required=True, help='Particles .csg file of the expanded particles, with sym_expand/src_uid (e.g. of the focused classification job).')
+    parser.add_argument('--orig_csg', type=str, required=True, help='Particles .csg file of a job before symmetry expansion, containing the source particles.')
+    parser.add_argument('--selected_csg', type=str, nargs='+', help='Particles .csg file(s) of the selected expanded particles (e.g. of the chosen classes). Matched by uid.')
+    parser.add_argument('--class_field', type=str, help='Class field of --expanded_csg for --classes.')
+    parser.add_argument('--classes', type=int, nargs='+', help='Select the expanded particles of these classes (values of --class_field).')
+    parser.add_argument('--rule', type=str, choices=c2r.AGGREGATION_RULES, default='any', help='Aggregation rule of the selected copies.')
+    parser.add_argument('--min_count', type=int, default=1, help='Number of selected copies required by --rule min_count.')
+    parser.add_argument('--outdir', type=str, help='Output directory of the cryoSPARC subset.')
+    parser.add_argument('--out_rootname', type=str, help='Output file rootname of the cryoSPARC subset. <out_rootname>_particles.cs, <out_rootname>_passthrough_particles.cs and <out_rootname>_particles.csg are written.')
+    parser.add_argument('--relion_star', type=str, help='RELION star file of the original particles (before symmetry expansion).')
+    parser.add_argument('--out_star', type=str, help='Output star file of the RELION subset.')
+    parser.add_argument('--relion_remove_uid', action='store_true', help='Remove the cryoSPARC UIDs from the image names of --relion_star too.')
+    args = parser.parse_args()
+
+    print('##### Command #####\n\t' + ' '.join(sys.argv))
+    args_print_str = '##### Input parameters #####\n'
+    for opt, val in vars(args).items():
+        args_print_str += '\t{} : {}\n'.format(opt, val)
+    print(args_print_str)
+    return args
+
+
+def get_field(md, name, csg_file):
+    """Field of the .cs file or of the passthrough .cs file."""
+
+    if name in md.cs.dtype.names:
+        return md.cs[name]
+    if md.passthrough is not None and name in md.passthrough.dtype.names:
+        return md.passthrough[name]
+    sys.exit(f'{name} does not exist in {csg_file}.')
+
+
+def main():
+    args = parse_args()
+    assert (args.outdir is None) == (args.out_rootname is None), 'Specify both --outdir and --out_rootname.'
+    assert (args.relion_star is None) == (args.out_star is None), 'Specify both --relion_star and --out_star.'
+    assert args.outdir is not None or args.out_star is not None, 'Specify --outdir/--out_rootname and/or --relion_star/--out_star.'
+    assert (args.class_field is None) == (args.classes is None), 'Specify both --class_field and --classes.'
+
+    # Only the fields needed for the selection are loaded from the expanded particles.
+    usecols = ['sym_expand/src_uid']
+    if args.class_field is not None:
+        usecols.append(args.class_field)
+    print(f'Loading {args.expanded_csg}...')
+    md_exp = c2r.CryoSPARCMetaData.load(args.expanded_csg, usecols=usecols)
+    src_uids = get_field(md_exp, 'sym_expand/src_uid', args.expanded_csg)
+
+    print('Selecting the expanded particles...')
+    selected = np.ones(len(md_exp.cs), dtype=bool)
+    if args.selected_csg is not None:
+        sel_uids = [c2r.CryoSPARCMetaData.load(x, usecols=['uid']).cs['uid'] for x in args.selected_csg]
+        selected &= np.isin(md_exp.cs['uid'], np.concatenate(sel_uids))
+    if args.classes is not None:
+        selected &= np.isin(get_field(md_exp, args.class_field, args.expanded_csg), args.classes)
+    print(f'{selected.sum()} / {len(selected)} expanded particles are selected.')
+
+    print('Collapsing to the source particles...')
+    uids, keep, num_selected, num_copies = c2r.aggregate_by_source(src_uids, selected, rule=args.rule, min_count=args.min_count)
+    summary = '##### Source particles #####\n'
+    summary += '\tsource particles : {}\n'.format(len(uids))
+    if len(uids) > 0:
+        summary += '\tcopies per particle : {}-{}\n'.format(num_copies.min(), num_copies.max())
+    summary += '\twith any selected copy : {}\n'.format(int(np.count_nonzero(num_selected > 0)))
+    summary += '\tkept ({}) : {}\n'.format(args.rule, int(np.count_nonzero(keep)))
+    print(summary)
+
+    print(f'Loading {args.orig_csg}...')
+    md_orig = c2r.CryoSPARCMetaData.load(args.orig_csg)
+    idxs = pd.Index(md_orig.cs['uid']).get_indexer(uids[keep])
+    if np.any(idxs < 0):
+        sys.exit(f'{np.count_nonzero(idxs < 0)} of sym_expand/src_uid could not be found in {args.orig_csg}')
+    # Keep the order of --orig_csg.
+    idxs = np.sort(idxs)
+    md_orig = md_orig.iloc(idxs)
+
+    if args.outdir is not None:
+        print('Saving the cryoSPARC subset...')
+        md_orig.write(args.outdir, args.out_rootname)
+
+    if args.out_star is not None:
+        print(f'Loading {args.relion_star}...')
+        md = c2r.RelionMetaData.load(args.relion_star)
+        codebook = c2r.ImageKeyCodebook()
+        cs_ids = md_orig.image_keys(codebook, rm_uid=True)
+        relion_ids = md.image_keys(codebook, rm_uid=args.relion_remove_uid)
+        mask = np.isin(relion_ids, cs_ids)
+        num_missing = len(cs_ids) - np.isin(cs_ids, relion_ids).sum()
+        if num_missing > 0:
+            print(f'WARNING: {num_missing} of the kept source particles were not found in {args.relion_star}')
+        print(f'{mask.sum()} / {len(mask)} particles are written.')
+        md.iloc(np.flatnonzero(mask)).write(args.out_star)
+
+
+if __name__ == '__main__':
+    main()
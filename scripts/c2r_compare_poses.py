@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""Compare the particle poses of two star files (e.g. a RELION refinement and a star file created by PyEM csparc2star.py), as a quality check before transferring the poses.
+
+The particles are joined on the normalized image ids. For each particle, the angular distance between the two orientations (the smallest over the symmetry-equivalent orientations) and the distance between the origin shifts are computed.
+Histograms of the distances and summaries per group (e.g. _rlnOpticsGroup or _rlnMicrographName) are printed, and optionally saved as TSV files.
+"""
+
+import sys
+import argparse
+
+import numpy as np
+import pandas as pd
+
+import c2r
+
+ANGLE_COLS = ('_rlnAngleRot', '_rlnAngleTilt', '_rlnAnglePsi')
+SHIFT_COLS = ('_rlnOriginXAngst', '_rlnOriginYAngst')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description=__doc__
+    )
+    parser.add_argument('--star_a', type=str, required=True, help='Reference star file (e.g. the RELION refinement).')
+    parser.add_argument('--star_b', type=str, required=True, help='Star file to compare (e.g. created with PyEM csparc2star.py). Symmetry-expanded particles are compared to the same particle of --star_a.')
+    parser.add_argument('--remove_uid_a', action='store_true', help='Remove the cryoSPARC UIDs from the image names of --star_a.')
+    parser.add_argument('--remove_uid_b', action='store_true', help='Remove the cryoSPARC UIDs from the image names of --star_b.')
+    parser.add_argument('--sym', type=str, default='C1', help='Point group symmetry (Cn, Dn, T, O or I).')
+    parser.add_argument('--group_by', type=str, default='_rlnOpticsGroup', help='Label of --star_a to summarize the distances by (e.g. _rlnOpticsGroup, _rlnMicrographName).')
+    parser.add_argument('--angle_bin', type=float, default=5, help='Bin width of the angular distance histogram in degrees.')
+    parser.add_argument('--shift_bin', type=float, default=1, help='Bin width of the shift distance histogram in Angstrom.')
+    parser.add_argument('--threshold', type=float, default=5, help='Angular distance in degrees, under which the poses are counted as consistent in the summaries.')
+    parser.add_argument('--o', type=str, help='Output file rootname. <o>_particles.tsv, <o>_histograms.tsv and <o>_groups.tsv are written.')
+    args = parser.parse_args()
+
+    print('##### Command #####\n\t' + ' '.join(sys.argv))
+    args_print_str = '##### Input parameters #####\n'
+    for opt, val in vars(args).items():
+        args_print_str += '\t{} : {}\n'.format(opt, val)
+    print(args_print_str)
+    return args
+
+
+def load_poses(starfile, group_by):
+    md = c2r.RelionMetaData.load(starfile, usecols=('_rlnImageName',) + ANGLE_COLS + SHIFT_COLS + (group_by,))
+    missing = [x for x in ('_rlnImageName',) + ANGLE_COLS if x not in md.df_data.columns]
+    if len(missing) > 0:
+        sys.exit(f'{starfile} does not have {missing}.')
+    return md
+
+
+def get_shifts(md):
+    if all(x in md.df_data.columns for x in SHIFT_COLS):
+        return np.stack([md.df_data[x].astype(np.float64).to_numpy() for x in SHIFT_COLS], axis=1)
+    return None
+
+
+def histogram(values, bin_width):
+    """Counts of the values in bins [i * bin_width, (i + 1) * bin_width)."""
+
+    if len(values) == 0:
+        return np.zeros(0), np.zeros(0, dtype=np.int64)
+    num_bins = int(np.floor(values.max() / bin_width)) + 1
+    counts = np.bincount(np.floor(values / bin_width).astype(np.int64), minlength=num_bins)
+    return np.arange(num_bins) * bin_width, counts
+
+
+def format_histogram(title, lower, counts, bin_width, width=50):
+    text = f'##### {title} #####\n'
+    scale = width / max(counts.max(initial=0), 1)
+    for x, n in zip(lower, counts):
+        text += '\t{:8.2f} - {:8.2f} : {:>10} {}\n'.format(x, x + bin_width, n, '#' * int(np.ceil(n * scale)))
+    return text
+
+
+def main():
+    args = parse_args()
+
+    print(f'Loading {args.star_a}...')
+    md_a = load_poses(args.star_a, args.group_by)
+    print(f'Loading {args.star_b}...')
+    md_b = load_poses(args.star_b, args.group_by)
+
+    print('Joining the particles...')
+    codebook = c2r.ImageKeyCodebook()
+    ids_a = md_a.image_keys(codebook, rm_uid=args.remove_uid_a)
+    ids_b = md_b.image_keys(codebook, rm_uid=args.remove_uid_b)
+    index_a = pd.Index(ids_a)
+    if index_a.has_duplicates:
+        sys.exit(f'{args.star_a} has duplicated particles.')
+    ia = index_a.get_indexer(ids_b)
+    ib = np.flatnonzero(ia >= 0)
+    ia = ia[ib]
+    print(f'{len(ib)} particles of {args.star_b} are found in {args.star_a}.')
+    if len(ib) < len(ids_b):
+        print(f'WARNING: {len(ids_b) - len(ib)} particles of {args.star_b} are not found in {args.star_a}, and skipped.')
+    if len(ib) == 0:
+        sys.exit('No particles to compare.')
+
+    print('Computing the distances...')
+    mats_a = c2r.euler_to_matrices(*(md_a.df_data[x].astype(np.float64).to_numpy()[ia] for x in ANGLE_COLS))
+    mats_b = c2r.euler_to_matrices(*(md_b.df_data[x].astype(np.float64).to_numpy()[ib] for x in ANGLE_COLS))
+    df = pd.DataFrame({
+        'imgid': codebook.imgids(ids_b[ib]),
+        'angle_dist': c2r.angular_distances(mats_a, mats_b, symmetry=args.sym),
+    })
+    shifts_a, shifts_b = get_shifts(md_a), get_shifts(md_b)
+    if shifts_a is not None and shifts_b is not None:
+        df['shift_dist'] = np.linalg.norm(shifts_a[ia] - shifts_b[ib], axis=1)
+    else:
+        print(f'WARNING: {SHIFT_COLS} are not found in both star files, and the shifts are not compared.')
+    has_group = args.group_by in md_a.df_data.columns
+    if has_group:
+        df[args.group_by] = md_a.df_data[args.group_by].astype(str).to_numpy()[ia]
+
+    print()
+    hists = []
+    for label, bin_width, title in (('angle_dist', args.angle_bin, 'Angular distance (degrees)'), ('shift_dist', args.shift_bin, 'Shift distance (Angstrom)')):
+        if label not in df.columns:
+            continue
+        lower, counts = histogram(df[label].to_numpy(), bin_width)
+        print(format_histogram(title, lower, counts, bin_width))
+        hists.append(pd.DataFrame({'distance': label, 'lower': lower, 'upper': lower + bin_width, 'count': counts}))
+
+    # Summaries per group, and of all the particles.
+    agg = {
+        'num_particles': ('angle_dist', 'size'),
+        'angle_median': ('angle_dist', 'median'),
+        'angle_mean': ('angle_dist', 'mean'),
+        'angle_p90': ('angle_dist', lambda x: x.quantile(0.9)),
+        'frac_consistent': ('angle_dist', lambda x: (x < args.threshold).mean()),
+    }
+    if 'shift_dist' in df.columns:
+        agg['shift_median'] = ('shift_dist', 'median')
+        agg['shift_p90'] = ('shift_dist', lambda x: x.quantile(0.9))
+    df_total = df.assign(group='all').groupby('group').agg(**agg)
+    if has_group:
+        df_groups = df.groupby(args.group_by, sort=True).agg(**agg)
+        df_groups = pd.concat([df_groups, df_total.rename_axis(args.group_by)])
+    else:
+        print(f'WARNING: {args.group_by} is not found in {args.star_a}, and only the total is summarized.')
+        df_groups = df_total
+    with pd.option_context('display.max_rows', 100, 'display.width', 200):
+        print(f'##### Summary (consistent: angular distance < {args.threshold} degrees) #####')
+        print(df_groups.to_string(float_format=lambda x: f'{x:.3f}'))
+
+    if args.o is not None:
+        df.to_csv(args.o + '_particles.tsv', sep='\t', index=False, float_format='%.3f')
+        pd.concat(hists).to_csv(args.o + '_histograms.tsv', sep='\t', index=False)
+        df_groups.to_csv(args.o + '_groups.tsv', sep='\t', float_format='%.4f')
+        print(f'{args.o}_particles.tsv, {args.o}_histograms.tsv and {args.o}_groups.tsv were created.')
+
+
+if __name__ == '__main__':
+    main()
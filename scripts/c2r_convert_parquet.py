@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""Convert RELION star files and cryoSPARC particles (.csg) to Parquet files with typed columns, and back.
+
+The other c2r scripts accept the Parquet files wherever they accept star or .csg files.
+RELION: particles.star <-> particles.parquet. The optics block is kept in the Parquet schema metadata.
+cryoSPARC: J10/P1_J10_particles.csg <-> J10_particles.parquet. The passthrough fields are joined to the particles on uid, and the csg is kept in the Parquet schema metadata.
+"""
+
+import sys
+import os
+import argparse
+
+import c2r
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description=__doc__
+    )
+    parser.add_argument('--i', type=str, required=True, help='Input star file, particles .csg file or Parquet file.')
+    parser.add_argument('--o', type=str, required=True, help='Output file. Parquet file (.parquet) for star/.csg input. Star file for RELION Parquet input, or <outdir>/<rootname>_particles.csg for cryoSPARC Parquet input.')
+    parser.add_argument('--usecols', type=str, nargs='+', help='Labels (RELION) or fields (cryoSPARC) to keep. By default all.')
+    parser.add_argument('--num_workers', type=int, default=1, help='Number of worker processes formatting the output star file. -1 uses all the logical CPUs.')
+    parser.add_argument('--compress-threads', type=int, default=0, help='Number of zstd compression threads for .star.zst output. -1 uses all the logical CPUs.')
+    args = parser.parse_args()
+
+    print('##### Command #####\n\t' + ' '.join(sys.argv))
+    args_print_str = '##### Input parameters #####\n'
+    for opt, val in vars(args).items():
+        args_print_str += '\t{} : {}\n'.format(opt, val)
+    print(args_print_str)
+    return args
+
+
+def main():
+    args = parse_args()
+
+    if args.i.endswith('.csg') or args.o.endswith('.csg'):
+        print(f'Loading {args.i}...')
+        md = c2r.CryoSPARCMetaData.load(args.i, mmap=True, usecols=args.usecols)
+        print(f'Writing {args.o}...')
+        if c2r.is_parquet(args.o):
+            md.write_parquet(args.o)
+        else:
+            assert args.o.endswith('_particles.csg'), f'The output file name should end with _particles.csg: {args.o}'
+            md.write(os.path.dirname(args.o) or '.', os.path.basename(args.o)[:-len('_particles.csg')])
+    else:
+        print(f'Loading {args.i}...')
+        md = c2r.RelionMetaData.load(args.i, usecols=args.usecols)
+        print(f'Writing {args.o}...')
+        md.write(args.o, threads=args.compress_threads, num_workers=args.num_workers)
+
+    print(f'{args.o} was created.')
+
+
+if __name__ == '__main__':
+    main()
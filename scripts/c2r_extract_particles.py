@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""Extract a small subset of particles from a large star file by row numbers or image names, without parsing the whole file.
+
+A seekable row index is built on the first run and saved next to the star file (<in_star>.c2ridx.npz). Subsequent runs only seek and read the requested rows.
+If the index can not be saved (e.g. read-only project directory) or --dont_save_index is given, it is built in memory on every run.
+"""
+
+import sys
+import argparse
+
+import numpy as np
+
+import c2r
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description=__doc__
+    )
+    parser.add_argument('--in_star', type=str, required=True, help='Input (uncompressed) star file.')
+    parser.add_argument('--out_star', type=str, help='Output star file.')
+    parser.add_argument('--rows', type=str, help='Text file listing the row numbers (0-based) of the particles to extract, one per line.')
+    parser.add_argument('--imgnames', type=str, help='Text file listing the _rlnImageName (e.g. 000012@Extract/job010/movies/mic_0001.mrcs) of the particles to extract, one per line. The directory part is ignored.')
+    parser.add_argument('--remove_uid', action='store_true', help='Remove the cryoSPARC UIDs from the image names of both --in_star and --imgnames before matching.')
+    parser.add_argument('--dont_save_index', action='store_true', help='Do not save the row index next to --in_star.')
+    parser.add_argument('--build_index_only', action='store_true', help='Only build the row index of --in_star.')
+    args = parser.parse_args()
+
+    print('##### Command #####\n\t' + ' '.join(sys.argv))
+    args_print_str = '##### Input parameters #####\n'
+    for opt, val in vars(args).items():
+        args_print_str += '\t{} : {}\n'.format(opt, val)
+    print(args_print_str)
+    return args
+
+
+def main():
+    args = parse_args()
+
+    if args.build_index_only:
+        assert not args.dont_save_index, '--build_index_only and --dont_save_index can not be used together.'
+        print('Building the row index...')
+        c2r.StarRowIndex.load(args.in_star, rm_uid=args.remove_uid)
+        return
+
+    assert args.out_star is not None, '--out_star is required.'
+    assert (args.rows is None) != (args.imgnames is None), 'Specify either --rows or --imgnames.'
+
+    if args.rows is not None:
+        rows = np.loadtxt(args.rows, dtype=np.int64, ndmin=1)
+        print(f'Extracting {len(rows)} rows...')
+        md = c2r.RelionMetaData.load_rows(args.in_star, rows=rows, rm_uid=args.remove_uid, save_index=not args.dont_save_index)
+    else:
+        with open(args.imgnames) as f:
+            imgnames = [line.split()[0] for line in f if line.strip() != '']
+        imgids = c2r.imgnames_to_imgids(imgnames, rm_uid=args.remove_uid)
+        print(f'Extracting {len(imgids)} particles...')
+        md = c2r.RelionMetaData.load_rows(args.in_star, imgids=imgids, rm_uid=args.remove_uid, save_index=not args.dont_save_index)
+        num_missing = len(imgids) - len(md.df_data)
+        if num_missing > 0:
+            print(f'{num_missing} image names were not found in {args.in_star}')
+
+    print('Saving the output star file...')
+    md.write(args.out_star)
+
+
+if __name__ == '__main__':
+    main()
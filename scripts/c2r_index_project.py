@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""Index the particle files of all the job directories of a cryoSPARC project, and list them.
+
+The index is cached in a per-user cache directory (C2R_INDEX_DIR environment variable, or ~/.cache/c2r), or in --index_file, and updated incrementally: only the job directories whose particle files were added, removed or modified are rescanned. The other c2r scripts accept a job directory (e.g. P1/J20) in place of a particles .csg file, and look it up in this index.
+"""
+
+import sys
+import argparse
+
+import c2r
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description=__doc__
+    )
+    parser.add_argument('--project_dir', type=str, required=True, help='cryoSPARC project directory (e.g. /path/to/P1).')
+    parser.add_argument('--num_workers', type=int, default=8, help='Number of threads scanning the job directories.')
+    parser.add_argument('--rebuild', action='store_true', help='Rescan all the job directories, ignoring the cached index.')
+    parser.add_argument('--index_file', type=str, help='Cached index file, e.g. <project_dir>/c2r_index.json. The other c2r scripts use the default file only. By default <project path>.c2r_index.json in C2R_INDEX_DIR or ~/.cache/c2r.')
+    args = parser.parse_args()
+
+    print('##### Command #####\n\t' + ' '.join(sys.argv))
+    args_print_str = '##### Input parameters #####\n'
+    for opt, val in vars(args).items():
+        args_print_str += '\t{} : {}\n'.format(opt, val)
+    print(args_print_str)
+    return args
+
+
+def main():
+    args = parse_args()
+
+    print(f'Indexing {args.project_dir}...')
+    index = c2r.CryoSPARCProjectIndex.load(args.project_dir, num_workers=args.num_workers, rebuild=args.rebuild, index_path=args.index_file)
+
+    print('Job\tParticles\tcsg file')
+    for job, entry in index.jobs.items():
+        for group in entry['groups']:
+            num_rows = entry['files'].get(group['particles'], {}).get('num_rows')
+            print(f'{job}\t{num_rows}\t{group["csg"]}')
+    print(f'{len(index.jobs)} job directories indexed in {index.index_path}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""Merge RELION star files (e.g. of several collection sessions or cryoSPARC jobs) into one, streaming the particles without loading the inputs entirely.
+
+The optics tables are merged: identical optics groups (e.g. the same session in two inputs) are merged into one group, and the groups are renumbered from 1 in the order of appearance. _rlnOpticsGroup of the particles is updated accordingly.
+Only the data labels found in all the inputs are written. Optionally, particles found in more than one input (or twice in an input) are written only once.
+"""
+
+import sys
+import argparse
+
+import c2r
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description=__doc__
+    )
+    parser.add_argument('--i', type=str, required=True, nargs='+', help='Input star files.')
+    parser.add_argument('--o', type=str, required=True, help='Output star file.')
+    parser.add_argument('--dedup', action='store_true', help='Write only the first occurrence of each particle image (by _rlnImageName, ignoring the directory part and leading zeros).')
+    parser.add_argument('--remove_uid', action='store_true', help='Remove the cryoSPARC UIDs from the image names for --dedup.')
+    parser.add_argument('--compress-threads', type=int, default=0, help='Number of zstd compression threads for .star.zst output. -1 uses all the logical CPUs.')
+    args = parser.parse_args()
+
+    print('##### Command #####\n\t' + ' '.join(sys.argv))
+    args_print_str = '##### Input parameters #####\n'
+    for opt, val in vars(args).items():
+        args_print_str += '\t{} : {}\n'.format(opt, val)
+    print(args_print_str)
+    return args
+
+
+def main():
+    args = parse_args()
+
+    print('Merging the star files...')
+    counts = c2r.RelionMetaData.merge(args.i, args.o, dedup=args.dedup, rm_uid=args.remove_uid, threads=args.compress_threads)
+    for starfile, (num_particles, num_written) in zip(args.i, counts):
+        print(f'\t{starfile} : {num_written} / {num_particles} particles written')
+    print(f'{args.o} was created.')
+
+
+if __name__ == '__main__':
+    main()
@@ -4,6 +4,8 @@ import argparse
 import sys
 import os
 
+import c2r
+
 
 def parse_args():
     parser = argparse.ArgumentParser(
@@ -25,6 +27,9 @@ def parse_args():
     parser.add_argument(
         '--overwrite', action='store_true', help='Allow overwriting output file.'
     )
+    parser.add_argument(
+        '--compress-threads', type=int, default=0, help='Number of compression threads when the output is .zst compressed. -1 uses all the logical CPUs.'
+    )
     args = parser.parse_args()
 
     print('##### Command #####\n\t' + ' '.join(sys.argv))
@@ -35,12 +40,12 @@ def parse_args():
     return args
 
 
-def main(in_star_file: str, out_star_file: str, orig_apix: float, add_groupname: bool, overwrite: bool) -> None:
+def main(in_star_file: str, out_star_file: str, orig_apix: float, add_groupname: bool, overwrite: bool, compress_threads: int = 0) -> None:
     assert os.path.exists(in_star_file), 'No such file exists : {}'.format(in_star_file)
     if not overwrite:
         assert not os.path.exists(out_star_file), 'File already exists : {}'.format(out_star_file)
 
-    with open(in_star_file) as f:
+    with c2r.open_star(in_star_file) as f:
         inlines = f.readlines()
 
     out_star_contents = []
@@ -113,7 +118,7 @@ def main(in_star_file: str, out_star_file: str, orig_apix: float, add_groupname:
         i += 1
         out_star_contents.append(line)
 
-    with open(out_star_file, 'w') as f:
+    with c2r.open_star(out_star_file, 'w', threads=compress_threads) as f:
         f.writelines(out_star_contents)
 
 
@@ -124,5 +129,6 @@ if __name__ == '__main__':
         args.out_star_file,
         args.orig_apix,
         args.add_groupname,
-        args.overwrite
+        args.overwrite,
+        args.compress_threads
     )
@@ -20,6 +20,8 @@ import glob
 import sys
 import argparse
 
+import c2r
+
 
 def parse_args():
     parser = argparse.ArgumentParser(
@@ -41,6 +43,9 @@ def parse_args():
     parser.add_argument(
         '--remove-uuid', action='store_true', help='Remove the preceding UUID of the image file names.'
     )
+    parser.add_argument(
+        '--compress-threads', type=int, default=0, help='Number of compression threads when the output is .zst compressed. -1 uses all the logical CPUs.'
+    )
     args = parser.parse_args()
 
     print('##### Command #####\n\t' + ' '.join(sys.argv))
@@ -51,7 +56,7 @@ def parse_args():
     return args
 
 
-def main(in_star_file, out_star_file, relion_project_dir, motioncorr_data_dirs, remove_uuid):
+def main(in_star_file, out_star_file, relion_project_dir, motioncorr_data_dirs, remove_uuid, compress_threads=0):
     # Assertions
     assert os.path.isdir(relion_project_dir), 'No such directory : {}'.format(relion_project_dir)
     assert os.path.exists(in_star_file), 'No such file exists : {}'.format(in_star_file)
@@ -69,71 +74,40 @@ def main(in_star_file, out_star_file, relion_project_dir, motioncorr_data_dirs,
         mic_names += lmic_names
         data_dirs += ldata_dirs
 
-    print('Now computing....')
-    with open(in_star_file) as f:
-        inlines = f.readlines()
-
-    out_star_contents = []
-    i = 0
-
-    # Read until data_particles
-    for j in range(i, len(inlines)):
-        line = inlines[j]
-        i += 1
-        out_star_contents.append(line)
-        if line.startswith('data_particles'):
-            break
-
-    # Real until labels
-    for j in range(i, len(inlines)):
-        line = inlines[j]
-        i += 1
-        out_star_contents.append(line)
-        if line.startswith('loop_'):
-            break
-
-    # Read labels, and find the label index of _rlnMicrographName
-    rlnMicrographName_index = None
-    for j in range(i, len(inlines)):
-        line = inlines[j]
-        i += 1
-        if line.startswith('_rlnMicrographName'):
-            rlnMicrographName_index = int(line.split()[1].replace('#', '')) - 1
-        if not line.startswith('_rln'):
-            i -= 1
-            break
-        out_star_contents.append(line)
-    assert rlnMicrographName_index is not None, 'Could not find _rlnMicrographName in the data_particles block.'
-
-    # Read data
-    for j in range(i, len(inlines)):
-        line = inlines[j]
-        i += 1
-        words = line.split()
-        if len(words) == 0:
-            break
-
-        query_mic_name = os.path.basename(words[rlnMicrographName_index])
+    # Micrograph name -> path relative to the relion project directory. The first match wins as before.
+    mic_paths = {}
+    for data_dir, mic_name in zip(data_dirs, mic_names):
+        if mic_name not in mic_paths:
+            mic_paths[mic_name] = os.path.join(data_dir, mic_name)
+
+    # Unmatched micrographs are collected and reported together.
+    unmatched = []
+
+    def find_mic_path(mic):
+        query_mic_name = os.path.basename(mic)
         if remove_uuid:
             # Remove cryoSPARC UUID
             query_mic_name = '_'.join(query_mic_name.split('_')[1:])
+        if query_mic_name not in mic_paths:
+            unmatched.append(query_mic_name)
+            return mic
+        return mic_paths[query_mic_name]
 
-        try:
-            mic_index = mic_names.index(query_mic_name)
-        except ValueError:
+    print('Now computing....')
+    md = c2r.RelionMetaData.load(in_star_file)
+    assert md.data_type == 'data_particles', 'Could not find the data_particles block.'
+    assert '_rlnMicrographName' in md.df_data.columns, 'Could not find _rlnMicrographName in the data_particles block.'
+
+    # _rlnMicrographName is dictionary-encoded, so each unique micrograph is looked up only once.
+    md.df_data['_rlnMicrographName'] = c2r.remap_categories(md.df_data['_rlnMicrographName'], find_mic_path)
+    if len(unmatched) > 0:
+        for query_mic_name in unmatched:
             print('No file name match: {}'.format(query_mic_name), file=sys.stderr)
-            sys.exit()
-
-        data_dir = data_dirs[mic_index]
-        mic_name = mic_names[mic_index]
-
-        newline = ' '.join(words[:rlnMicrographName_index]) + ' ' + os.path.join(data_dir, mic_name) + ' ' + ' '.join(words[rlnMicrographName_index + 1:]) + '\n'
+        sys.exit(f'{len(unmatched)} micrographs were not found in the motioncorr data directories.')
 
-        out_star_contents.append(newline)
+    md.write(out_star_file, threads=compress_threads)
 
-    with open(out_star_file, 'w') as fo:
-        fo.writelines(out_star_contents)
 
 if __name__ == '__main__':
     args = parse_args()
-    main(args.in_star_file, args.out_star_file, args.relion_project_dir, args.motioncorr_data_dirs, args.remove_uuid)
+    main(args.in_star_file, args.out_star_file, args.relion_project_dir, args.motioncorr_data_dirs, args.remove_uuid, args.compress_threads)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""Rewrite the file paths of a star file (e.g. _rlnImageName and _rlnMicrographName) with prefix or regular expression rules, after moving a project to another storage or directory layout.
+
+Rules are given with --prefix (repeatable) and/or a rules file (--rules). The first matching rule wins, and paths matching no rule are kept as they are.
+Syntax of the rules file: one rule per line, <prefix|regex> <pattern> <replacement>. A regex rule is matched at the beginning of the path, and may refer to its groups in the replacement (e.g. \\1). Empty lines and lines starting with # are ignored.
+
+prefix /old_storage/project1/ /new_storage/project1/
+regex ^J([0-9]+)/extract/ Extract/job\\1/
+
+The particles are streamed in chunks, and each unique path is rewritten only once.
+"""
+
+import os
+import sys
+import argparse
+
+import c2r
+
+PATH_LABELS = ('_rlnImageName', '_rlnMicrographName')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description=__doc__
+    )
+    parser.add_argument('--i', type=str, required=True, help='Input star file.')
+    parser.add_argument('--o', type=str, required=True, help='Output star file.')
+    parser.add_argument('--prefix', type=str, nargs=2, action='append', default=[], metavar=('OLD', 'NEW'), help='Replace the leading OLD of the paths with NEW. Can be repeated. Applied before the rules of --rules.')
+    parser.add_argument('--rules', type=str, help='Rules file.')
+    parser.add_argument('--labels', type=str, nargs='+', default=list(PATH_LABELS), help='Labels to rewrite. Labels of the optics block are also accepted. Default: %(default)s')
+    parser.add_argument('--remove_uid', action='store_true', help='Remove the preceding cryoSPARC UIDs of the file names.')
+    parser.add_argument('--require_match', action='store_true', help='Exit with an error (and no output) if any path matches no rule.')
+    parser.add_argument('--compress-threads', type=int, default=0, help='Number of zstd compression threads for .star.zst output. -1 uses all the logical CPUs.')
+    args = parser.parse_args()
+
+    print('##### Command #####\n\t' + ' '.join(sys.argv))
+    args_print_str = '##### Input parameters #####\n'
+    for opt, val in vars(args).items():
+        args_print_str += '\t{} : {}\n'.format(opt, val)
+    print(args_print_str)
+    return args
+
+
+def relocate_df(df, relocator, labels):
+    for label in labels:
+        if label not in df.columns:
+            continue
+        if label == '_rlnImageName':
+            df[label] = relocator.relocate_imgnames(df[label])
+        else:
+            df[label] = relocator.relocate_values(df[label])
+    return df
+
+
+def main():
+    args = parse_args()
+    assert os.path.exists(args.i), 'No such file exists : {}'.format(args.i)
+    assert os.path.abspath(args.i) != os.path.abspath(args.o), 'The output file must be different from the input file.'
+
+    rules = [('prefix', old, new) for old, new in args.prefix]
+    if args.rules is not None:
+        rules += c2r.PathRelocator.load(args.rules).rules
+    assert len(rules) > 0 or args.remove_uid, 'Specify --prefix, --rules or --remove_uid.'
+    relocator = c2r.PathRelocator(rules, rm_uid=args.remove_uid)
+
+    md = c2r.RelionMetaData.load(args.i, lazy=True)
+    data_labels = md.data_labels()
+    labels = [x for x in args.labels if x in data_labels or (md.df_optics is not None and x in md.df_optics.columns)]
+    assert len(labels) > 0, f'None of {args.labels} is found in {args.i}.'
+    print('Rewriting : {}'.format(' '.join(labels)))
+    if md.df_optics is not None:
+        md.df_optics = relocate_df(md.df_optics, relocator, labels)
+
+    if c2r.is_parquet(args.o):
+        # Parquet files are written at once.
+        relocate_df(md.df_data, relocator, labels)
+        md.write(args.o)
+    else:
+        with c2r.open_star(args.o, 'w', threads=args.compress_threads) as f:
+            md.write_header(f, data_labels)
+            for df in md.iter_data_chunks():
+                lines = md._format_rows(relocate_df(df, relocator, labels))
+                if len(lines) > 0:
+                    f.write('\n'.join(lines))
+                    f.write('\n')
+            f.write('\n')
+
+    summary = '##### Rules #####\n'
+    for (kind, pattern, replacement), n in zip(relocator.rules, relocator.num_matched):
+        summary += '\t{} {} -> {} : {} unique paths\n'.format(kind, pattern, replacement, n)
+    summary += '\tno match : {} unique paths\n'.format(len(relocator.unmatched))
+    print(summary)
+
+    if len(relocator.unmatched) > 0:
+        for path in relocator.unmatched[:10]:
+            print('No rule match: {}'.format(path), file=sys.stderr)
+        if args.require_match:
+            os.remove(args.o)
+            sys.exit(f'{len(relocator.unmatched)} paths matched no rule.')
+    print(f'{args.o} was created.')
+
+
+if __name__ == '__main__':
+    main()
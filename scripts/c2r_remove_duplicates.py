@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""Remove duplicated particles, e.g. after merging the picks of several pickers, or after re-centering the particles with the refined origins.
+
+Particles closer than --min_distance to a better particle in the same micrograph are removed. The particle centers are the picked coordinates corrected by the origin shifts.
+Neighbors are found with a spatial hash grid per micrograph, so the run time grows linearly with the number of particles.
+"""
+
+import sys
+import argparse
+
+import numpy as np
+
+import c2r
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description=__doc__
+    )
+    parser.add_argument('--i', type=str, required=True, help='Input star file.')
+    parser.add_argument('--o', type=str, required=True, help='Output star file without the duplicated particles.')
+    parser.add_argument('--o_removed', type=str, help='Output star file of the removed particles.')
+    parser.add_argument('--min_distance', type=float, required=True, help='Minimum inter-particle distance in Angstrom.')
+    parser.add_argument('--score_label', type=str, help='Label to choose the particle to keep among the duplicates, e.g. _rlnMaxValueProbDistribution or _rlnAutopickFigureOfMerit. By default the first one in --i is kept.')
+    parser.add_argument('--lower_is_better', action='store_true', help='Keep the particle with the lowest --score_label.')
+    parser.add_argument('--angpix', type=float, help='Pixel size of the coordinates in Angstrom. By default _rlnMicrographPixelSize of the optics groups. Required if the optics block has no _rlnMicrographPixelSize (_rlnImagePixelSize is of the extracted, possibly binned, particles).')
+    parser.add_argument('--num_workers', type=int, default=1, help='Number of worker processes. -1 uses all the logical CPUs.')
+    args = parser.parse_args()
+
+    print('##### Command #####\n\t' + ' '.join(sys.argv))
+    args_print_str = '##### Input parameters #####\n'
+    for opt, val in vars(args).items():
+        args_print_str += '\t{} : {}\n'.format(opt, val)
+    print(args_print_str)
+    return args
+
+
+def main():
+    args = parse_args()
+
+    print(f'Loading {args.i}...')
+    md = c2r.RelionMetaData.load(args.i)
+    if args.angpix is None and (md.df_optics is None or '_rlnMicrographPixelSize' not in md.df_optics.columns):
+        sys.exit(f'{args.i} has no _rlnMicrographPixelSize. Specify the pixel size of the coordinates with --angpix.')
+
+    print('Finding the duplicated particles...')
+    duplicated = md.find_duplicates(args.min_distance, score_label=args.score_label, lower_is_better=args.lower_is_better, angpix=args.angpix, num_workers=args.num_workers)
+    print(f'{duplicated.sum()} / {len(duplicated)} particles are duplicated.')
+
+    print('Saving the output star file...')
+    md.iloc(np.flatnonzero(~duplicated)).write(args.o, num_workers=args.num_workers)
+    if args.o_removed:
+        md.iloc(np.flatnonzero(duplicated)).write(args.o_removed)
+
+
+if __name__ == '__main__':
+    main()
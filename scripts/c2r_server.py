@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""Run a local metadata server, which keeps parsed star files and cryoSPARC jobs in memory between c2r script invocations.
+
+While the server is running, the other c2r scripts load their inputs from it instead of parsing the files again, and fall back to parsing the files themselves otherwise.
+Cached metadata is reloaded when the files are modified, and the least recently used metadata is dropped beyond --max_memory.
+The server listens on a Unix socket, by default in the system temporary directory. Set C2R_SERVER_SOCKET environment variable to use another socket path (for both the server and the scripts), or to 'none' to disable the server.
+"""
+
+import sys
+import os
+import argparse
+
+import c2r
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description=__doc__
+    )
+    parser.add_argument('--max_memory', type=float, default=8192, help='Memory budget of the cache in MiB.')
+    parser.add_argument('--socket', type=str, default=c2r.server_socket_path(), help='Unix socket path.')
+    parser.add_argument('--stop', action='store_true', help='Stop the running server.')
+    parser.add_argument('--stats', action='store_true', help='Show the cache contents of the running server.')
+    parser.add_argument('--clear', action='store_true', help='Clear the cache of the running server.')
+    args = parser.parse_args()
+
+    print('##### Command #####\n\t' + ' '.join(sys.argv))
+    args_print_str = '##### Input parameters #####\n'
+    for opt, val in vars(args).items():
+        args_print_str += '\t{} : {}\n'.format(opt, val)
+    print(args_print_str)
+    return args
+
+
+def main():
+    args = parse_args()
+
+    if args.stop or args.stats or args.clear:
+        if not os.path.exists(args.socket):
+            sys.exit(f'The server is not running on {args.socket}')
+        op = 'shutdown' if args.stop else 'stats' if args.stats else 'clear'
+        stats = c2r.server_request({'op': op}, socket_path=args.socket)
+        if args.stats:
+            for kind, path, nbytes in stats['entries']:
+                print(f'{kind}\t{nbytes / 1024 ** 2:.1f} MiB\t{path}')
+            print(f'Cache: {stats["cache_size"] / 1024 ** 2:.1f} / {stats["max_memory"] / 1024 ** 2:.1f} MiB, {stats["hits"]} hits, {stats["misses"]} misses')
+        return
+
+    c2r._in_server = True
+    server = c2r.MetadataServer(args.socket, int(args.max_memory * 1024 ** 2))
+    print(f'Serving on {args.socket}. Stop with Ctrl-C or {sys.argv[0]} --stop')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(args.socket)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""Split a RELION star file into one star file per optics group, micrograph or group, written in parallel.
+
+Each output star file carries the optics groups of its particles only. The output files are listed in a manifest file (<root>.manifest.json).
+For example, --o Split/particles.star --shard_by _rlnMicrographName writes Split/particles.0001_mic_0001.star, ... and Split/particles.manifest.json.
+"""
+
+import sys
+import os
+import argparse
+
+import c2r
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description=__doc__
+    )
+    parser.add_argument('--i', type=str, required=True, help='Input star file.')
+    parser.add_argument('--o', type=str, required=True, help='Output file name template. Add .gz, .bz2, .xz or .zst extension to compress the output files.')
+    parser.add_argument('--shard_by', type=str, default='_rlnMicrographName', help='Label to split by, e.g. _rlnOpticsGroup, _rlnMicrographName or _rlnGroupName.')
+    parser.add_argument('--num_workers', type=int, default=1, help='Number of worker processes. -1 uses all the logical CPUs.')
+    parser.add_argument('--compress-threads', type=int, default=0, help='Number of zstd compression threads per worker for .star.zst output. -1 uses all the logical CPUs.')
+    args = parser.parse_args()
+
+    print('##### Command #####\n\t' + ' '.join(sys.argv))
+    args_print_str = '##### Input parameters #####\n'
+    for opt, val in vars(args).items():
+        args_print_str += '\t{} : {}\n'.format(opt, val)
+    print(args_print_str)
+    return args
+
+
+def main():
+    args = parse_args()
+
+    print(f'Loading {args.i}...')
+    md = c2r.RelionMetaData.load(args.i)
+
+    outdir = os.path.dirname(args.o)
+    if outdir:
+        os.makedirs(outdir, exist_ok=True)
+    print('Writing the shards...')
+    md.write(args.o, threads=args.compress_threads, shard_by=args.shard_by, num_workers=args.num_workers)
+    print('Done.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""Write a RELION particle subset (e.g. Bayesian-polished particles or a RELION class selection) back to cryoSPARC as a new particle group.
+
+The particles of --relion_star are matched to the cryoSPARC job by the normalized image ids, and the .cs/passthrough records are selected and reordered to follow --relion_star. The output .cs/.csg files can be imported in cryoSPARC with the Import Result Group job, without re-importing and re-extracting the particles.
+"""
+
+import sys
+import argparse
+
+import numpy as np
+import pandas as pd
+
+import c2r
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description=__doc__
+    )
+    parser.add_argument('--relion_star', type=str, required=True, help='RELION particle star file.')
+    parser.add_argument('--csparc_csg', type=str, required=True, help='Particles .csg file of the cryoSPARC job containing all the particles of --relion_star.')
+    parser.add_argument('--outdir', type=str, required=True, help='Output directory.')
+    parser.add_argument('--out_rootname', type=str, required=True, help='Output file rootname. <out_rootname>_particles.cs, <out_rootname>_passthrough_particles.cs and <out_rootname>_particles.csg are written.')
+    parser.add_argument('--relion_remove_uid', action='store_true', help='Remove the cryoSPARC UIDs from the image names of --relion_star too.')
+    parser.add_argument('--skip_missing', action='store_true', help='Skip the particles not found in the cryoSPARC job, instead of raising an error.')
+    args = parser.parse_args()
+
+    print('##### Command #####\n\t' + ' '.join(sys.argv))
+    args_print_str = '##### Input parameters #####\n'
+    for opt, val in vars(args).items():
+        args_print_str += '\t{} : {}\n'.format(opt, val)
+    print(args_print_str)
+    return args
+
+
+def main():
+    args = parse_args()
+
+    print(f'Loading {args.relion_star}...')
+    md_relion = c2r.RelionMetaData.load(args.relion_star, usecols=('_rlnImageName',))
+    print(f'Loading {args.csparc_csg}...')
+    md_cs = c2r.CryoSPARCMetaData.load(args.csparc_csg)
+
+    print('Matching the particles...')
+    codebook = c2r.ImageKeyCodebook()
+    cs_ids = md_cs.image_keys(codebook, rm_uid=True)
+    relion_ids = md_relion.image_keys(codebook, rm_uid=args.relion_remove_uid)
+    if pd.Index(cs_ids).has_duplicates:
+        sys.exit(f'{args.csparc_csg} has duplicated particle images (e.g. symmetry-expanded particles), which can not be matched to {args.relion_star} by image id. Use the cryoSPARC job before symmetry expansion.')
+    if not args.skip_missing:
+        c2r.preflight_imgids(relion_ids, cs_ids, args.relion_star, args.csparc_csg, require='subset', codebook=codebook)
+    idxs = pd.Index(cs_ids).get_indexer(relion_ids)
+    missing = np.flatnonzero(idxs < 0)
+    if len(missing) > 0:
+        print(f'WARNING: {len(missing)} particles of {args.relion_star} are not found in {args.csparc_csg}, and skipped.')
+        idxs = idxs[idxs >= 0]
+    print(f'{len(idxs)} particles are written.')
+
+    print('Saving the output files...')
+    md_cs.iloc(idxs).write(args.outdir, args.out_rootname)
+
+
+if __name__ == '__main__':
+    main()
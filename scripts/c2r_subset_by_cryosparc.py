@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""Cut a RELION star file down to the particles selected in cryoSPARC (e.g. the particles kept after 2D/3D classification or Select 2D).
+
+Particles are matched by the normalized image ids (particle index + stack file basename without cryoSPARC UIDs) by default. With --match uid, the particles are matched by cryoSPARC uids, which requires --ref_csg, the cryoSPARC job whose particles correspond row by row to --relion_star.
+"""
+
+import sys
+import argparse
+
+import numpy as np
+
+import c2r
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description=__doc__
+    )
+    parser.add_argument('--relion_star', type=str, required=True, help='RELION star file to cut down.')
+    parser.add_argument('--csparc_csg', type=str, required=True, nargs='+', help='cryoSPARC particles .csg file(s) of the selection. The union of the particles is selected.')
+    parser.add_argument('--out_star', type=str, required=True, help='Output star file.')
+    parser.add_argument('--invert', action='store_true', help='Output the particles NOT selected in cryoSPARC (the complement set).')
+    parser.add_argument('--match', type=str, choices=('imgid', 'uid'), default='imgid', help='Match particles by normalized image ids or by cryoSPARC uids.')
+    parser.add_argument('--ref_csg', type=str, help='cryoSPARC particles .csg file corresponding row by row to --relion_star. Required for --match uid.')
+    parser.add_argument('--relion_remove_uid', action='store_true', help='Remove the cryoSPARC UIDs from the image names of --relion_star too.')
+    args = parser.parse_args()
+
+    print('##### Command #####\n\t' + ' '.join(sys.argv))
+    args_print_str = '##### Input parameters #####\n'
+    for opt, val in vars(args).items():
+        args_print_str += '\t{} : {}\n'.format(opt, val)
+    print(args_print_str)
+    return args
+
+
+def main():
+    args = parse_args()
+
+    print(f'Loading {args.relion_star}...')
+    md = c2r.RelionMetaData.load(args.relion_star)
+
+    codebook = c2r.ImageKeyCodebook()
+    sel_keys = []
+    for csg_file in args.csparc_csg:
+        print(f'Loading {csg_file}...')
+        md_sel = c2r.CryoSPARCMetaData.load(csg_file)
+        if args.match == 'uid':
+            sel_keys.append(md_sel.cs['uid'])
+        else:
+            sel_keys.append(md_sel.image_keys(codebook, rm_uid=True))
+
+    print('Computing the membership...')
+    if args.match == 'uid':
+        assert args.ref_csg is not None, '--ref_csg is required for --match uid.'
+        md_ref = c2r.CryoSPARCMetaData.load(args.ref_csg)
+        c2r.preflight_imgids(md_ref.image_keys(codebook, rm_uid=True), md.image_keys(codebook, rm_uid=True), args.ref_csg, args.relion_star, codebook=codebook)
+        mask = np.isin(md_ref.cs['uid'], np.concatenate(sel_keys))
+    else:
+        keys = md.image_keys(codebook, rm_uid=args.relion_remove_uid)
+        sel_keys = np.unique(np.concatenate(sel_keys))
+        mask = np.isin(keys, sel_keys)
+        num_missing = len(sel_keys) - np.isin(sel_keys, keys).sum()
+        if num_missing > 0:
+            print(f'WARNING: {num_missing} of the selected particles were not found in {args.relion_star}')
+
+    if args.invert:
+        mask = ~mask
+    print(f'{mask.sum()} / {len(mask)} particles are selected.')
+
+    print('Saving the output star file...')
+    md_out = md.iloc(np.flatnonzero(mask))
+    md_out.write(args.out_star)
+
+
+if __name__ == '__main__':
+    main()
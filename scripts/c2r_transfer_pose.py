@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 """Transfer pose parameters (rot + trans) and random subset id (half1 or half2) from a star file created by PyEM csparc2star.py to the original relion star file. Particles not listed in the csparc star file are not included in the output star file.
+With --previous_star, the output of a previous run is updated incrementally: only the particles added, removed or changed since then are processed, and the other rows are copied as they are.
 """
 
 import os
@@ -9,7 +10,6 @@ import argparse
 
 import numpy as np
 import pandas as pd
-from tqdm import tqdm
 
 import c2r
 
@@ -33,6 +33,10 @@ def parse_args():
     parser.add_argument('--out_star', type=str, required=True, help='Output star file.')
     parser.add_argument('--csparc_remove_uid', action='store_true', help='Remove the cryoSPARC micrograph UIDs.')
     parser.add_argument('--dont_transfer_random_subset', action='store_true', help='Don\'t transfer _rlnRandomSubset to the output star file.')
+    parser.add_argument('--num_workers', type=int, default=1, help='Number of worker processes formatting the output star file. -1 uses all the logical CPUs.')
+    parser.add_argument('--max_memory', type=float, help='Memory budget in MiB. If specified, both star files are sorted by image id on scratch files and merge-joined, for datasets larger than RAM. The output particles are then sorted by image id.')
+    parser.add_argument('--previous_star', type=str, help='Output star file of a previous run with the same relion star file (uncompressed). Only the particles added, removed or changed in the csparc star file are processed, and a summary of the changes is printed. The remaining particles keep their order, and added particles are appended at the end.')
+    parser.add_argument('--tmpdir', type=str, help='Scratch directory for --max_memory. Preferably on a local disk. By default the system temporary directory.')
     args = parser.parse_args()
 
     print('##### Command #####\n\t' + ' '.join(sys.argv))
@@ -43,12 +47,226 @@ def parse_args():
     return args
 
 
+def transfer_pose_external(args):
+    """Sort-merge join version of main(), with memory bounded by args.max_memory."""
+
+    max_memory = int(args.max_memory * 1024 * 1024)
+    chunk_bytes = max(max_memory // 8, 1024 * 1024)
+
+    md_relion = c2r.RelionMetaData.load(args.relion_star, lazy=True)
+    md_csparc = c2r.RelionMetaData.load(args.csparc_star, lazy=True)
+    md_out = c2r.RelionMetaData(
+        df_data=None,
+        df_optics=md_relion.df_optics,
+        data_type='data_particles'
+    )
+
+    csparc_cols = md_csparc.data_labels()
+    csparc_pose_cols = [x for x in POSE_COLS if x in csparc_cols]
+    if not args.dont_transfer_random_subset:
+        if SUBSET_COL in csparc_cols:
+            csparc_pose_cols.append(SUBSET_COL)
+    relion_cols = md_relion.data_labels()
+    out_cols = relion_cols + [x for x in csparc_pose_cols if x not in relion_cols]
+    out_pose_idxs = [out_cols.index(x) for x in csparc_pose_cols]
+
+    with c2r.ExternalSorter(max_memory // 2, args.tmpdir) as sorter_csparc, c2r.ExternalSorter(max_memory // 2, args.tmpdir) as sorter_relion:
+        print('Sorting the csparc star file by image id...')
+        for df in md_csparc.iter_data_chunks(chunk_bytes, usecols=['_rlnImageName'] + csparc_pose_cols):
+            if len(csparc_pose_cols) > 0:
+                poses = md_out._format_rows(df[csparc_pose_cols])
+            else:
+                # Nothing to transfer, but the particles are still checked and written.
+                poses = [''] * len(df)
+            sorter_csparc.add(c2r.df_data_to_imgids(df, rm_uid=True), poses)
+
+        print('Sorting the relion star file by image id...')
+        for df in md_relion.iter_data_chunks(chunk_bytes):
+            sorter_relion.add(c2r.df_data_to_imgids(df, rm_uid=False), md_out._format_rows(df))
+
+        print('Transfering poses....')
+        with c2r.open_star(args.out_star, 'w') as f:
+            md_out.write_header(f, out_cols)
+            for imgid, pose, row in c2r.merge_join(sorter_csparc, sorter_relion):
+                assert row is not None, f'{imgid} of {args.csparc_star} is not found in {args.relion_star}'
+                words = row.split(' ')
+                words.extend([''] * (len(out_cols) - len(words)))
+                for idx, value in zip(out_pose_idxs, pose.split(' ')):
+                    words[idx] = value
+                f.write(' '.join(words))
+                f.write('\n')
+            f.write('\n')
+
+
+def copy_rows(f_in, f_out, start, end, chunk_size=64 * 1024 * 1024):
+    """Copy the star file bytes [start, end) as they are, between binary file objects.
+    Returns True if a line break was appended to the last row.
+    """
+
+    f_in.seek(start)
+    last = b''
+    while start < end:
+        data = f_in.read(min(chunk_size, end - start))
+        if len(data) == 0:
+            break
+        f_out.write(data)
+        start += len(data)
+        last = data[-1:]
+    # The last row of the file may lack the line break.
+    if last not in (b'', b'\n'):
+        f_out.write(b'\n')
+        return True
+    return False
+
+
+def transfer_pose_incremental(args):
+    """Update the output of a previous run (args.previous_star) with the particles added, removed or changed in the csparc star file."""
+
+    print('Loading star files...')
+    md_csparc = c2r.RelionMetaData.load(args.csparc_star, usecols=('_rlnImageName',) + POSE_COLS + (SUBSET_COL,))
+    csparc_cols = list(md_csparc.df_data.columns)
+    csparc_pose_cols = [x for x in POSE_COLS if x in csparc_cols]
+    if not args.dont_transfer_random_subset:
+        if SUBSET_COL in csparc_cols:
+            csparc_pose_cols.append(SUBSET_COL)
+
+    # The row index gives the byte range of every row, so that unchanged rows are copied without formatting.
+    index = c2r.StarRowIndex.load(args.previous_star)
+    missing_cols = [x for x in csparc_pose_cols if x not in index.labels]
+    if len(missing_cols) > 0:
+        sys.exit(f'{args.previous_star} does not have {missing_cols}. Run without --previous_star.')
+    md_prev = c2r.RelionMetaData.load(args.previous_star, categorical=False, usecols=['_rlnImageName'] + csparc_pose_cols)
+
+    print('Comparing particles...')
+    codebook = c2r.ImageKeyCodebook()
+    prev_ids = md_prev.image_keys(codebook, rm_uid=False)
+    csparc_ids = md_csparc.image_keys(codebook, rm_uid=True)
+    for ids, name in ((prev_ids, args.previous_star), (csparc_ids, args.csparc_star)):
+        if pd.Index(ids).has_duplicates:
+            sys.exit(f'{name} has duplicated particles (e.g. symmetry expansion), which can not be matched incrementally. Run without --previous_star.')
+
+    # Position of the csparc particles in the previous output. -1 for added particles.
+    pos = pd.Index(prev_ids).get_indexer(csparc_ids)
+    added = pos < 0
+    kept = ~added
+    removed = np.ones(len(prev_ids), dtype=bool)
+    removed[pos[kept]] = False
+
+    # Changed values of the kept particles, in the previous output order.
+    changed = np.zeros(len(prev_ids), dtype=bool)
+    col_changes = {}
+    for col in csparc_pose_cols:
+        prev_values = md_prev.df_data[col].to_numpy()
+        diff = prev_values[pos[kept]] != md_csparc.df_data[col].to_numpy()[kept]
+        col_changes[col] = int(np.count_nonzero(diff))
+        changed[pos[kept][diff]] = True
+
+    summary = '##### Changes #####\n'
+    summary += '\tunchanged : {}\n'.format(int(np.count_nonzero(~removed & ~changed)))
+    summary += '\tchanged : {}\n'.format(int(np.count_nonzero(changed)))
+    summary += '\tadded : {}\n'.format(int(np.count_nonzero(added)))
+    summary += '\tremoved : {}\n'.format(int(np.count_nonzero(removed)))
+    for col, n in col_changes.items():
+        summary += '\t{} : {} changed\n'.format(col, n)
+    print(summary)
+
+    if not np.any(changed | removed) and not np.any(added) and os.path.abspath(args.out_star) == os.path.abspath(args.previous_star):
+        print('Nothing to update.')
+        return
+
+    # The csparc values of the previous output rows.
+    csparc_rows = np.full(len(prev_ids), -1, dtype=np.int64)
+    csparc_rows[pos[kept]] = np.flatnonzero(kept)
+
+    print('Formatting changed particles...')
+    changed_rows = np.flatnonzero(changed)
+    df_changed = index.fetch_rows(changed_rows, categorical=False)
+    for col in csparc_pose_cols:
+        df_changed[col] = md_csparc.df_data[col].to_numpy()[csparc_rows[changed_rows]]
+    changed_lines = [x.encode() + b'\n' for x in c2r.RelionMetaData._format_rows(df_changed[index.labels])]
+
+    added_lines = []
+    if np.any(added):
+        print('Loading added particles from the relion star file...')
+        added_imgids = codebook.imgids(csparc_ids[added])
+        if os.path.splitext(args.relion_star)[1].lower() == '.star':
+            md_added = c2r.RelionMetaData.load_rows(args.relion_star, imgids=added_imgids, categorical=False)
+            df_added = md_added.df_data
+            found_ids = c2r.df_data_to_imgids(df_added, rm_uid=False)
+        else:
+            md_relion = c2r.RelionMetaData.load(args.relion_star, categorical=False)
+            relion_ids = c2r.df_data_to_imgids(md_relion.df_data, rm_uid=False)
+            js = pd.Index(relion_ids).get_indexer(added_imgids)
+            df_added = md_relion.df_data.iloc[js[js >= 0]].reset_index(drop=True)
+            found_ids = relion_ids[js[js >= 0]]
+        not_found = np.setdiff1d(added_imgids, found_ids)
+        if len(not_found) > 0:
+            sys.exit(f'{len(not_found)} particles of {args.csparc_star} are not found in {args.relion_star} (e.g. {not_found[0]}).')
+        missing_cols = [x for x in index.labels if x not in df_added.columns and x not in csparc_pose_cols]
+        if len(missing_cols) > 0:
+            sys.exit(f'{args.relion_star} does not have {missing_cols} of {args.previous_star}. Run without --previous_star.')
+        for col in csparc_pose_cols:
+            df_added[col] = md_csparc.df_data[col].to_numpy()[added]
+        added_lines = [x.encode() + b'\n' for x in c2r.RelionMetaData._format_rows(df_added[index.labels])]
+
+    print('Saving the output star file...')
+    # Write next to the output first, as the previous output may be overwritten. The codec follows the extension, which is kept last.
+    root, ext = os.path.splitext(args.out_star)
+    compressed = ext.lower() in ('.gz', '.bz2', '.xz', '.zst')
+    tmp_star = root + '.tmp' + ext if compressed else args.out_star + '.tmp'
+    rows = np.flatnonzero(~removed)
+    # Byte length of each output row, for the row index of the output.
+    lengths = np.concatenate([np.diff(index.offsets.astype(np.int64))[rows], [len(x) for x in added_lines]]).astype(np.int64)
+    with open(args.previous_star, 'rb') as f_in, c2r.open_star(tmp_star, 'wb') as f_out:
+        copy_rows(f_in, f_out, 0, int(index.offsets[0]))
+        # Runs of consecutive previous rows that are either copied or reformatted.
+        breaks = np.flatnonzero((np.diff(rows) != 1) | (np.diff(changed[rows].astype(np.int8)) != 0)) + 1
+        changed_line_idxs = np.cumsum(changed) - 1
+        out_pos = 0
+        for run in np.split(rows, breaks):
+            if len(run) == 0:
+                continue
+            if changed[run[0]]:
+                for j, i in enumerate(changed_line_idxs[run]):
+                    f_out.write(changed_lines[i])
+                    lengths[out_pos + j] = len(changed_lines[i])
+            elif copy_rows(f_in, f_out, int(index.offsets[run[0]]), int(index.offsets[run[-1] + 1])):
+                lengths[out_pos + len(run) - 1] += 1
+            out_pos += len(run)
+        for line in added_lines:
+            f_out.write(line)
+        f_out.write(b'\n')
+    os.replace(tmp_star, args.out_star)
+
+    if not compressed:
+        # Save the row index of the output, so that the next incremental run does not scan it again.
+        out_keys = np.concatenate([prev_ids[rows], csparc_ids[added]])
+        key_hashes = c2r.hash_imgids(codebook.imgids(out_keys))
+        key_rows = np.argsort(key_hashes, kind='stable')
+        offsets = np.concatenate([[int(index.offsets[0])], int(index.offsets[0]) + np.cumsum(lengths)]).astype(np.uint64)
+        out_index = c2r.StarRowIndex(args.out_star, index.block_name, index.labels, offsets, key_hashes[key_rows], key_rows, False)
+        try:
+            out_index.save()
+        except OSError:
+            pass
+
+
 def main():
     args = parse_args()
 
+    if args.previous_star is not None:
+        assert args.max_memory is None, '--previous_star and --max_memory can not be used together.'
+        transfer_pose_incremental(args)
+        return
+
+    if args.max_memory is not None:
+        transfer_pose_external(args)
+        return
+
     print('Loading star files...')
     md_relion = c2r.RelionMetaData.load(args.relion_star)
-    md_csparc = c2r.RelionMetaData.load(args.csparc_star)
+    # Only the image names and the transferred labels are needed from the csparc star file.
+    md_csparc = c2r.RelionMetaData.load(args.csparc_star, usecols=('_rlnImageName',) + POSE_COLS + (SUBSET_COL,))
     md_out = c2r.RelionMetaData(
         df_data=None,
         df_optics=md_relion.df_optics,
@@ -57,46 +275,27 @@ def main():
 
     print('Preparing....')
     csparc_cols = list(md_csparc.df_data.columns)
-    csparc_data = md_csparc.df_data.to_numpy(copy=True)
     csparc_pose_cols = [x for x in POSE_COLS if x in csparc_cols]
     if not args.dont_transfer_random_subset:
         if SUBSET_COL in csparc_cols:
             csparc_pose_cols.append(SUBSET_COL)
-    csparc_pose_idxs = [csparc_cols.index(x) for x in csparc_pose_cols]
-    csparc_imgname_idx = csparc_cols.index('_rlnImageName')
-
-    relion_cols = list(md_relion.df_data.columns)
-    relion_data = md_relion.df_data.to_numpy(copy=True)
-    for csparc_pose_col in csparc_pose_cols:
-        if csparc_pose_col not in relion_cols:
-            relion_cols.append(csparc_pose_col)
-            relion_data = np.concatenate((relion_data, np.empty((relion_data.shape[0], 1))), axis=1)
-    relion_pose_cols = csparc_pose_cols
-    relion_pose_idxs = [relion_cols.index(x) for x in relion_pose_cols]
-    relion_imgname_idx = relion_cols.index('_rlnImageName')
-
-    out_cols = relion_cols
-    out_data = []
 
     print('Listing relion image id...')
-    relion_id_dict = {}
-    for i in tqdm(range(relion_data.shape[0])):
-        relion_id_dict[c2r.imgname_to_imgid(relion_data[i, relion_imgname_idx], rm_uid=False)] = i
+    codebook = c2r.ImageKeyCodebook()
+    relion_ids = md_relion.image_keys(codebook, rm_uid=False)
+    csparc_ids = md_csparc.image_keys(codebook, rm_uid=True)
+    # Every csparc particle must be found in the relion star file. Symmetry-expanded csparc particles are allowed.
+    c2r.preflight_imgids(csparc_ids, relion_ids, args.csparc_star, args.relion_star, require='subset', allow_duplicated_a=True, codebook=codebook)
 
     print('Transfering poses....')
-    for i in tqdm(range(csparc_data.shape[0])):
-        csparc_id = c2r.imgname_to_imgid(csparc_data[i, csparc_imgname_idx], rm_uid=True)
-        j = relion_id_dict[csparc_id]
-        dst = np.copy(relion_data[j])
-        src = csparc_data[i]
-        dst[relion_pose_idxs] = src[csparc_pose_idxs]
-        out_data.append(dst)
-
-    print('Converting to dataframe...')
-    md_out.df_data = pd.DataFrame(out_data, columns=out_cols)
+    js = pd.Index(relion_ids).get_indexer(csparc_ids)
+    df_out = md_relion.df_data.iloc[js].reset_index(drop=True)
+    for col in csparc_pose_cols:
+        df_out[col] = md_csparc.df_data[col].to_numpy()
+    md_out.df_data = df_out
 
     print('Saving the output star file...')
-    md_out.write(args.out_star)
+    md_out.write(args.out_star, num_workers=args.num_workers)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""Check that the files referenced by a star file exist, before RELION fails on them hours later.
+
+The unique paths of the particle stacks (_rlnImageName), the micrographs (_rlnMicrographName) and other referenced files (_rlnMicrographMetadata, _rlnCtfImage) are collected, and checked with many concurrent stat calls, which is fast even on high-latency network file systems.
+Optionally, the MRC headers of the particle stacks are read to check that each stack holds the highest particle index referenced from the star file, and that the stack file is not truncated.
+The exit status is 0 if no problem is found, 1 otherwise.
+"""
+
+import sys
+import os
+import re
+import struct
+import argparse
+import concurrent.futures
+
+import pandas as pd
+
+import c2r
+
+PATH_LABELS = ('_rlnMicrographName', '_rlnMicrographMetadata', '_rlnCtfImage')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description=__doc__
+    )
+    parser.add_argument('--i', type=str, required=True, help='Input star file.')
+    parser.add_argument('--project_dir', type=str, default='.', help='RELION project directory, to which the paths in --i are relative.')
+    parser.add_argument('--check_stacks', action='store_true', help='Read the MRC headers of the particle stacks, and check the number of images and the file sizes.')
+    parser.add_argument('--num_workers', type=int, default=32, help='Number of concurrent file system requests.')
+    parser.add_argument('--report', type=str, help='Write all the problems to this file (tab separated: problem, path, detail). By default only the first ones are printed.')
+    parser.add_argument('--num_examples', type=int, default=10, help='Number of problems printed per kind.')
+    args = parser.parse_args()
+
+    print('##### Command #####\n\t' + ' '.join(sys.argv))
+    args_print_str = '##### Input parameters #####\n'
+    for opt, val in vars(args).items():
+        args_print_str += '\t{} : {}\n'.format(opt, val)
+    print(args_print_str)
+    return args
+
+
+def check_stack(path, max_idx):
+    """Problems of a particle stack: fewer images than max_idx, or a truncated file."""
+
+    try:
+        header = c2r.read_mrc_header(path)
+    except (OSError, AssertionError, struct.error) as e:
+        return [('unreadable_stack', str(e))]
+    problems = []
+    if header['nz'] < max_idx:
+        problems.append(('too_few_images', f'{header["nz"]} images, particle {max_idx} referenced'))
+    if header['data_size'] is not None:
+        expected = header['data_offset'] + header['data_size']
+        size = os.path.getsize(path)
+        if size < expected:
+            problems.append(('truncated_stack', f'{size} bytes, {expected} bytes expected'))
+    return problems
+
+
+def main():
+    args = parse_args()
+
+    print(f'Loading {args.i}...')
+    # Parse the path labels only.
+    md = c2r.RelionMetaData.load(args.i, usecols=('_rlnImageName',) + PATH_LABELS)
+    labels = md.data_labels()
+    assert len(labels) > 0, f'No file path labels found in {args.i}'
+    df = md.df_data
+
+    print('Collecting the referenced files...')
+    # Highest referenced particle index of each stack.
+    max_idxs = {}
+    if '_rlnImageName' in labels:
+        idxs, stacks = c2r.split_imgnames(df['_rlnImageName'])
+        per_stack = pd.Series(idxs).groupby(stacks.codes).max()
+        max_idxs = {stacks.categories[code]: int(idx) for code, idx in per_stack.items()}
+    paths = {x: 'stack' for x in max_idxs}
+    for label in PATH_LABELS:
+        if label in labels:
+            for x in df[label].astype('category').cat.categories:
+                # RELION appends the file type to some paths (e.g. x.ctf:mrc).
+                paths.setdefault(re.sub(':mrcs?$', '', x), label)
+    print(f'{len(paths)} unique files are referenced.')
+
+    print('Checking the files...')
+    stats = c2r.stat_files([os.path.join(args.project_dir, x) for x in paths], num_workers=args.num_workers)
+    problems = []
+    for path, kind in paths.items():
+        if stats[os.path.join(args.project_dir, path)] is None:
+            problems.append(('missing', path, kind))
+
+    if args.check_stacks:
+        print('Checking the particle stacks...')
+        existing = [x for x in max_idxs if stats[os.path.join(args.project_dir, x)] is not None]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.num_workers) as executor:
+            results = executor.map(lambda x: check_stack(os.path.join(args.project_dir, x), max_idxs[x]), existing)
+            for path, stack_problems in zip(existing, results):
+                problems += [(problem, path, detail) for problem, detail in stack_problems]
+
+    kinds = pd.Series([x[0] for x in problems], dtype=object)
+    for kind, count in kinds.value_counts().items():
+        print(f'{kind}: {count} files, e.g.')
+        for problem, path, detail in [x for x in problems if x[0] == kind][:args.num_examples]:
+            print(f'\t{path}\t{detail}')
+    if args.report:
+        with open(args.report, 'w') as f:
+            f.writelines(f'{problem}\t{path}\t{detail}\n' for problem, path, detail in problems)
+    if len(problems) > 0:
+        sys.exit(f'{len(problems)} problems found in the files referenced by {args.i}')
+    print('All the referenced files are OK.')
+
+
+if __name__ == '__main__':
+    main()